@@ -0,0 +1,805 @@
+# Micro benchmarks for the server and the protocol code.
+#
+# Run all of them with `python benchmarks.py`, or pick some by name:
+# `python benchmarks.py framing`.
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from asyncio import IncompleteReadError
+
+import common
+import shipserv
+from common import parse as hw3_parse, _SOCKET_NAME
+from shipclient import Battleship
+
+SHOOT_MESSAGE = b'(shoot 12 3 4)'
+LAYOUT_MESSAGE = (b'(layout 123 (ship 5 0 0 horizontal)'
+                  b' (ship 4 5 5 vertical)'
+                  b' (ship 3 6 5 vertical)'
+                  b' (ship 3 8 5 vertical)'
+                  b' (ship 2 9 9 horizontal))')
+NICK_MESSAGE = b'(nick "bench" "salt")'
+
+# ( x, y, size, vertical )
+LAYOUT = [ ( 0, 0, 2, False ),
+           ( 0, 1, 3, False ),
+           ( 0, 2, 3, False ),
+           ( 0, 3, 4, False ),
+           ( 0, 4, 5, False ), ]
+
+
+class _NullWriter:
+    """Stands in for asyncio.StreamWriter, just counts what was written."""
+
+    def __init__( self ):
+        self.written = 0
+        self.transport = self
+
+    def get_write_buffer_size( self ):
+        return 0
+
+    def abort( self ):
+        pass
+
+    def write( self, data ):
+        self.written += len(data)
+
+    def writelines( self, data ):
+        for d in data:
+            self.write( d )
+
+    async def drain( self ):
+        pass
+
+    def close( self ):
+        pass
+
+    def is_closing( self ):
+        return False
+
+
+class _CountingServer(shipserv.Server):
+    """Server which only counts the commands it was handed."""
+
+    def __init__( self ):
+        super().__init__()
+        self.executed = 0
+
+    async def execute( self, command, player ):
+        self.executed += 1
+
+
+async def _legacy_handle_client( server, reader, writer ):
+    """The byte-at-a-time loop Server.handle_client used before framing."""
+    buffer = ""
+    while True:
+        try:
+            data = await reader.readexactly(1)
+        except IncompleteReadError:
+            break
+
+        buffer += data.decode()
+        command = hw3_parse( buffer, native=True )
+
+        if command is None:
+            continue
+
+        await server.execute( command=command, player=writer )
+        buffer = ""
+
+
+def _report( name, count, elapsed, unit="msg" ):
+    print( f"{name:<40} {count / elapsed:>14,.0f} {unit}/s   ({count} in {elapsed:.3f} s)" )
+
+
+async def _run_handler( handler, message, count, chunk ):
+    server = _CountingServer()
+    reader = asyncio.StreamReader( limit=2 ** 30 )
+    payload = NICK_MESSAGE + message * count
+
+    # deliver the stream in socket sized chunks
+    for i in range( 0, len(payload), chunk ):
+        reader.feed_data( payload[i:i + chunk] )
+    reader.feed_eof()
+
+    start = time.perf_counter()
+    await handler( server, reader, _NullWriter() )
+    elapsed = time.perf_counter() - start
+
+    assert server.executed == count + 1, server.executed
+    return elapsed
+
+
+async def bench_framing( count=20000 ):
+    """Messages per second of the legacy read loop and the framed one."""
+    async def framed( server, reader, writer ):
+        await server.handle_client( reader, writer )
+
+    # the legacy loop is quadratic, keep its runs short
+    for name, message, legacy_count in ( ("shoot", SHOOT_MESSAGE, count // 4),
+                                         ("layout", LAYOUT_MESSAGE, count // 40) ):
+        elapsed = await _run_handler( _legacy_handle_client, message, legacy_count, 4096 )
+        _report( f"{name}: legacy byte-at-a-time", legacy_count, elapsed )
+
+        elapsed = await _run_handler( framed, message, count, 4096 )
+        _report( f"{name}: framed", count, elapsed )
+
+
+def _disconnect_all( server ):
+    for writer in list( server._outboxes ):
+        server._disconnect( writer )
+
+
+async def _login( server, nick ):
+    writer = _NullWriter()
+    server._connect( writer )
+    await server._nick( writer, hw3_parse( f'(nick "{nick}" "salt")', native=True ) )
+    return writer
+
+
+async def bench_nicks( sizes=( 10, 1000, 10000, 100000 ), rounds=1000 ):
+    """Latency of login and joinplayer with a growing number of players."""
+    for size in sizes:
+        server = shipserv.Server()
+        for i in range(size):
+            await _login( server, f"idle{i}" )
+
+        start = time.perf_counter()
+        hosts = [ await _login( server, f"host{i}" ) for i in range(rounds) ]
+        login = ( time.perf_counter() - start ) / rounds
+
+        joiners = [ await _login( server, f"joiner{i}" ) for i in range(rounds) ]
+        for host in hosts:
+            await server._start( host, hw3_parse( '(start "hash")', native=True ) )
+
+        start = time.perf_counter()
+        for i, joiner in enumerate(joiners):
+            await server._joinplayer( joiner, hw3_parse( f'(joinplayer "host{i}" "hash")', native=True ) )
+        joinplayer = ( time.perf_counter() - start ) / rounds
+
+        print( f"{size:>8} players   login {login * 1e6:8.1f} us   joinplayer {joinplayer * 1e6:8.1f} us" )
+        _disconnect_all( server )
+
+
+async def bench_pairing( sizes=( 1000, 10000, 100000 ), pairs=5000 ):
+    """Pairing with ‹size› games waiting.
+
+    Steady state, where each auto() takes the oldest game and a new one is
+    started, then all of them taken with none started.
+    """
+    for size in sizes:
+        server = shipserv.Server()
+        for i in range(size):
+            host = await _login( server, f"host{i}" )
+            await server._start( host, hw3_parse( '(start "hash")', native=True ) )
+        players = [ await _login( server, f"player{i}" ) for i in range( 2 * pairs ) ]
+
+        start = time.perf_counter()
+        for i in range(pairs):
+            await server._auto( players[ 2 * i ], hw3_parse( '(auto "hash")', native=True ) )
+            await server._start( players[ 2 * i + 1 ], hw3_parse( '(start "hash")', native=True ) )
+        elapsed = time.perf_counter() - start
+
+        assert len( server._waiting ) == size
+        _report( f"pairing, {size} waiting games", pairs, elapsed, "pair" )
+
+        # and nobody starts any more, the queue empties from its front
+        joiners = [ await _login( server, f"joiner{i}" ) for i in range(size) ]
+        start = time.perf_counter()
+        for joiner in joiners:
+            await server._auto( joiner, hw3_parse( '(auto "hash")', native=True ) )
+        elapsed = time.perf_counter() - start
+
+        assert not server._waiting
+        _report( f"draining {size} waiting games", size, elapsed, "pair" )
+        _disconnect_all( server )
+
+
+async def bench_matchmaking( sizes=( 100, 1000, 10000 ), joiners_per_game=4 ):
+    """Join storms: many concurrent auto() and join() calls on waiting games."""
+    for size in sizes:
+        server = shipserv.Server()
+        hosts = [ await _login( server, f"host{i}" ) for i in range(size) ]
+        for host in hosts:
+            await server._start( host, hw3_parse( '(start "hash")', native=True ) )
+        joiners = [ await _login( server, f"joiner{i}" ) for i in range( size * joiners_per_game ) ]
+
+        async def try_auto( joiner ):
+            await server._auto( joiner, hw3_parse( '(auto "hash")', native=True ) )
+
+        start = time.perf_counter()
+        await asyncio.gather( *map( try_auto, joiners ) )
+        elapsed = time.perf_counter() - start
+
+        # the first joiners pair up with all hosts, the rest pair among themselves
+        paired = sum( len(game) == 2 for game in server.games.values() )
+        assert paired == size + ( len(joiners) - size ) // 2, paired
+        _report( f"auto storm, {size} waiting games", len(joiners), elapsed, "auto" )
+
+        # everyone races for the same fresh game, exactly one may win
+        host = await _login( server, "racehost" )
+        await server._start( host, hw3_parse( '(start "hash")', native=True ) )
+        game_id = server._get_active_game( host )
+
+        async def try_join( joiner ):
+            try:
+                await server._join( joiner, hw3_parse( f'(join {game_id} "hash")', native=True ) )
+                return True
+            except shipserv.ServerError:
+                return False
+
+        start = time.perf_counter()
+        won = await asyncio.gather( *map( try_join, joiners ) )
+        elapsed = time.perf_counter() - start
+
+        assert sum(won) == 1, sum(won)
+        _report( f"join race, {len(joiners)} joiners", len(joiners), elapsed, "join" )
+        _disconnect_all( server )
+
+
+def _legacy_games_reply( server ):
+    """The (games ...) reply as Server._list built it before caching."""
+    games = []
+    for g in server.games:
+        players = list(server.games[g])
+        if len(players) == 1:
+            games.append( f'(waiting "{server.players[ players[0] ]["nick"]}" {g})' )
+        elif len(players) == 2:
+            games.append( f'(active "{server.players[ players[0] ]["nick"]}" "{server.players[ players[1] ]["nick"]}" {g})' )
+    games = " ".join(games)
+    return f'(games {games})\n'.encode()
+
+
+async def bench_listing( games=10000, listers=1000, lists=20, change_every=100 ):
+    """(list) replies with many games, rebuilt each time and cached."""
+    server = shipserv.Server()
+    for i in range(games):
+        host = await _login( server, f"host{i}" )
+        await server._start( host, hw3_parse( '(start "hash")', native=True ) )
+        if i % 2:
+            joiner = await _login( server, f"joiner{i}" )
+            await server._join( joiner, hw3_parse( f'(join {server._get_active_game( host )} "hash")', native=True ) )
+    clients = [ await _login( server, f"lister{i}" ) for i in range(listers) ]
+    command = hw3_parse( '(list)', native=True )
+
+    assert _legacy_games_reply( server ) == server._get_games_reply()
+
+    late_hosts = 0
+
+    async def run( send_games, listing_clients, lists ):
+        nonlocal late_hosts
+        count = 0
+        start = time.perf_counter()
+        for _ in range(lists):
+            for client in listing_clients:
+                await send_games( client )
+                count += 1
+                # let the outboxes flush
+                await asyncio.sleep(0)
+                # the lobby keeps changing while people list it
+                if count % change_every == 0:
+                    late_hosts += 1
+                    host = await _login( server, f"late{late_hosts}" )
+                    await server._start( host, hw3_parse( '(start "hash")', native=True ) )
+        return count, time.perf_counter() - start
+
+    async def legacy( client ):
+        server._send_to_player( client, _legacy_games_reply( server ) )
+
+    async def cached( client ):
+        await server._list( client, command )
+
+    # rebuilding is slow, a few hundred listings are enough to see it
+    count, elapsed = await run( legacy, clients[:200], 1 )
+    _report( f"rebuilt reply, {games} games", count, elapsed, "list" )
+
+    count, elapsed = await run( cached, clients, lists )
+    _report( f"cached reply, {games} games", count, elapsed, "list" )
+
+    _disconnect_all( server )
+
+
+async def _play( nick ):
+    """Play one game with auto(), shooting the board row by row."""
+    b = Battleship()
+    for x, y, size, vertical in LAYOUT:
+        b.put_ship( x, y, size, vertical )
+
+    await b.connect( nick )
+    await b.auto()
+
+    rounds = 0
+    while not b.finished():
+        await b.round( rounds % 10, rounds // 10 )
+        rounds += 1
+    return rounds
+
+
+async def _play_games( server, games ):
+    """Serve ‹games› concurrent games of two clients, return rounds played."""
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir( directory )
+        try:
+            listener = await asyncio.start_unix_server( server.handle_client, path=_SOCKET_NAME,
+                                                        backlog=4 * games )
+            async with listener:
+                rounds = await asyncio.gather( *[ _play( f"player{i}" ) for i in range( 2 * games ) ] )
+        finally:
+            os.chdir( cwd )
+    return sum(rounds) // 2
+
+
+async def bench_outbox( games=200 ):
+    """Frames written per writelines() call while games are played."""
+    server = shipserv.Server()
+
+    start = time.perf_counter()
+    rounds = await _play_games( server, games )
+    elapsed = time.perf_counter() - start
+
+    outboxes = list( server._outboxes.values() )
+    frames = server.sent_frames + sum( o.sent_frames for o in outboxes )
+    flushes = server.flushes + sum( o.flushes for o in outboxes )
+    peak = max( ( o.peak_depth for o in outboxes ), default=0 )
+
+    _report( f"{games} concurrent games", rounds, elapsed, "round" )
+    print( f"{frames} frames in {flushes} writelines calls "
+           f"({frames / flushes:.2f} frames per call, peak queue depth {peak})" )
+
+
+GAMES_MESSAGE = b'(games (waiting "foo" 1) (active "alice" "bob" 2) (waiting "bar" 3))'
+
+
+async def bench_parser( count=20000 ):
+    """Messages per second parsed by Parser and by the tokenizer in parse()."""
+    def reference( expr ):
+        return common.Parser( expr.strip(), 0 ).parse()
+
+    for name, message in ( ("shoot", SHOOT_MESSAGE), ("layout", LAYOUT_MESSAGE),
+                           ("nick", NICK_MESSAGE), ("games", GAMES_MESSAGE) ):
+        expr = message.decode()
+        rates = []
+        for label, parse in ( ("Parser", reference), ("tokenizer", hw3_parse) ):
+            start = time.perf_counter()
+            for _ in range(count):
+                parse( expr )
+            elapsed = time.perf_counter() - start
+            _report( f"{name}: {label}", count, elapsed )
+            rates.append( count / elapsed )
+        print( f"{name}: {rates[1] / rates[0]:.1f}x" )
+
+
+async def bench_parse_memory( count=10000 ):
+    """Memory traced by tracemalloc while parsing 10k received messages."""
+    def decoded( frame ):
+        return hw3_parse( frame.decode() )
+
+    for name, message in ( ("shoot", SHOOT_MESSAGE), ("layout", LAYOUT_MESSAGE),
+                           ("games", GAMES_MESSAGE) ):
+        frames = [ bytes( message ) for _ in range(count) ]
+        for label, parse in ( ("decode + parse", decoded), ("parse bytes", hw3_parse) ):
+            start = time.perf_counter()
+            for frame in frames:
+                parse( frame )
+            elapsed = time.perf_counter() - start
+
+            tracemalloc.start()
+            parsed = [ parse( frame ) for frame in frames ]
+            kept, peak = tracemalloc.get_traced_memory()
+
+            # what parsing allocates and frees again on the way
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            for frame in frames:
+                parse( frame )
+            _, transient = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print( f"{name + ': ' + label:<24} kept {kept / 1024:8.1f} kB   peak {peak / 1024:8.1f} kB   "
+                   f"transient {( transient - base ) / 1024:6.1f} kB   {count / elapsed:>10,.0f} msg/s" )
+            del parsed
+
+
+HIT_MESSAGE = b'(hit 12)'
+
+
+async def bench_queued( count=100000 ):
+    """Memory held by ‹count› parsed messages waiting in a queue."""
+    for name, message in ( ("shoot", SHOOT_MESSAGE), ("hit", HIT_MESSAGE),
+                           ("layout", LAYOUT_MESSAGE), ("games", GAMES_MESSAGE) ):
+        # the first parse may fill caches, it does not count
+        hw3_parse( message )
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        queue = [ hw3_parse( message ) for _ in range(count) ]
+        blocks = sys.getallocatedblocks() - blocks
+        kept, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del queue
+        print( f"{name:<8} {kept / 1024:10.1f} kB   {kept / count:6.0f} B/msg   "
+               f"{blocks / count:5.1f} blocks/msg" )
+
+
+async def bench_native( count=20000 ):
+    """Nodes against native values: parse rate and memory kept per message."""
+    for name, message in ( ("shoot", SHOOT_MESSAGE), ("hit", HIT_MESSAGE),
+                           ("layout", LAYOUT_MESSAGE), ("games", GAMES_MESSAGE) ):
+        for label, native in ( ("nodes", False), ("native", True) ):
+            hw3_parse( message, native )
+            start = time.perf_counter()
+            for _ in range(count):
+                hw3_parse( message, native )
+            elapsed = time.perf_counter() - start
+
+            tracemalloc.start()
+            queue = [ hw3_parse( message, native ) for _ in range(count) ]
+            kept, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del queue
+            print( f"{name + ': ' + label:<16} {count / elapsed:>12,.0f} msg/s   {kept / count:6.0f} B/msg" )
+
+
+async def bench_gameplay( count=100000 ):
+    """shoot, hit and miss decoded by parse() and by parse_gameplay()."""
+    def general( frame ):
+        return hw3_parse( frame, native=True )
+
+    for name, message in ( ("shoot", SHOOT_MESSAGE), ("hit", HIT_MESSAGE) ):
+        for label, parse in ( ("parse", general), ("parse_gameplay", common.parse_gameplay) ):
+            start = time.perf_counter()
+            for _ in range(count):
+                parse( message )
+            elapsed = time.perf_counter() - start
+            _report( f"{name}: {label}", count, elapsed )
+
+
+class _NullServer(shipserv.Server):
+    """Server whose command handlers do nothing, execute() is all that is left."""
+
+    async def _ignore( self, player, command ):
+        pass
+
+    _shoot = _hit_or_miss = _nick = _start = _join = _list = _auto = _joinplayer = _layout = _ignore
+
+
+async def bench_dispatch( count=100000 ):
+    """Server.execute: registry lookup, schema validation and counters."""
+    server = _NullServer()
+    for name, message in ( ("shoot", SHOOT_MESSAGE), ("hit", HIT_MESSAGE), ("nick", NICK_MESSAGE),
+                           ("layout", LAYOUT_MESSAGE), ("unknown", b'(nope 1)') ):
+        command = hw3_parse( message, native=True )
+        start = time.perf_counter()
+        for _ in range(count):
+            try:
+                await server.execute( command, None )
+            except shipserv.ServerError:
+                pass
+        elapsed = time.perf_counter() - start
+        _report( f"{name}: execute", count, elapsed, unit="cmd" )
+
+
+async def bench_encoder( count=100000 ):
+    """Outgoing frames built by f-string + encode(), Template / encode() and bytes %."""
+    game_id, x, y, nick = 12, 3, 4, "nick"
+    ships = [ ( 5, 0, 0 ), ( 4, 5, 5 ), ( 3, 6, 5 ), ( 3, 8, 5 ), ( 2, 9, 9 ) ]
+
+    shoot = common.Template( "shoot", int, int, int )
+    end = common.Template( "end", int, str )
+    game_ok = common.Template( "game", "ok" )
+    ship = common.Template( "ship", int, int, int, "vertical" )
+    layout = common.Template( "layout", int, bytes, bytes, bytes, bytes, bytes )
+    layout_value = ( common.Symbol( "layout" ), game_id,
+                     *[ ( common.Symbol( "ship" ), *s, common.Symbol( "vertical" ) ) for s in ships ] )
+
+    def legacy_layout():
+        msg = " ".join( f"(ship {size} {x} {y} vertical)" for size, x, y in ships )
+        return f"(layout {game_id} {msg})\n".encode()
+
+    def bytes_layout():
+        parts = b" ".join( b"(ship %d %d %d vertical)" % s for s in ships )
+        return b"(layout %d %s)\n" % ( game_id, parts )
+
+    cases = [
+        ( "shoot: f-string", lambda: f"(shoot {game_id} {x} {y})\n".encode() ),
+        ( "shoot: Template", lambda: shoot( game_id, x, y ) ),
+        ( "shoot: bytes %", lambda: b"(shoot %d %d %d)\n" % ( game_id, x, y ) ),
+        ( "end: f-string", lambda: f'(end {game_id} "{nick}")\n'.encode() ),
+        ( "end: Template", lambda: end( game_id, nick ) ),
+        ( "end: bytes %", lambda: b'(end %d "%s")\n' % ( game_id, common._escape( nick ) ) ),
+        ( "game ok: f-string", lambda: f'{ str("(game ok)") }\n'.encode() ),
+        ( "game ok: Template", lambda: game_ok.frame ),
+        ( "layout: f-string", legacy_layout ),
+        ( "layout: Template", lambda: layout( game_id, *[ ship.part( *s ) for s in ships ] ) ),
+        ( "layout: bytes %", bytes_layout ),
+        ( "layout: encode()", lambda: common.encode( layout_value ) ),
+    ]
+    for name, encode in cases:
+        start = time.perf_counter()
+        for _ in range(count):
+            encode()
+        elapsed = time.perf_counter() - start
+        _report( name, count, elapsed )
+
+async def bench_oversized( size=4 * 1024 * 1024 ):
+    """Bytes held while a client sends one endless frame, with and without limits."""
+    chunk = b'(nick "' + b'x' * ( common._READ_CHUNK - 7 )
+    deep = b'(' * common._READ_CHUNK
+    for name, first, rest in ( ( "long", chunk, b'x' * common._READ_CHUNK ), ( "deep", deep, deep ) ):
+        for label, limits in ( ( "unlimited", { "max_depth": size } ),
+                               ( "server limits", { "max_frame": shipserv.Server.max_frame,
+                                                    "max_depth": shipserv.Server.max_depth } ) ):
+            parser = common.StreamParser( native=True, **limits )
+            held = 0
+            start = time.perf_counter()
+            parser.feed( first )
+            for _ in range( size // len(rest) ):
+                parser.feed( rest )
+                held = max( held, len( parser.pending() ) )
+            elapsed = time.perf_counter() - start
+            print( f"{name + ': ' + label:<24} held {held / 1024:10.1f} kB   "
+                   f"{size / elapsed / 1024 / 1024:8.1f} MB/s" )
+
+def _game_traffic( games=50 ):
+    """Frames a server receives over ‹games› games: shots, replies and listings."""
+    frames = []
+    for game_id in range( 1000, 1000 + games ):
+        frames.append( b'(list)' )
+        for shot in range(100):
+            frames.append( b'(shoot %d %d %d)' % ( game_id, shot % 10, shot // 10 ) )
+            frames.append( b'(hit %d)' % game_id if shot % 6 == 0 else b'(miss %d)' % game_id )
+    return b"".join( frames )
+
+
+async def bench_memo( games=250 ):
+    """StreamParser over game traffic, without and with frame memos."""
+    stream = _game_traffic( games )
+    chunk = common._READ_CHUNK
+    for size in ( 0, 64, 1024, 16384 ):
+        memo = common.FrameMemo( size ) if size else None
+        parser = common.StreamParser( native=True, memo=memo )
+        count = 0
+        start = time.perf_counter()
+        for i in range( 0, len(stream), chunk ):
+            count += len( parser.feed( stream[i:i + chunk] ) )
+        elapsed = time.perf_counter() - start
+        label = f"memo of {size}" if size else "no memo"
+        stats = f"   hits {memo.hits / ( memo.hits + memo.misses ):.1%}, {memo.evictions} evictions" if memo else ""
+        print( f"{label:<16} {count / elapsed:>12,.0f} msg/s{stats}" )
+
+
+def _legacy_game( players, logins, shots ):
+    """A game as Server.games held it before GameSession: writer -> dict of the slot."""
+    game = {}
+    for player, ( nick, salt, server_salt, hashed ) in zip( players, logins ):
+        board = [['?' for _ in range(10)] for _ in range(10)]
+        hits = 0
+        for x, y, hit in shots:
+            board[y][x] = "h" if hit else "m"
+            hits += hit
+        game[player] = { "nick": nick, "salt": salt, "server_salt": server_salt, "hash": hashed,
+                         "hits": hits, "layout": None, "turn": None, "cached_ships": board }
+    return game
+
+
+def _session_game( game_id, players, logins, shots ):
+    slots = []
+    for player, login in zip( players, logins ):
+        slot = shipserv.PlayerSlot( player, *login )
+        for x, y, hit in shots:
+            if hit:
+                slot.hits |= 1 << shipserv._cell( x, y )
+            else:
+                slot.misses |= 1 << shipserv._cell( x, y )
+        slots.append( slot )
+    game = shipserv.GameSession( game_id, slots[0] )
+    game.seat( slots[1] )
+    return game
+
+
+async def bench_sessions( games=100000, shots=40 ):
+    """Memory of ‹games› running games, ‹shots› squares shot at each board.
+
+    The logins (nick, salts, hash) belong to the players and are the same
+    strings either way, only what the game itself adds is counted.
+    """
+    rnd = random.Random( 21 )
+    players = [ ( _NullWriter(), _NullWriter() ) for _ in range(games) ]
+    logins = [ [ ( f"p{i}{side}", common.generate_salt(), common.generate_salt(), "h" * 64 ) for side in "ab" ]
+               for i in range(games) ]
+    boards = [ [ ( cell % 10, cell // 10, rnd.random() < 0.3 ) for cell in rnd.sample( range(100), shots ) ]
+               for _ in range(games) ]
+
+    for label, make in ( ( "dict + board", lambda i: _legacy_game( players[i], logins[i], boards[i] ) ),
+                         ( "GameSession", lambda i: _session_game( i, players[i], logins[i], boards[i] ) ) ):
+        tracemalloc.start()
+        start = time.perf_counter()
+        running = { i: make( i ) for i in range(games) }
+        elapsed = time.perf_counter() - start
+        kept, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del running
+        print( f"{label:<14} {kept / 1024 / 1024:8.1f} MB   {kept / games:7.0f} B/game   "
+               f"built in {elapsed:.2f} s" )
+
+def _legacy_verify_board( layout, slot ) -> bool:
+    """Server._verify_board before the ship masks: a 10x10 board and a loop over it."""
+    player_board = [['w' for _ in range(10)] for _ in range(10)]
+    for size,x,y,direction in layout:
+        for i in range(size):
+            if direction == "horizontal":
+                player_board[y][x+i] = 's'
+            else:
+                player_board[y+i][x] = 's'
+
+    for x in range(10):
+        for y in range(10):
+            cell = 1 << shipserv._cell( x, y )
+            if slot.hits & cell:
+                if player_board[y][x] != 's':
+                    return False
+            elif slot.misses & cell:
+                if player_board[y][x] != 'w':
+                    return False
+    return True
+
+
+# ( size, x, y, direction ), sorted the way _layout() keeps them
+_LAYOUTS = [
+    [ ( 5, 0, 0, "horizontal" ), ( 4, 5, 5, "vertical" ), ( 3, 8, 5, "vertical" ),
+      ( 3, 6, 5, "vertical" ), ( 2, 0, 9, "horizontal" ) ],
+    [ ( 5, 0, 0, "vertical" ), ( 4, 1, 0, "vertical" ), ( 3, 3, 0, "vertical" ),
+      ( 3, 2, 0, "vertical" ), ( 2, 4, 0, "vertical" ) ],
+]
+
+
+def _finished_game( server, game_id, rnd ):
+    """A game where the host sank the whole fleet of the guest.
+
+    Returns the game and the layout each player is about to send.
+    """
+    slots = []
+    layouts = []
+    for side in ( "host", "guest" ):
+        salt, server_salt = common.generate_salt(), common.generate_salt()
+        layout = rnd.choice( _LAYOUTS )
+        hashed = common.hash_game( server_salt, salt, [ ( x, y, d == "vertical" ) for _, x, y, d in layout ] )
+        slots.append( shipserv.PlayerSlot( _NullWriter(), f"{side}{game_id}", salt, server_salt, hashed ) )
+        layouts.append( layout )
+
+    guest = slots[1]
+    ships = shipserv.layout_mask( layouts[1] )
+    guest.hits = ships
+    for cell in rnd.sample( [ cell for cell in range(100) if not ships >> cell & 1 ], 30 ):
+        guest.misses |= 1 << cell
+
+    game = server.games[game_id] = shipserv.GameSession( game_id, slots[0] )
+    game.seat( guest )
+    for slot in slots:
+        server._add_seat( slot.player, game_id )
+    return game, layouts
+
+
+async def bench_verify( games=5000 ):
+    """End of ‹games› games at once: board checks alone, then whole (layout ...) commands."""
+    rnd = random.Random( 22 )
+    server = shipserv.Server()
+    finished = [ _finished_game( server, game_id, rnd ) for game_id in range( 1, games + 1 ) ]
+    seats = [ ( game, slot, layout ) for game, layouts in finished for slot, layout in zip( game.slots, layouts ) ]
+
+    def masks( game, slot, layout ):
+        slot.layout = layout
+        return server._verify_board( slot.player, game.game_id )
+
+    for label, verify in ( ( "board loop", lambda game, slot, layout: _legacy_verify_board( layout, slot ) ),
+                           ( "ship masks", masks ) ):
+        start = time.perf_counter()
+        assert all( verify( *seat ) for seat in seats )
+        _report( f"_verify_board: {label}", len(seats), time.perf_counter() - start, unit="board" )
+
+    # both layouts arrive, the second one verifies hashes and boards and removes the game
+    for game, slot, _ in seats:
+        slot.layout = None
+    commands = [ ( slot.player, ( "layout", game.game_id, *[ ( "ship", *ship ) for ship in layout ] ) )
+                 for game, slot, layout in seats ]
+    start = time.perf_counter()
+    for player, command in commands:
+        await server._layout( player, command )
+    _report( "(layout ...) incl. hashes", games, time.perf_counter() - start, unit="game" )
+    server.close()
+    assert not server.games
+
+async def _probe_lag( lags, interval=0.001 ):
+    """Record how late the event loop wakes up a task sleeping for ‹interval›."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep( interval )
+        lags.append( loop.time() - start - interval )
+
+
+async def bench_hash_pool( games=2000, per_tick=100 ):
+    """A burst of ‹games› games ending, ‹per_tick› in each tick of the event loop.
+
+    Reports the time to verify them all and how late the event loop
+    got to other tasks meanwhile.
+    """
+    for pool, workers in ( ( "inline", 1 ), ( "thread", 2 ), ( "thread", 4 ), ( "process", 2 ), ( "process", 4 ) ):
+        rnd = random.Random( 23 )
+        server = shipserv.Server()
+        server.hash_pool, server.hash_workers = pool, workers
+        finished = [ _finished_game( server, game_id, rnd ) for game_id in range( 1, games + 1 ) ]
+        for game, layouts in finished:
+            game.host.layout = layouts[0]
+        guests = [ ( game.guest.player, ( "layout", game.game_id, *[ ( "ship", *ship ) for ship in layouts[1] ] ) )
+                   for game, layouts in finished ]
+
+        # start the pool up front, it should not count
+        await server._verify_hashes( [ finished[0][0].host ] )
+        lags = []
+        probe = asyncio.ensure_future( _probe_lag( lags ) )
+        await asyncio.sleep( 0.01 )
+        batches = server.hash_batches
+        start = time.perf_counter()
+        ending = []
+        for i in range( 0, games, per_tick ):
+            ending += [ asyncio.ensure_future( server._layout( player, command ) )
+                        for player, command in guests[i:i + per_tick] ]
+            await asyncio.sleep( 0 )
+        await asyncio.gather( *ending )
+        elapsed = time.perf_counter() - start
+        probe.cancel()
+        server.close()
+        assert not server.games
+
+        print( f"{pool + ' x' + str( workers ):<12} {games / elapsed:>10,.0f} games/s   "
+               f"lag max {max( lags ) * 1e3:7.1f} ms   p50 {statistics.median( lags ) * 1e3:6.2f} ms   "
+               f"{server.hash_batches - batches} batches" )
+
+BENCHMARKS = {
+    "framing": bench_framing,
+    "nicks": bench_nicks,
+    "matchmaking": bench_matchmaking,
+    "pairing": bench_pairing,
+    "outbox": bench_outbox,
+    "listing": bench_listing,
+    "parser": bench_parser,
+    "parse-memory": bench_parse_memory,
+    "queued": bench_queued,
+    "native": bench_native,
+    "gameplay": bench_gameplay,
+    "dispatch": bench_dispatch,
+    "encoder": bench_encoder,
+    "oversized": bench_oversized,
+    "memo": bench_memo,
+    "sessions": bench_sessions,
+    "verify": bench_verify,
+    "hash-pool": bench_hash_pool,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Battleship server benchmarks." )
+    parser.add_argument( "names", nargs="*", metavar="name",
+                         help=f"benchmark to run, one of: {', '.join(BENCHMARKS)} (default: all)" )
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error( f"unknown benchmark {name}" )
+
+    async def main_simple():
+        for name in args.names or BENCHMARKS:
+            print( f"== {name}" )
+            await BENCHMARKS[name]()
+
+    asyncio.run( main_simple() )
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # Additional types (classes) that you may want to define.
 
 class Interface:
+    __slots__ = ()
 
     def is_atom(self):
         return False
@@ -25,6 +26,8 @@ class Interface:
 
 
 class Atom(Interface):
+    __slots__ = ( "value", )
+
     def __init__(self, value):
         self.value = value
 
@@ -41,11 +44,15 @@ class Atom(Interface):
 
 
 class Literal(Atom):
+    __slots__ = ()
+
     def is_literal(self):
         return True
 
 
 class Identifier(Atom):
+    __slots__ = ()
+
     def is_identifier(self):
         return True
 
@@ -54,6 +61,8 @@ class Identifier(Atom):
 
 
 class Number(Literal):
+    __slots__ = ()
+
     def is_number(self):
         return True
 
@@ -129,6 +138,8 @@ class Number(Literal):
 
 
 class Bool(Literal):
+    __slots__ = ()
+
     def is_bool(self):
         return True
 
@@ -140,6 +151,8 @@ class Bool(Literal):
 
 
 class String(Literal):
+    __slots__ = ()
+
     def is_string(self):
         return True
 
@@ -1,10 +1,16 @@
 # Code shared between the client and server.
 import hashlib
 import os
+import re
+from collections import OrderedDict
 from base64 import b64encode
+from typing import List, Optional, Union
 
 _SOCKET_NAME = "chatsock"
 _SHIPS_HEALTH = 17
+_READ_CHUNK = 64 * 1024
+# nesting parse() accepts unless told otherwise, the protocol needs 2
+_MAX_DEPTH = 64
 
 def hash_game(server_salt, client_salt, ships):
     hashed = hashlib.pbkdf2_hmac('sha1', bytes( ships[0] ), client_salt.encode() , 1)
@@ -18,7 +24,108 @@ def hash_game(server_salt, client_salt, ships):
 def generate_salt() -> str:
     return b64encode( os.urandom(16) ).decode('utf-8')
 
+
+_FRAME_SPECIAL = re.compile( rb'[()\[\]"\\\n]' )
+
+class FrameSplitter:
+    """Split a byte stream into complete protocol frames.
+
+    A frame is either a balanced (...) / [...] expression or a bare atom
+    terminated by a newline. String literals are tracked, so brackets and
+    newlines inside of them do not end a frame. Every byte is scanned once,
+    no matter in how many chunks it arrives.
+
+    A frame longer than ‹max_frame› bytes or nested deeper than ‹max_depth›
+    is rejected as soon as it gets there: its bytes are dropped as they
+    arrive and None takes its place among the frames once it ends.
+    """
+
+    def __init__( self, max_frame=None, max_depth=None ):
+        self._buffer = bytearray()
+        self._start = 0     # start of the frame being collected
+        self._scanned = 0   # everything before this offset was already scanned
+        self._depth = 0
+        self._in_string = False
+        self._max_frame = max_frame
+        self._max_depth = max_depth
+        self._rejected = False  # the frame being collected is dropped
+
+    def pending( self ) -> bytes:
+        """Return bytes received but not yet part of a complete frame."""
+        return bytes( self._buffer[self._start:] )
+
+    def feed( self, data ) -> List[Optional[bytes]]:
+        """Append received bytes and return the frames they completed."""
+        buffer = self._buffer
+        buffer += data
+        frames = []
+
+        pos = self._scanned
+        while True:
+            match = _FRAME_SPECIAL.search( buffer, pos )
+            if match is None:
+                pos = max( pos, len(buffer) )
+                break
+
+            i = match.start()
+            char = buffer[i]
+            pos = i + 1
+
+            if self._in_string:
+                if char == 0x5c:    # '\' skips the escaped char, even if it did not arrive yet
+                    pos = i + 2
+                elif char == 0x22:  # '"'
+                    self._in_string = False
+                continue
+
+            if char == 0x22:
+                self._in_string = True
+
+            elif char == 0x28 or char == 0x5b:  # '(' '['
+                self._depth += 1
+                if self._max_depth is not None and self._depth > self._max_depth:
+                    self._rejected = True
+
+            elif char == 0x29 or char == 0x5d:  # ')' ']'
+                self._depth -= 1
+                # an unbalanced closing bracket ends the frame as well,
+                # the parser then rejects it
+                if self._depth <= 0:
+                    self._depth = 0
+                    frames.append( self._frame( buffer, pos ) )
+                    self._start = pos
+
+            elif char == 0x0a and self._depth == 0:  # '\n' ends a bare atom
+                if self._rejected or buffer[self._start:i].strip():
+                    frames.append( self._frame( buffer, i ) )
+                self._start = pos
+
+        if self._rejected or ( self._max_frame is not None and len(buffer) - self._start > self._max_frame ):
+            # nothing more of this frame is kept; an escape at the very end
+            # still skips the byte which did not arrive yet
+            self._rejected = True
+            pos = self._start + max( pos - len(buffer), 0 )
+            del buffer[self._start:]
+
+        if self._start:
+            del buffer[:self._start]
+            pos -= self._start
+            self._start = 0
+        self._scanned = pos
+
+        return frames
+
+    def _frame( self, buffer, end ) -> Optional[bytes]:
+        if self._rejected:
+            self._rejected = False
+            return None
+        if self._max_frame is not None and end - self._start > self._max_frame:
+            return None
+        return bytes( buffer[self._start:end] )
+
+
 class Interface:
+    __slots__ = ()
 
     def is_atom(self):
         return False
@@ -43,6 +150,8 @@ class Interface:
 
 
 class Atom(Interface):
+    __slots__ = ( "value", )
+
     def __init__(self, value):
         self.value = value
 
@@ -59,11 +168,15 @@ class Atom(Interface):
 
 
 class Literal(Atom):
+    __slots__ = ()
+
     def is_literal(self):
         return True
 
 
 class Identifier(Atom):
+    __slots__ = ()
+
     def is_identifier(self):
         return True
 
@@ -72,6 +185,8 @@ class Identifier(Atom):
 
 
 class Number(Literal):
+    __slots__ = ()
+
     def is_number(self):
         return True
 
@@ -147,6 +262,8 @@ class Number(Literal):
 
 
 class Bool(Literal):
+    __slots__ = ()
+
     def is_bool(self):
         return True
 
@@ -158,6 +275,8 @@ class Bool(Literal):
 
 
 class String(Literal):
+    __slots__ = ()
+
     def is_string(self):
         return True
 
@@ -176,6 +295,8 @@ class NotParsable(Exception):
 
 
 class Compound(Interface):
+    __slots__ = ( "compounds", )
+
     def __init__(self, compounds):
         self.compounds = compounds
 
@@ -506,12 +627,611 @@ class Parser:
         return Compound(self.expressions)
 
 
-def parse(expr):
+# The tokenizer below replaces Parser in parse(); Parser stays as the
+# reference the tokenizer is tested against, quirks included:
+#  • bools, numbers and identifiers must be followed by whitespace, a closing
+#    bracket or the end, strings need not be,
+#  • a compound must be followed by whitespace or a closing bracket too,
+#    unless it is the first element of its parent: ((a)b) parses, (x (a)b) not,
+#  • escapes \\ and \" are kept in the value of a String node as they were
+#    sent; native parsing resolves them.
+
+# a token together with the whitespace in front of it
+_TOKEN = re.compile( r'\s*(?:[()\[\]]|"[^"\\]*(?:\\["\\][^"\\]*)*"|[^\s()\[\]"]+|")' )
+_CLOSURE = { "(": ")", "[": "]" }
+
+# Identifiers and small numbers recur in every message, the tokenizer shares
+# one node per such token instead of allocating it anew; nodes are never
+# modified once parsed. New identifiers are remembered up to a limit, past it
+# they get fresh nodes.
+_INTERN_LIMIT = 4096
+
+
+def _intern(atoms, token, atom):
+    if len(atoms) < _INTERN_LIMIT:
+        atoms[token] = atom
+    return atom
+
+_STRING_TOKEN = re.compile( r'"[^"\\]*(?:\\["\\][^"\\]*)*"' )
+_ATOM_TOKEN = re.compile( r'[^\s()\[\]"]+' )
+_ASCII_NUMBER = re.compile( r'[+-]?[0-9]+(?:\.[0-9]+)?' )
+_ASCII_IDENTIFIER = re.compile( r'[A-Za-z!$%&*/:<=>?_~][A-Za-z0-9!$%&*/:<=>?_~+\-.@#]*' )
+
+
+def _unicode_number(token, nodes):
+    """Parser.process_number for tokens beyond ASCII, None if not a number."""
+    body = token[1:] if token[0] in SIGN else token
+    if not body or not body[0].isnumeric():
+        return None
+    if not all(c == "." or c.isnumeric() for c in body):
+        return None
+
+    if "." in body:
+        try:
+            value = float(token)
+        except ValueError:
+            return None
+        split = token.split(".")
+        if len(split) != 2 or not split[0] or not split[1]:
+            return None
+        return nodes.number(value)
+
+    try:
+        return nodes.number(int(token))
+    except ValueError:
+        # numeric to str.isnumeric(), yet not to int(), e.g. "²"
+        raise NotParsable
+
+
+def _unicode_identifier(token, nodes):
+    if not (token[0].isalpha() or token[0] in ID_SYMBOL):
+        return None
+    for char in token:
+        if not (char.isalpha() or char in ID_SYMBOL or char in DIGIT or char in ID_SPECIAL):
+            return None
+    return nodes.identifier(token)
+
+
+def _atom(token, nodes):
+    """Convert a bare token to a bool, number or identifier node."""
+    if token == "#t" or token == "#f":
+        return nodes.boolean(token == "#t")
+
+    if token.isascii():
+        if _ASCII_NUMBER.fullmatch(token):
+            return nodes.number(float(token) if "." in token else int(token))
+        if token in SIGN or _ASCII_IDENTIFIER.fullmatch(token):
+            return nodes.identifier(token)
+        raise NotParsable
+
+    atom = _unicode_number(token, nodes)
+    if atom is None:
+        atom = _unicode_identifier(token, nodes)
+    if atom is None:
+        raise NotParsable
+    return atom
+
+
+def _new_atom(token, nodes):
+    """The node of a bare token not in nodes.atoms (yet)."""
+    if token.isdigit() and token.isascii():
+        return nodes.number(int(token))
+    if _ASCII_IDENTIFIER.fullmatch(token):
+        return _intern(nodes.atoms, token, nodes.identifier(token))
+    return _atom(token, nodes)
+
+
+def _new_byte_atom(token, nodes):
+    """_new_atom for an ASCII token of received data."""
+    if token.isdigit():
+        return nodes.number(int(token))
+    text = token.decode()
+    if _ASCII_IDENTIFIER.fullmatch(text):
+        return _intern(nodes.bytes_atoms, token, nodes.identifier(text))
+    return _atom(text, nodes)
+
+
+class Symbol(str):
+    """An identifier in a natively parsed expression.
+
+    It compares and hashes as the str it is, its type tells it apart from
+    the contents of a string literal.
+    """
+    __slots__ = ()
+
+
+class _Nodes:
+    """What the tokenizer builds out of the tokens it finds."""
+
+    def __init__(self, atoms, boolean, number, identifier, string, compound):
+        self.atoms = atoms
+        self.bytes_atoms = { token.encode(): value for token, value in atoms.items() }
+        self.boolean = boolean
+        self.number = number        # from an int or a float
+        self.identifier = identifier
+        self.string = string        # from the literal, quotes included
+        self.compound = compound    # from the list of its elements
+
+
+# Compound and Atom nodes
+_NODES = _Nodes( { **{ str(n): Number(n) for n in range(256) }, "#t": Bool(True), "#f": Bool(False) },
+                 Bool, Number, Identifier, String, Compound )
+
+
+def _unescape(literal):
+    """The text of a string literal, without the quotes and escapes."""
+    text = literal[1:-1]
+    if "\\" in text:
+        # a quote inside a literal follows an odd number of backslashes, so
+        # once the pairs are undone, the one left is the quote's own
+        text = text.replace( "\\\\", "\\" ).replace( '\\"', '"' )
+    return text
+
+
+# tuples of int, float, bool, str (the text of the string literals, which
+# encode() escapes again) and Symbol (the identifiers)
+_NATIVE = _Nodes( { **{ str(n): n for n in range(256) }, "#t": True, "#f": False },
+                  bool, lambda value: value, Symbol, _unescape, tuple )
+
+
+# Most messages are a single compound of atoms and plain strings, all
+# separated by whitespace: (shoot 12 3 4), (nick "alice" "salt"). Such a
+# compound is split on whitespace instead of tokenized; whatever else may be
+# inside it, a bracket or an escape, takes the general path.
+_NOT_FLAT = re.compile( r'[()\[\]\\]' )
+
+
+def _parse_flat(expr, nodes):
+    """The compound ‹expr› if it is flat, None if it is not (or not parsable)."""
+    if _NOT_FLAT.search(expr, 1, len(expr) - 1):
+        return None
+    atoms, string = nodes.atoms, nodes.string
+    expressions = []
+    for token in expr[1:-1].split():
+        if '"' in token:
+            if token[0] != '"' or token[-1] != '"' or token.count('"') != 2:
+                return None
+            expressions.append(string(token))
+            continue
+        atom = atoms.get(token)
+        if atom is None:
+            atom = _new_atom(token, nodes)
+        expressions.append(atom)
+    if not expressions:
+        return None
+    return nodes.compound(expressions)
+
+
+def _parse_tokens(expr, nodes, max_depth):
+    first = expr[0]
+    if first != "(" and first != "[":
+        # singleton, a single atom spanning the whole expression
+        if first == '"':
+            if not _STRING_TOKEN.fullmatch(expr):
+                raise NotParsable
+            return nodes.string(expr)
+        if not _ATOM_TOKEN.fullmatch(expr):
+            raise NotParsable
+        return _atom(expr, nodes)
+
+    if expr[-1] == _CLOSURE[first]:
+        compound = _parse_flat(expr, nodes)
+        if compound is not None:
+            return compound
+
+    atoms, string, new_compound = nodes.atoms, nodes.string, nodes.compound
+    tokens = _TOKEN.findall(expr)
+    stack = []
+    expressions = []
+    closure = _CLOSURE[first]
+    # whether the previous token allows the next one to follow without a space
+    open_end = True
+
+    for i in range(1, len(tokens)):
+        token = tokens[i]
+        char = token[0]
+        if char.isspace():
+            token = token.lstrip()
+            char = token[0]
+            open_end = True
+
+        if char == ")" or char == "]":
+            # empty expression of any kind not permitted
+            if char != closure or not expressions:
+                raise NotParsable
+            compound = new_compound(expressions)
+            if not stack:
+                if i + 1 != len(tokens):
+                    raise NotParsable
+                return compound
+            expressions, closure = stack.pop()
+            expressions.append(compound)
+            open_end = len(expressions) == 1
+            continue
+
+        if not open_end:
+            raise NotParsable
+
+        if char == '"':
+            if len(token) == 1:
+                raise NotParsable   # an unterminated string or a bad escape
+            expressions.append(string(token))
+
+        elif char == "(" or char == "[":
+            stack.append((expressions, closure))
+            if len(stack) >= max_depth:
+                raise NotParsable
+            expressions = []
+            closure = _CLOSURE[char]
+
+        else:
+            atom = atoms.get(token)
+            if atom is None:
+                atom = _new_atom(token, nodes)
+            expressions.append(atom)
+            open_end = False
+
+    raise NotParsable   # the compound is not closed
+
+
+# ASCII characters which str.isspace() takes for whitespace
+_BYTES_SPACE = b" \t\n\x0b\x0c\r\x1c\x1d\x1e\x1f"
+_BYTES_TOKEN = re.compile( rb'[ \t\n\x0b\x0c\r\x1c-\x1f]*'
+                           rb'(?:[()\[\]]|"[^"\\]*(?:\\["\\][^"\\]*)*"|[^ \t\n\x0b\x0c\r\x1c-\x1f()\[\]"]+|")' )
+_BYTES_CLOSURE = { ord("("): ord(")"), ord("["): ord("]") }
+
+
+# bytes.split() does not split on \x1c-\x1f, unlike str.split()
+_NOT_FLAT_BYTES = re.compile( rb'[()\[\]\\\x1c-\x1f]' )
+
+
+def _parse_flat_bytes(data, nodes):
+    """_parse_flat for ASCII received data."""
+    if _NOT_FLAT_BYTES.search(data, 1, len(data) - 1):
+        return None
+    atoms, string = nodes.bytes_atoms, nodes.string
+    expressions = []
+    for token in data[1:-1].split():
+        if 0x22 in token:   # '"'
+            if token[0] != 0x22 or token[-1] != 0x22 or token.count(b'"') != 2:
+                return None
+            expressions.append(string(token.decode()))
+            continue
+        atom = atoms.get(token)
+        if atom is None:
+            atom = _new_byte_atom(token, nodes)
+        expressions.append(atom)
+    if not expressions:
+        return None
+    return nodes.compound(expressions)
+
+
+def _parse_byte_tokens(data, nodes, max_depth):
+    """_parse_tokens for an ASCII compound, only tokens are decoded."""
+    if data[-1] == _BYTES_CLOSURE[data[0]]:
+        compound = _parse_flat_bytes(data, nodes)
+        if compound is not None:
+            return compound
+
+    atoms, string, new_compound = nodes.bytes_atoms, nodes.string, nodes.compound
+    tokens = _BYTES_TOKEN.findall(data)
+    stack = []
+    expressions = []
+    closure = _BYTES_CLOSURE[data[0]]
+    open_end = True
+
+    for i in range(1, len(tokens)):
+        token = tokens[i]
+        char = token[0]
+        if char in _BYTES_SPACE:
+            token = token.lstrip(_BYTES_SPACE)
+            char = token[0]
+            open_end = True
+
+        if char == 0x29 or char == 0x5d:    # ')' ']'
+            if char != closure or not expressions:
+                raise NotParsable
+            compound = new_compound(expressions)
+            if not stack:
+                if i + 1 != len(tokens):
+                    raise NotParsable
+                return compound
+            expressions, closure = stack.pop()
+            expressions.append(compound)
+            open_end = len(expressions) == 1
+            continue
+
+        if not open_end:
+            raise NotParsable
+
+        if char == 0x22:    # '"'
+            if len(token) == 1:
+                raise NotParsable
+            expressions.append(string(token.decode()))
+
+        elif char == 0x28 or char == 0x5b:  # '(' '['
+            stack.append((expressions, closure))
+            if len(stack) >= max_depth:
+                raise NotParsable
+            expressions = []
+            closure = _BYTES_CLOSURE[char]
+
+        else:
+            atom = atoms.get(token)
+            if atom is None:
+                atom = _new_byte_atom(token, nodes)
+            expressions.append(atom)
+            open_end = False
+
+    raise NotParsable
+
+
+def _parse_bytes(data, native, max_depth):
+    if type(data) is not bytes:
+        data = bytes(data)  # a memoryview or bytearray; their tokens would not be hashable
+    if not data.isascii():
+        # beyond ASCII, whitespace and atoms need the str rules
+        return parse(data.decode(errors="replace"), native, max_depth)
+
+    data = data.strip(_BYTES_SPACE)
+    if not data:
+        return None
+    if data[0] != 0x28 and data[0] != 0x5b:
+        # a singleton, decoding it whole costs nothing extra
+        return parse(data.decode(), native, max_depth)
+    try:
+        return _parse_byte_tokens(data, _NATIVE if native else _NODES, max_depth)
+    except NotParsable:
+        return None
+
+
+def parse(expr, native=False, max_depth=_MAX_DEPTH):
+    """Parse an expression given as str, or as bytes-like received data.
+
+    Received data is parsed without decoding it first; only the tokens
+    which end up in the atoms are decoded, as UTF-8.
+
+    With ‹native›, the expression is returned as plain Python values
+    instead of nodes: compounds as tuples, numbers as int or float, bools
+    as bool, string literals as str holding their text, escapes resolved
+    (so that encode() gives the literal back), and identifiers as Symbol.
+
+    Expressions nested deeper than ‹max_depth› are not parsable.
+    """
+    if not expr:
+        return None
+    if not isinstance(expr, str):
+        return _parse_bytes(expr, native, max_depth)
+    expr = expr.strip()
     if not expr:
         return None
-    parser = Parser(expr.strip(), 0)
     try:
-        x = parser.parse()
+        return _parse_tokens(expr, _NATIVE if native else _NODES, max_depth)
     except NotParsable:
         return None
-    return x
\ No newline at end of file
+
+# (shoot <id> <x> <y>), (hit <id>) and (miss <id>) are most of the traffic
+# of a game; in their usual spelling they are matched whole
+_GAMEPLAY = re.compile( rb'\s*\((shoot|hit|miss) ([0-9]+)(?: ([0-9]+) ([0-9]+))?\)' )
+_GAMEPLAY_COMMANDS = { name.encode(): Symbol(name) for name in ( "shoot", "hit", "miss" ) }
+
+
+def parse_gameplay(frame):
+    """Return the native value of a received shoot, hit or miss message.
+
+    None for anything else, including these commands spelled differently
+    (other whitespace, brackets...), for which parse() is needed.
+    """
+    match = _GAMEPLAY.fullmatch(frame)
+    if match is None:
+        return None
+    command, game_id, x, y = match.groups()
+    if x is None:
+        if command == b"shoot":
+            return None
+        return (_GAMEPLAY_COMMANDS[command], int(game_id))
+    if command != b"shoot":
+        return None
+    return (_GAMEPLAY_COMMANDS[command], int(game_id), int(x), int(y))
+
+
+_MISSING = object()
+
+
+class FrameMemo:
+    """Bounded LRU cache of parsed frames, keyed by the received bytes.
+
+    Meant for native values only: tuples, numbers and strings cannot be
+    changed, so the same result can be handed out again and again. It
+    counts its hits, misses and evictions.
+    """
+
+    def __init__( self, size: int ):
+        self.size = size
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__( self ):
+        return len(self._results)
+
+    def parse( self, frame: bytes, parse ):
+        """Return the result of ‹parse›( ‹frame› ), remembered or computed now."""
+        results = self._results
+        result = results.get( frame, _MISSING )
+        if result is not _MISSING:
+            self.hits += 1
+            results.move_to_end( frame )
+            return result
+
+        self.misses += 1
+        result = results[frame] = parse( frame )
+        if len(results) > self.size:
+            results.popitem( last=False )
+            self.evictions += 1
+        return result
+
+
+class StreamParser:
+    """Resumable parser for a byte stream of expressions.
+
+    Bytes can be fed in arbitrary chunks; the frame splitter keeps the
+    nesting and string state between them, so every complete expression is
+    parsed exactly once, as soon as its closing bracket arrives. Frames
+    over the limits are rejected early, see FrameSplitter.
+    """
+
+    def __init__( self, native=False, max_frame=None, max_depth=_MAX_DEPTH, memo: Optional[FrameMemo] = None ):
+        if memo is not None and not native:
+            raise ValueError( "a frame memo needs native=True, nodes can be modified" )
+        self._frames = FrameSplitter( max_frame, max_depth )
+        self._native = native
+        self._max_depth = max_depth
+        self._memo = memo
+
+    def pending( self ) -> bytes:
+        """Return bytes of the expression which is not complete yet."""
+        return self._frames.pending()
+
+    def feed( self, data ) -> List[Optional[Union[Interface, tuple]]]:
+        """Consume received bytes, return expressions completed by them.
+
+        Frames which are not valid expressions are returned as None, so the
+        caller can reply to them in order.
+        """
+        frames = self._frames.feed( data )
+        max_depth = self._max_depth
+        if not self._native:
+            return [ parse( frame, False, max_depth ) for frame in frames ]
+        if self._memo is not None:
+            return [ None if frame is None else self._memo.parse( frame, self._parse_native )
+                     for frame in frames ]
+        # a rejected frame is None, parse() returns None for it
+        return [ frame is not None and parse_gameplay( frame ) or parse( frame, True, max_depth )
+                 for frame in frames ]
+
+    def _parse_native( self, frame ):
+        return parse_gameplay( frame ) or parse( frame, True, self._max_depth )
+
+
+
+def _escape(text) -> bytes:
+    """Body of a string literal holding ‹text›."""
+    if '"' in text or "\\" in text:
+        text = text.replace("\\", "\\\\").replace('"', '\\"')
+    return text.encode()
+
+
+class Encoder:
+    """Serializes expressions into a reusable buffer, one bytes per frame.
+
+    Compounds are tuples, lists or Compound nodes. Symbol and Identifier
+    are written as identifiers, str as a string literal with " and \
+    escaped, int and float as numbers and bool as #t or #f. Other atom
+    nodes are written the way they were received.
+    """
+
+    def __init__( self ):
+        self._buffer = bytearray()
+
+    def encode( self, expr ) -> bytes:
+        """Return the frame of ‹expr›, newline included."""
+        buffer = self._buffer
+        del buffer[:]
+        self._write( buffer, expr )
+        buffer += b"\n"
+        return bytes( buffer )
+
+    def _write( self, buffer, expr ):
+        kind = type(expr)
+        if kind is tuple or kind is list or kind is Compound:
+            buffer += b"("
+            first = True
+            for element in expr:
+                if not first:
+                    buffer += b" "
+                first = False
+                self._write( buffer, element )
+            buffer += b")"
+        elif kind is Symbol:
+            buffer += expr.encode()
+        elif kind is str:
+            buffer += b'"' + _escape( expr ) + b'"'
+        elif kind is bool:
+            buffer += b"#t" if expr else b"#f"
+        elif kind is int:
+            buffer += b"%d" % expr
+        elif kind is float:
+            buffer += repr( expr ).encode()
+        elif kind is Bool:
+            buffer += str( expr ).encode()
+        elif isinstance( expr, Atom ):
+            # a String keeps its quotes and escapes in the value
+            buffer += str( expr.value ).encode()
+        else:
+            raise TypeError( f"cannot encode {kind.__name__}" )
+
+
+encode = Encoder().encode
+
+
+class Template:
+    """Encoder of one message shape, compiled into a bytes % template.
+
+    The shape lists the elements of the message: int, str and Symbol stand
+    for values given when encoding, bytes for an expression encoded
+    already (e.g. by part() of another template), any other str is written
+    as it is, as an identifier. Template( "game", int, "joined" )( 12 )
+    gives b'(game 12 joined)\n'. A shape without values is a constant
+    message, it is encoded once.
+
+    A call costs more than formatting the bytes by hand (0.9 against
+    0.35 us for (shoot ...)), the messages of every round are formatted
+    by hand.
+    """
+    __slots__ = ( "_part", "_frame", "_converters", "frame" )
+
+    def __init__( self, *shape ):
+        parts = []
+        # ( index of the value, function making it bytes ) for str and Symbol
+        self._converters = []
+        values = 0
+        for element in shape:
+            if element is int:
+                parts.append( b"%d" )
+            elif element is str:
+                parts.append( b'"%s"' )
+                self._converters.append( ( values, _escape ) )
+            elif element is Symbol:
+                parts.append( b"%s" )
+                self._converters.append( ( values, str.encode ) )
+            elif element is bytes:
+                parts.append( b"%s" )
+            else:
+                parts.append( element.replace( "%", "%%" ).encode() )
+                continue
+            values += 1
+
+        self._part = b"(" + b" ".join( parts ) + b")"
+        self._frame = self._part + b"\n"
+        # the frame of a constant message
+        self.frame = self._frame % () if not values else None
+
+    def part( self, *values ) -> bytes:
+        """Return the expression without the newline, for a frame of several."""
+        if self._converters:
+            values = self._convert( values )
+        return self._part % values
+
+    def __call__( self, *values ) -> bytes:
+        """Return the frame."""
+        if self._converters:
+            values = self._convert( values )
+        return self._frame % values
+
+    def _convert( self, values ):
+        values = list( values )
+        for index, convert in self._converters:
+            values[index] = convert( values[index] )
+        return tuple( values )
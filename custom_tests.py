@@ -1,8 +1,15 @@
 from shipclient import Battleship
 import shipserv
+from common import _SOCKET_NAME
 
 import unittest
 import asyncio
+import contextlib
+import gc
+import os
+import signal
+import sys
+import tracemalloc
 
 def get_basic_layout_1():
     return [( 0, 0, 2, False ),
@@ -71,6 +78,27 @@ async def check_list( b: Battleship, *players ):
     for p in players:
         assert p in ships
 
+@contextlib.asynccontextmanager
+async def cluster_server( workers ):
+    """Run shipserv with game worker processes for the duration of a test."""
+    if os.path.exists( _SOCKET_NAME ):
+        os.remove( _SOCKET_NAME )
+
+    server = await asyncio.create_subprocess_exec( sys.executable, "shipserv.py", "--workers", str(workers) )
+    try:
+        # the socket exists a moment before it is listened on
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection( _SOCKET_NAME )
+                writer.close()
+                break
+            except ( FileNotFoundError, ConnectionRefusedError ):
+                await asyncio.sleep( 0.05 )
+        yield server
+    finally:
+        server.terminate()
+        await server.wait()
+
 class TestConnect_TwoPlayers:
 
     @staticmethod
@@ -87,6 +115,8 @@ class TestConnect_TwoPlayers:
 
         set_layout( b, get_basic_layout_1() )
         await b.start()
+        # a host who disconnects withdraws the game, stay until the test is over
+        return b
 
     @staticmethod
     async def player_2():
@@ -120,6 +150,8 @@ class TestConnect_FourPlayers:
 
         set_layout( b, get_basic_layout_1() )
         await b.start()
+        # a host who disconnects withdraws the game, stay until the test is over
+        return b
 
     @staticmethod
     async def player_2():
@@ -144,6 +176,8 @@ class TestConnect_FourPlayers:
 
         await asyncio.sleep(0.1)
         await b.start()
+        # a host who disconnects withdraws the game, stay until the test is over
+        return b
 
     @staticmethod
     async def player_4():
@@ -190,6 +224,8 @@ class TestList_TwoPlayers:
 
         await asyncio.sleep(0.1)
         await b.start()
+        # a host who disconnects withdraws the game, stay until the test is over
+        return b
 
 
 class TestWin_TwoPlayers:
@@ -591,6 +627,287 @@ class TestWin_StartAuto_Restart_TwoPlayers:
         await shoot_layout( b, get_basic_layout_2() )
         check_win( b )
 
+class TestCluster_StartAuto_Restart_TwoPlayers:
+
+    @staticmethod
+    async def launch():
+        # games run in worker processes and both players return to the lobby
+        async with cluster_server( workers=2 ):
+            await asyncio.gather(   TestWin_StartAuto_Restart_TwoPlayers.player_1(),
+                                    TestWin_StartAuto_Restart_TwoPlayers.player_2(), )
+
+class TestCluster_PipelinedJoin_TwoPlayers:
+
+    @staticmethod
+    async def launch():
+        # what follows (joinplayer ...) is the worker's to serve, however much
+        # of it the lobby read already
+        async with cluster_server( workers=2 ):
+            hosted, done = asyncio.Event(), asyncio.Event()
+            await asyncio.gather(   TestCluster_PipelinedJoin_TwoPlayers.player_1( hosted, done ),
+                                    TestCluster_PipelinedJoin_TwoPlayers.player_2( hosted, done ), )
+
+    @staticmethod
+    async def player_1( hosted, done ):
+        b = Battleship()
+        await b.connect(nick="foo")
+
+        set_layout( b, get_basic_layout_1() )
+        await b.start()
+        hosted.set()
+        # leaving would abort the game
+        await done.wait()
+
+    @staticmethod
+    async def player_2( hosted, done ):
+        await hosted.wait()
+        reader, writer = await asyncio.open_unix_connection( _SOCKET_NAME )
+
+        writer.write( b'(nick "bar" "salt")' )
+        assert ( await reader.readline() ).startswith( b'(ok ' )
+
+        # a command right behind, then more than one control packet of
+        # padding before the next one
+        writer.write( b'(joinplayer "foo" "hash")(list)' + b' \n' * 100000 + b'(list)' )
+        assert ( await reader.readline() ).startswith( b'(game ' )
+        # the lobby answers them, the game goes on there
+        for _ in range( 2 ):
+            line = await reader.readline()
+            assert line.startswith( b'(games (active "foo" "bar" ' ), line
+        writer.close()
+        done.set()
+
+class TestCluster_LobbyCommands_ThreePlayers:
+
+    @staticmethod
+    async def launch():
+        async with cluster_server( workers=1 ):
+            login = TestCluster_WorkerDies_TwoPlayers.login
+            ( r1, w1 ), ( r2, w2 ), ( r3, w3 ) = [ await login( nick ) for nick in ( "x", "y", "z" ) ]
+
+            # a host with a game waiting plays another one in the lobby
+            w1.write( b'(start "hash")' )
+            assert await r1.readline() == b'(started 1)\n'
+            w2.write( b'(start "hash")' )
+            assert await r2.readline() == b'(started 2)\n'
+            w1.write( b'(joinplayer "y" "hash")' )
+            assert await r1.readline() == b'(game 2 joined)\n'
+            assert await r2.readline() == b'(game 2 joined)\n'
+            w1.write( b'(list)' )
+            assert await r1.readline() == b'(games (waiting "x" 1) (active "y" "x" 2))\n'
+            w3.write( b'(join 1 "hash")' )
+            assert await r3.readline() == b'(game 1 joined)\n'
+            assert await r1.readline() == b'(game 1 joined)\n'
+
+            w1.write( b'(list)' )
+            assert await r1.readline() == b'(games (active "x" "z" 1) (active "y" "x" 2))\n'
+
+            # game 3 runs in the worker, a (list) brings it back to the lobby
+            # and the game goes on there
+            ( r4, w4 ), ( r5, w5 ) = [ await login( nick ) for nick in ( "a", "b" ) ]
+            w4.write( b'(start "hash")' )
+            assert await r4.readline() == b'(started 3)\n'
+            w5.write( b'(joinplayer "a" "hash")' )
+            assert await r5.readline() == b'(game 3 joined)\n'
+            assert await r4.readline() == b'(game 3 joined)\n'
+            w5.write( b'(shoot 3 0 0)(list)(shoot 3 1 1)' )
+            assert await r4.readline() == b'(shoot 3 0 0)\n'
+            line = await r5.readline()
+            assert line.startswith( b'(games ' ) and b'(active "a" "b" 3)' in line, line
+            assert await r5.readline() == b'(error "Cannot shoot two times in row!")\n'
+            w4.write( b'(miss 3)(shoot 3 2 2)' )
+            assert await r5.readline() == b'(miss 3)\n'
+            assert await r5.readline() == b'(shoot 3 2 2)\n'
+
+            for writer in ( w1, w2, w3, w4, w5 ):
+                writer.close()
+
+class TestCluster_WorkerDies_TwoPlayers:
+
+    @staticmethod
+    async def launch():
+        async with cluster_server( workers=1 ) as server:
+            foo = await TestCluster_WorkerDies_TwoPlayers.login( "foo" )
+            bar = await TestCluster_WorkerDies_TwoPlayers.login( "bar" )
+            foo[1].write( b'(start "hash")' )
+            assert ( await foo[0].readline() ).startswith( b'(started ' )
+            bar[1].write( b'(joinplayer "foo" "hash")' )
+            assert ( await bar[0].readline() ).startswith( b'(game ' )
+
+            # the game and both connections end with the worker
+            with open( f"/proc/{server.pid}/task/{server.pid}/children" ) as children:
+                for pid in children.read().split():
+                    os.kill( int( pid ), signal.SIGKILL )
+            for reader, writer in ( foo, bar ):
+                await reader.read()     # (game <id> joined) may come first
+                assert reader.at_eof()
+                writer.close()
+
+            # the nicks are free again, the lobby runs the games itself now
+            foo = await TestCluster_WorkerDies_TwoPlayers.login( "foo" )
+            bar = await TestCluster_WorkerDies_TwoPlayers.login( "bar" )
+            foo[1].write( b'(start "hash")' )
+            assert ( await foo[0].readline() ).startswith( b'(started ' )
+            bar[1].write( b'(joinplayer "foo" "hash")' )
+            assert ( await bar[0].readline() ).startswith( b'(game ' )
+            for _, writer in ( foo, bar ):
+                writer.close()
+
+    @staticmethod
+    async def login( nick ):
+        # the lobby hears of a dead worker a moment after its players do
+        for _ in range( 100 ):
+            reader, writer = await asyncio.open_unix_connection( _SOCKET_NAME )
+            writer.write( b'(nick "%s" "salt")' % nick.encode() )
+            line = await reader.readline()
+            if line != b'(error "Nick already in use")\n':
+                break
+            writer.close()
+            await asyncio.sleep( 0.05 )
+        assert line.startswith( b'(ok ' ), line
+        return reader, writer
+
+class TestListen_UnixTcp_TwoPlayers:
+
+    @staticmethod
+    async def launch():
+        # one server behind both listeners, the tcp port is picked by the system
+        server = shipserv.Server()
+        listeners = await shipserv.listen( server, [ _SOCKET_NAME, "tcp:127.0.0.1:0" ] )
+        port = listeners[1].sockets[0].getsockname()[1]
+
+        hosted = asyncio.Event()
+        await asyncio.gather(   TestListen_UnixTcp_TwoPlayers.player_1( hosted ),
+                                TestListen_UnixTcp_TwoPlayers.player_2( hosted, port ), )
+        for listener in listeners:
+            listener.close()
+
+    @staticmethod
+    async def player_1( hosted ):
+        b = Battleship()
+        await b.connect(nick="foo")
+
+        set_layout( b, get_basic_layout_1() )
+        await b.start()
+        hosted.set()
+        # a host who disconnects withdraws the game, stay until the test is over
+        return b
+
+    @staticmethod
+    async def player_2( hosted, port ):
+        await hosted.wait()
+        reader, writer = await asyncio.open_connection( "127.0.0.1", port )
+
+        writer.write( b'(nick "bar" "salt")' )
+        assert ( await reader.readline() ).startswith( b'(ok ' )
+
+        writer.write( b'(list)' )
+        assert ( await reader.readline() ).startswith( b'(games (waiting "foo" ' )
+        writer.close()
+
+class TestLimits_OversizedDeep_OnePlayer:
+
+    @staticmethod
+    async def launch():
+        server = shipserv.Server()
+        listeners = await shipserv.listen( server, [ _SOCKET_NAME ] )
+        await TestLimits_OversizedDeep_OnePlayer.player_1()
+        for listener in listeners:
+            listener.close()
+
+    @staticmethod
+    async def player_1():
+        reader, writer = await asyncio.open_unix_connection( _SOCKET_NAME )
+        writer.write( b'(nick "foo" "salt")' )
+        assert ( await reader.readline() ).startswith( b'(ok ' )
+
+        # megabytes of a single command are dropped as they come
+        writer.write( b'(nick "' + b'x' * ( 4 * 1024 * 1024 ) + b'" "salt")' )
+        assert ( await reader.readline() ).startswith( b'(error ' )
+
+        writer.write( b'(list ' + b'(' * 100000 + b')' * 100000 + b')' )
+        assert ( await reader.readline() ).startswith( b'(error ' )
+
+        # and the connection goes on
+        writer.write( b'(list)' )
+        assert ( await reader.readline() ).startswith( b'(games ' )
+        writer.close()
+
+class TestSoak_Disconnects_ManyPlayers:
+
+    WAVES = 8
+    PAIRS = 20
+
+    @staticmethod
+    async def launch():
+        # waves of games whose players walk away, nothing of them may stay behind
+        server = shipserv.Server()
+        listeners = await shipserv.listen( server, [ _SOCKET_NAME ] )
+        tracemalloc.start()
+        try:
+            usage = []
+            for wave in range( TestSoak_Disconnects_ManyPlayers.WAVES ):
+                await asyncio.gather( *[ TestSoak_Disconnects_ManyPlayers.pair( wave, i )
+                                         for i in range( TestSoak_Disconnects_ManyPlayers.PAIRS ) ],
+                                      *[ TestSoak_Disconnects_ManyPlayers.lone_host( wave, i )
+                                         for i in range( TestSoak_Disconnects_ManyPlayers.PAIRS // 2 ) ] )
+                await TestSoak_Disconnects_ManyPlayers.settle( server )
+                gc.collect()
+                # the parsers intern the nicks they see, up to common._INTERN_LIMIT
+                snapshot = tracemalloc.take_snapshot().filter_traces( [ tracemalloc.Filter( False, "*common.py" ) ] )
+                usage.append( sum( stat.size for stat in snapshot.statistics( "filename" ) ) )
+
+            # the first waves fill caches and free lists, after them memory stays flat
+            grown = usage[-1] - usage[2]
+            assert grown < 16 * 1024, f"memory grew by {grown} B over the waves: {usage}"
+        finally:
+            tracemalloc.stop()
+            for listener in listeners:
+                listener.close()
+
+    @staticmethod
+    async def settle( server ):
+        for _ in range(100):
+            state = ( server.games, server.players, server.nicks, server._seats, server._waiting,
+                      server._hosted, server._listing, server._last_seen, server._outboxes )
+            if not any( state ):
+                return
+            await asyncio.sleep( 0.01 )
+        assert False, f"state left behind: {state}"
+
+    @staticmethod
+    async def pair( wave, i ):
+        host = Battleship()
+        await host.connect( nick=f"soak{wave}host{i}" )
+        set_layout( host, get_basic_layout_1() )
+        await host.start()
+
+        guest = Battleship()
+        await guest.connect( nick=f"soak{wave}guest{i}" )
+        set_layout( guest, get_basic_layout_2() )
+        await guest.join( f"soak{wave}host{i}" )
+
+        for x in range( i % 4 ):
+            await asyncio.gather( host.round( x, 9 ), guest.round( x, 9 ) )
+
+        # one of them leaves in the middle of the game
+        leaver, stayer = ( host, guest ) if i % 2 else ( guest, host )
+        await leaver.close()
+        await stayer.round( 9, 9 )
+        assert stayer.aborted()
+        assert [ report[0] for report in stayer._end_mismatch ] == [ "left" ], stayer._end_mismatch
+        await stayer.close()
+
+    @staticmethod
+    async def lone_host( wave, i ):
+        # offers a game nobody takes, and goes
+        b = Battleship()
+        await b.connect( nick=f"soak{wave}lone{i}" )
+        set_layout( b, get_basic_layout_1() )
+        await b.start()
+        await b.close()
+
+
 class TestWin_AutoJoin_Restart_TwoPlayers:
 
     @staticmethod
@@ -1129,8 +1446,11 @@ class TestList_WaitingGames_Increase_TwoPlayers:
 
     @staticmethod
     async def add_additional_active_games():
+        # a host who disconnects withdraws the game, keep them all connected
+        ships = []
         for i in range(10):
             b = Battleship()
+            ships.append( b )
             await b.connect(nick=f"additional{i}")
 
             set_layout( b, get_basic_layout_1() )
@@ -1138,6 +1458,7 @@ class TestList_WaitingGames_Increase_TwoPlayers:
             print(f"additional game {i} started")
             check_states_empty( b )
             await asyncio.sleep(0.1)
+        return ships
 
 
     @staticmethod
@@ -1294,6 +1615,14 @@ def main():
 
         await TestList_WaitingGames_Increase_TwoPlayers.launch()
 
+        await TestCluster_StartAuto_Restart_TwoPlayers.launch()
+        await TestCluster_PipelinedJoin_TwoPlayers.launch()
+        await TestCluster_LobbyCommands_ThreePlayers.launch()
+        await TestCluster_WorkerDies_TwoPlayers.launch()
+        await TestListen_UnixTcp_TwoPlayers.launch()
+        await TestLimits_OversizedDeep_OnePlayer.launch()
+        await TestSoak_Disconnects_ManyPlayers.launch()
+
         # TODO: await TestList_ActiveGames_Increase_TwoPlayers.launch()
         # TODO: await TestList_WaitingGames_TwoPlayers.launch()
 
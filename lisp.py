@@ -1,6 +1,9 @@
 # Implement ‹parse› here. You can define helper classes either here
 # or in ‹classes.py› (the latter will not be directly imported by
 # the tests).
+import sys
+
+import common
 from classes import Bool, Number, Identifier, String, Interface
 
 ID_SYMBOL = {'!', '$', '%', '&', '*', '/', ':', '<', '=', '>', '?', '_', '~'}
@@ -14,6 +17,8 @@ class NotParsable(Exception):
 
 
 class Compound(Interface):
+    __slots__ = ( "compounds", )
+
     def __init__(self, compounds):
         self.compounds = compounds
 
@@ -344,12 +349,21 @@ class Parser:
         return Compound(self.expressions)
 
 
+# parse() is the tokenizer of common.py building the nodes of classes.py;
+# Parser stays as the reference the tokenizer is tested against, see there
+# for the quirks it keeps.
+_NODES = common._Nodes( { **{ str(n): Number(n) for n in range(256) }, "#t": Bool(True), "#f": Bool(False) },
+                        Bool, Number, Identifier, String, Compound )
+
+
 def parse(expr):
     if not expr:
         return None
-    parser = Parser(expr.strip(), 0)
+    expr = expr.strip()
+    if not expr:
+        return None
     try:
-        x = parser.parse()
-    except NotParsable:
+        # no depth limit here, unlike for the messages the server receives
+        return common._parse_tokens(expr, _NODES, sys.maxsize)
+    except common.NotParsable:
         return None
-    return x
@@ -0,0 +1,329 @@
+# Throughput of the s-expression parsers on generated corpora.
+#
+# Every corpus is first parsed by Parser, the reference implementation, and
+# common.parse (text, bytes and native values) and lisp.parse must give the
+# same results; a parser which is fast but wrong does not get timed at all.
+# Then each parser runs over each corpus and its rate is compared with the
+# stored baseline.
+#
+#   python parsebench.py                  # check, time, compare with parsebench.json
+#   python parsebench.py --save           # ... and store the rates as the new baseline
+#   python parsebench.py --check          # exit with 1 if something got slower
+#
+# The baseline holds the rates of whichever machine saved it, regressions are
+# only meaningful when compared on that same machine.
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from typing import Callable, Dict, List
+
+import common
+import lisp
+
+_BASELINE = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "parsebench.json" )
+
+# numbers as the grammar takes them, and things which only look like numbers
+_NUMBERS = [ "0", "-0", "+0", "007", "-007", "+5", "42", "-1", "1.5", "-1.5", "0.0", "-0.0",
+             "3.14159265358979323846", "9" * 30, "-" + "9" * 30, "1" + "0" * 300 + ".5",
+             "1.", ".5", "-.5", "1.2.3", "1e3", "1E-3", "0x1f", "1_000", "+-1", "--1",
+             "+", "-", "inf", "nan", "#t", "#f", "#true", "١٢", "²", "1²" ]
+
+_MUTATIONS = [ "(", ")", "[", "]", '"', "\\", " ", "\n", "\x1c", "#", ".", "-", "²", "é", "\xa0" ]
+
+
+# comparing the parsers, tests.py checks them with these too
+def reference_parse( module, expr ):
+    """parse() as it was before the tokenizer, on top of ‹module›.Parser."""
+    if not expr:
+        return None
+    try:
+        return module.Parser( expr.strip(), 0 ).parse()
+    except ( module.NotParsable, ValueError ):
+        # ValueError: Parser tried int() on e.g. "²"
+        return None
+
+
+def shape( expr ):
+    if expr is None:
+        return None
+    if expr.is_compound():
+        return tuple( shape( e ) for e in expr )
+    return ( type(expr).__name__, type(expr.value).__name__, expr.value )
+
+
+def native_shape( expr ):
+    """shape() of what parse( expr, native=True ) should return for the nodes ‹expr›."""
+    if expr is None:
+        return None
+    if expr.is_compound():
+        return tuple( native_shape( e ) for e in expr )
+    if expr.is_identifier():
+        return ( "Symbol", expr.value )
+    if expr.is_string():
+        return ( "str", re.sub( r'\\(.)', r'\1', str( expr ) ) )
+    return ( type(expr.value).__name__, expr.value )
+
+
+def typed( value ):
+    # 1, 1.0 and True are all equal, their types tell them apart
+    if value is None:
+        return None
+    if type(value) is tuple:
+        return tuple( typed( v ) for v in value )
+    return ( type(value).__name__, value )
+
+
+def protocol_corpus( count, rnd ):
+    """Messages as they go over the wire during games, in about that mix."""
+    def nick():
+        return "".join( rnd.choice( "abcdefghijklmnopqrstuvwxyz0123456789_" ) for _ in range( rnd.randint( 1, 16 ) ) )
+
+    def games():
+        listing = [ f'(waiting "{nick()}" {rnd.randint( 1, 99999 )})' if rnd.random() < 0.5 else
+                    f'(active "{nick()}" "{nick()}" {rnd.randint( 1, 99999 )})'
+                    for _ in range( rnd.randint( 0, 40 ) ) ]
+        return f'(games {" ".join( listing )})'
+
+    def layout():
+        ships = " ".join( f"(ship {size} {rnd.randint( 0, 9 )} {rnd.randint( 0, 9 )} "
+                          f"{rnd.choice( ( 'horizontal', 'vertical' ) )})" for size in ( 5, 4, 3, 3, 2 ) )
+        return f"(layout {rnd.randint( 1, 99999 )} {ships})"
+
+    game = lambda: rnd.randint( 1, 99999 )
+    coordinate = lambda: rnd.randint( 0, 9 )
+    kinds = [
+        ( 30, lambda: f"(shoot {game()} {coordinate()} {coordinate()})" ),
+        ( 20, lambda: f"(hit {game()})" ),
+        ( 20, lambda: f"(miss {game()})" ),
+        ( 3, lambda: f'(nick "{nick()}" "{common.generate_salt()}")' ),
+        ( 3, lambda: f'(ok "{common.generate_salt()}")' ),
+        ( 3, lambda: f'(auto "{common.generate_salt()}{common.generate_salt()}")' ),
+        ( 3, lambda: f"(started {game()})" ),
+        ( 3, lambda: f"(game {game()} joined)" ),
+        ( 3, lambda: rnd.choice( ( "(list)", "(list wait)", "(ok)" ) ) ),
+        ( 3, games ),
+        ( 3, layout ),
+        ( 2, lambda: f'(end {game()} "{nick()}")' ),
+        ( 2, lambda: f"(game {game()} {rnd.choice( ( 'ok', 'aborted' ) )})" ),
+        ( 2, lambda: f'(error "{rnd.choice( ( "Command not known.", "Game not found", "Nick taken" ) )}")' ),
+    ]
+    weights = [ weight for weight, _ in kinds ]
+    makers = [ make for _, make in kinds ]
+    return [ rnd.choices( makers, weights )[0]() for _ in range( count ) ]
+
+
+def strings_corpus( count, rnd ):
+    """Long string literals full of escapes, brackets and non-ascii text."""
+    pieces = [ "a", "Z", " ", "(", ")", "[", "]", "\\\"", "\\\\", ";", "é", "一", "\t", "salt", "0" ]
+
+    def literal():
+        return '"' + "".join( rnd.choice( pieces ) for _ in range( rnd.randint( 32, 1024 ) ) ) + '"'
+
+    corpus = []
+    for _ in range( count ):
+        corpus.append( rnd.choice( (
+            lambda: literal(),
+            lambda: f"(nick {literal()} {literal()})",
+            lambda: f"(error {literal()})",
+            lambda: f"({' '.join( literal() for _ in range( rnd.randint( 2, 8 ) ) )})",
+        ) )() )
+    return corpus
+
+
+def deep_corpus( count, rnd, depth=common._MAX_DEPTH ):
+    """Nesting up to ‹depth›, with both kinds of brackets, and some beyond it."""
+    def nested( levels ):
+        expr = rnd.choice( ( "x", "1", '"s"', "" ) )
+        for _ in range( levels ):
+            opening, closing = rnd.choice( ( "()", "[]" ) )
+            expr = f"{opening}{rnd.choice( ( 'a ', '', '(b) ' ) )}{expr}{closing}"
+        return expr
+
+    corpus = []
+    for _ in range( count ):
+        levels = rnd.randint( 1, depth - 2 )
+        # past the limit common.parse gives up, lisp.parse does not
+        if rnd.random() < 0.1:
+            levels = rnd.randint( depth + 1, 4 * depth )
+        corpus.append( nested( levels ) )
+    return corpus
+
+
+def numbers_corpus( count, rnd ):
+    """Numeric edge cases, bare and inside messages."""
+    corpus = []
+    for _ in range( count ):
+        numbers = [ rnd.choice( _NUMBERS ) for _ in range( rnd.randint( 1, 6 ) ) ]
+        corpus.append( numbers[0] if rnd.random() < 0.3 else f"(shoot {' '.join( numbers )})" )
+    return corpus
+
+
+def mutated_corpus( count, rnd ):
+    """Protocol messages with characters inserted, replaced, dropped or cut off."""
+    corpus = []
+    for message in protocol_corpus( count, rnd ):
+        chars = list( message )
+        for _ in range( rnd.randint( 1, 3 ) ):
+            at = rnd.randrange( len(chars) + 1 )
+            action = rnd.random()
+            if action < 0.4:
+                chars.insert( at, rnd.choice( _MUTATIONS ) )
+            elif action < 0.7 and at < len(chars):
+                chars[at] = rnd.choice( _MUTATIONS )
+            elif action < 0.9 and at < len(chars):
+                del chars[at]
+            else:
+                del chars[at:]
+        corpus.append( "".join( chars ) )
+    return corpus
+
+
+CORPORA: Dict[ str, Callable ] = {
+    "protocol": protocol_corpus,
+    "strings": strings_corpus,
+    "deep": deep_corpus,
+    "numbers": numbers_corpus,
+    "mutated": mutated_corpus,
+}
+
+
+def make_corpora( count=2000, seed=20 ) -> Dict[ str, List[str] ]:
+    return { name: make( count, random.Random( f"{seed}:{name}" ) ) for name, make in CORPORA.items() }
+
+
+def _depth( value ):
+    # shape() of an atom is a tuple too, starting with the node type name
+    if type(value) is not tuple or ( value and type(value[0]) is str ):
+        return 0
+    return 1 + max( ( _depth( v ) for v in value ), default=0 )
+
+
+def differences( corpus, limit=10 ):
+    """Expressions of ‹corpus› on which a parser disagrees with Parser, at most ‹limit› of them."""
+    found = []
+    for expr in corpus:
+        reference = reference_parse( common, expr )
+        expect = shape( reference )
+        # common.parse refuses to go deeper than _MAX_DEPTH, Parser and lisp.parse do not
+        limited = None if _depth( expect ) > common._MAX_DEPTH else expect
+        native = None if limited is None else native_shape( reference )
+        data = expr.encode()
+
+        for name, got, want in (
+                ( "common.parse", lambda: shape( common.parse( expr ) ), limited ),
+                ( "common.parse bytes", lambda: shape( common.parse( data ) ), limited ),
+                ( "common.parse native", lambda: typed( common.parse( data, native=True ) ), native ),
+                ( "lisp.parse", lambda: shape( lisp.parse( expr ) ), expect ) ):
+            got = got()
+            if got != want:
+                found.append( f"{name}({expr[:80]!r}): {got} != {want}" )
+                if len(found) >= limit:
+                    return found
+    return found
+
+
+def _parsers():
+    return {
+        "common": ( lambda corpus: corpus, common.parse ),
+        "common bytes": ( lambda corpus: [ expr.encode() for expr in corpus ], common.parse ),
+        "common native": ( lambda corpus: [ expr.encode() for expr in corpus ],
+                           lambda data: common.parse( data, native=True ) ),
+        "lisp": ( lambda corpus: corpus, lisp.parse ),
+    }
+
+
+def measure( corpus, prepare, parse, min_time=0.2 ):
+    """Messages and megabytes per second of ‹parse› going over ‹corpus› until ‹min_time› passes."""
+    inputs = prepare( corpus )
+    size = sum( len( expr.encode() ) for expr in corpus )
+    rounds = 0
+    start = time.perf_counter()
+    while True:
+        for expr in inputs:
+            parse( expr )
+        rounds += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return { "msg_s": rounds * len(corpus) / elapsed, "mb_s": rounds * size / elapsed / 1e6 }
+
+
+def load_baseline( path=_BASELINE ):
+    try:
+        with open( path ) as f:
+            return json.load( f )
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Throughput of the s-expression parsers." )
+    parser.add_argument( "corpora", nargs="*", metavar="corpus",
+                         help=f"corpus to run, one of: {', '.join(CORPORA)} (default: all)" )
+    parser.add_argument( "--messages", type=int, default=2000,
+                         help="messages in each corpus (default: 2000)" )
+    parser.add_argument( "--min-time", type=float, default=0.2, metavar="SECONDS",
+                         help="time spent on each corpus with each parser (default: 0.2)" )
+    parser.add_argument( "--baseline", default=_BASELINE, metavar="FILE",
+                         help="where the baseline is kept (default: parsebench.json)" )
+    parser.add_argument( "--save", action="store_true",
+                         help="store the measured rates as the new baseline" )
+    parser.add_argument( "--check", action="store_true",
+                         help="exit with 1 if a rate is below the baseline by more than the tolerance" )
+    parser.add_argument( "--tolerance", type=float, default=0.15,
+                         help="allowed slow-down against the baseline (default: 0.15)" )
+    args = parser.parse_args()
+    for name in args.corpora:
+        if name not in CORPORA:
+            parser.error( f"unknown corpus {name}" )
+
+    corpora = make_corpora( args.messages )
+    names = args.corpora or list( CORPORA )
+
+    failed = False
+    for name in names:
+        found = differences( corpora[name] )
+        for difference in found:
+            print( f"{name}: {difference}" )
+        failed = failed or bool( found )
+    if failed:
+        print( "the parsers disagree, not timing them" )
+        sys.exit( 1 )
+
+    baseline = load_baseline( args.baseline )
+    results = {}
+    regressed = []
+    print( f"{'corpus':<10} {'parser':<14} {'msg/s':>12} {'MB/s':>8}   {'baseline':>12}" )
+    for name in names:
+        for label, ( prepare, parse ) in _parsers().items():
+            rate = measure( corpora[name], prepare, parse, args.min_time )
+            results.setdefault( name, {} )[label] = rate
+            before = baseline.get( name, {} ).get( label )
+            compared = ""
+            if before:
+                change = rate["msg_s"] / before["msg_s"] - 1
+                compared = f"{before['msg_s']:>12,.0f} {change:+7.1%}"
+                if change < -args.tolerance:
+                    compared += "  slower"
+                    regressed.append( f"{name}/{label}" )
+            print( f"{name:<10} {label:<14} {rate['msg_s']:>12,.0f} {rate['mb_s']:>8.2f}   {compared}" )
+
+    if args.save:
+        # corpora which were not run keep their old rates
+        with open( args.baseline, "w" ) as f:
+            json.dump( { **baseline, **results }, f, indent=2, sort_keys=True )
+            f.write( "\n" )
+        print( f"baseline saved to {args.baseline}" )
+
+    if regressed:
+        print( f"slower than the baseline: {', '.join( regressed )}" )
+        if args.check:
+            sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
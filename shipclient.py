@@ -1,11 +1,29 @@
 # The client API.
 
 import asyncio
+from collections import deque
 from common import parse as hw3_parse
 from shipserv import _SOCKET_NAME
-from typing import List, Dict
+from typing import List
 import common
-from common import _SHIPS_HEALTH, _SOCKET_NAME
+from common import _SHIPS_HEALTH, _SOCKET_NAME, _READ_CHUNK, Template
+
+# reports which follow (game aborted), one or more of them
+_MISMATCH_REPORTS = ( "hash-mismatch", "board-mismatch", "left", "timeout" )
+
+# the messages the client sends
+_NICK = Template( "nick", str, str )
+_START = Template( "start", str )
+_LIST = Template( "list" ).frame
+_LIST_WAIT = Template( "list", "wait" ).frame
+_AUTO = Template( "auto", str )
+_JOINPLAYER = Template( "joinplayer", str, str )
+# formatted directly, calling a Template costs more than the formatting
+_SHOOT = b"(shoot %d %d %d)\n"
+_DAMAGE = { "hit": b"(hit %d)\n", "miss": b"(miss %d)\n" }
+_LAYOUT = b"(layout %d %s)\n"
+_SHIP = b"(ship %d %d %d %s)"
+_ALIGN = { True: b"vertical", False: b"horizontal" }
 
 async def check_line( reader, expect ):
     expect += '\n'
@@ -14,9 +32,13 @@ async def check_line( reader, expect ):
 
 class Battleship:
 
-    def __init__(self):
+    def __init__(self, memo_size=0):
         self._reader = None
         self._writer = None
+        # with ‹memo_size›, that many received frames are remembered parsed
+        self.frame_memo = common.FrameMemo( memo_size ) if memo_size else None
+        self._parser = common.StreamParser( native=True, memo=self.frame_memo )
+        self._responses = deque()
         self._salt = common.generate_salt()
         self._server_salt = None
 
@@ -38,13 +60,30 @@ class Battleship:
         self._enemy_hit_count = 0
         self._is_host = False
 
-    async def _send_command( self, msg ):
-        self._writer.write( msg.encode() )
+    async def _send_command( self, frame: bytes ):
+        self._writer.write( frame )
         await self._writer.drain()
 
-    async def _get_server_response( self ):
-        data = await self._reader.readline()
-        return hw3_parse( data.decode() )
+    @staticmethod
+    def _is_mismatch_report( response ):
+        return type(response) is tuple and response[0] in _MISMATCH_REPORTS
+
+    async def _get_server_response( self, mismatch=False ):
+        """Return the next message received from the server.
+
+        Mismatch reports are skipped unless asked for; their count is not
+        known up front, so the ones left over from a game may trail behind.
+        """
+        while True:
+            while not self._responses:
+                data = await self._reader.read( _READ_CHUNK )
+                if not data:
+                    raise ConnectionError("Server closed the connection")
+                self._responses.extend( self._parser.feed( data ) )
+
+            response = self._responses.popleft()
+            if mismatch or not self._is_mismatch_report( response ):
+                return response
 
     async def connect( self, nick: str ):
         self._nick = nick
@@ -53,13 +92,18 @@ class Battleship:
         self._reader = r
         self._writer = w
 
-        await self._send_command( f'(nick "{nick}" "{self._salt}")' )
+        await self._send_command( _NICK( nick, self._salt ) )
 
         status = await self._get_server_response()
         assert status[0] == "ok"
-        assert status[1].is_string() #TODO remove
+        assert type(status[1]) is str #TODO remove
         self._server_salt = str( status[1] )
 
+    async def close( self ):
+        """Close the connection to the server."""
+        self._writer.close()
+        await self._writer.wait_closed()
+
     def _get_layout_for_hash( self ):
         layout = sorted( self._ship_layout, key=lambda x: (x[0], x[1], x[2]), reverse=True )
         return[ (t[1], t[2], t[3]) for t in layout ]
@@ -91,7 +135,7 @@ class Battleship:
 
         self._hash = common.hash_game( self._server_salt, self._salt, self._get_layout_for_hash() )
 
-        await self._send_command( f'(start "{self._hash}")' )
+        await self._send_command( _START( self._hash ) )
         response = await self._get_server_response()
         assert response[0] == 'started' # TODO remove
         self._game_id = int(response[1])
@@ -102,19 +146,18 @@ class Battleship:
         # assert joined[0] == "game" and joined[1] == "started" # TODO remove
 
 
-    async def _get_games( self ):
-        """Request server and return the buffered result."""
-        await self._send_command( f'(list)' )
+    async def _get_games( self, wait=False ):
+        """Request the list of games from the server.
 
-        games = None
-        while True: # parsing and waiting for all the lines to be received
-            games = await self._get_server_response()
-            if games:
-                if len(games) == 1: # TODO consider server side holding, not client's
-                    await self._send_command( f'(list)' )
-                else:
-                    return games
-            await asyncio.sleep(0.1)
+        With ‹wait›, the server holds the reply until some games are waiting
+        and their nicks differ from its previous reply to us.
+        """
+        await self._send_command( _LIST_WAIT if wait else _LIST )
+        return await self._get_server_response()
+
+    @staticmethod
+    def _get_waiting_nicks( server_resp ) -> List[ str ]:
+        return [ str(g[1]) for g in server_resp[1:] if g[0] == "waiting" ]
 
     async def list_games( self ) -> List[ str ]:
         """Return a list of nicks who announced a game and are waiting for other player.
@@ -123,24 +166,15 @@ class Battleship:
            call; never returns an empty list (i.e. blocks until it can
            return a non-empty list)
         """
-        server_resp = await self._get_games()
-        server_list = server_resp[1:]
-        games: Dict[str, List[int]]= { str(g[1]):[] for g in server_list if g[0] == "waiting" }
-
-        if len(games) == 0 or self._available_games:
-            while True:
-                if len(games) == 0:
-                    pass
-                elif self._available_games != games: # TODO should compare sets of nicks instead responses
-                    break
-
-                await asyncio.sleep(0.1) # TODO is this correct?
-                server_resp = await self._get_games()
-                server_list = server_resp[1:]
-                games = { str(g[1]):[] for g in server_list if g[0] == "waiting" }
+        games = None
+        if self._available_games is None:
+            games = self._get_waiting_nicks( await self._get_games() )
+
+        if not games:
+            games = self._get_waiting_nicks( await self._get_games( wait=True ) )
 
         self._available_games = games
-        return [ nick for nick in games ]
+        return games
 
 
     async def auto( self ):
@@ -149,15 +183,15 @@ class Battleship:
 
         self._hash = common.hash_game( self._server_salt, self._salt, self._get_layout_for_hash() )
 
-        await self._send_command( f'(auto "{self._hash}")' )
+        await self._send_command( _AUTO( self._hash ) )
         resp = await self._get_server_response()
 
         assert len(resp) == 2 or len(resp) == 3 #TODO remove
         self._game_id = resp[1]
 
-        if str(resp) == f"(started {self._game_id})":
+        if resp == ( "started", self._game_id ):
             self._is_host = True
-        elif str(resp) == f"(game {self._game_id} joined)": #TODO remove
+        elif resp == ( "game", self._game_id, "joined" ): #TODO remove
             pass
         else:
             assert False  #TODO remove
@@ -169,10 +203,10 @@ class Battleship:
 
         self._hash = common.hash_game( self._server_salt, self._salt, self._get_layout_for_hash() )
 
-        await self._send_command( f'(joinplayer "{nick}" "{self._hash}")' )
+        await self._send_command( _JOINPLAYER( nick, self._hash ) )
         resp = await self._get_server_response()
         self._game_id = int(resp[1])
-        assert str(resp) == f"(game {self._game_id} joined)" #TODO remove
+        assert resp == ( "game", self._game_id, "joined" ) #TODO remove
 
 
     def enemy( self ) -> List[ List[ str ] ]:
@@ -205,7 +239,7 @@ class Battleship:
                 self._ships[y][x] = "m"
             damage = "miss"
 
-        await self._send_command( f'({damage} {self._game_id})' )
+        await self._send_command( _DAMAGE[damage] % self._game_id )
 
 
     async def _send_layout_to_server( self ):
@@ -214,20 +248,28 @@ class Battleship:
                    (ship 3 6 5 vertical)
                    (ship 3 8 5 vertical)
                    (ship 2 9 9 horizontal)). """
-        ships = []
-        for size,x,y,vertical in self._ship_layout:
-            align = "vertical" if vertical else "horizontal"
-            ships.append(f"(ship {size} {x} {y} {align})")
+        ships = b" ".join( _SHIP % ( size, x, y, _ALIGN[bool(vertical)] ) for size, x, y, vertical in self._ship_layout )
+        await self._send_command( _LAYOUT % ( self._game_id, ships ) )
+
 
-        ships_msg = " ".join(ships) # TODO "/n" join or " "
-        msg = f"(layout {self._game_id} {ships_msg})"
-        await self._send_command( msg )
+    async def _aborted( self, response ) -> bool:
+        """Finish the game if ‹response› is (game aborted), return whether it was."""
+        if response != ( "game", "aborted" ):
+            return False
 
+        self._end_mismatch = [ await self._get_server_response( mismatch=True ) ]
+        while self._responses and self._is_mismatch_report( self._responses[0] ):
+            self._end_mismatch.append( self._responses.popleft() )
+        self._end_status = "abort"
+        return True
 
     async def _process_game_end( self ):
         """Call when end of game occured."""
         if not self._early_end:
             self._early_end = await self._get_server_response()
+            # the other player left or the game timed out instead
+            if await self._aborted( self._early_end ):
+                return
         end_response = self._early_end
         assert end_response[0] == "end" # TODO remove
         winner = str(end_response[2])
@@ -241,11 +283,10 @@ class Battleship:
             is_draw = True
             game_status = await self._get_server_response()
 
-        if game_status[1] == "aborted":
-            self._end_mismatch = await self._get_server_response()
-            self._end_status = "abort"
+        if await self._aborted( game_status ):
+            return
 
-        elif game_status[1] == "ok":
+        if game_status[1] == "ok":
             self._end_status =  "d" if is_draw else \
                                 "w" if winner == self._nick else \
                                 "l" 
@@ -258,14 +299,20 @@ class Battleship:
         """Play one round, shooting at ‹(x, y)›."""
         if self._is_host:
             resp = await self._get_server_response()
-            assert str(resp) == f'(game {self._game_id} joined)' #TODO remove
+            assert resp == ( "game", self._game_id, "joined" ) #TODO remove
             self._is_host = False
 
-        await self._send_command( f'(shoot {self._game_id} {x} {y})' )
+        await self._send_command( _SHOOT % ( self._game_id, x, y ) )
+        # the game may be aborted at any point, when the other player leaves
+        # or stands still too long
         attack = await self._get_server_response()
+        if await self._aborted( attack ):
+            return
         await self._process_received_attack( attack )
 
         result = await self._get_server_response()
+        if await self._aborted( result ):
+            return
 
         if result[0] == "hit" or result[0] == "miss":
             self._enemy_ships[y][x] = "h" if result[0] == "hit" else "m"
@@ -274,6 +321,8 @@ class Battleship:
         elif result[0] == "end":
             self._early_end = result
             result = await self._get_server_response()
+            if await self._aborted( result ):
+                return
             if result[0] == "hit" or result[0] == "miss":
                 self._enemy_ships[y][x] = "h" if result[0] == "hit" else "m"
             if result[0] == "hit":
@@ -0,0 +1,427 @@
+# Multi-process server: a lobby process pairs the players, worker processes
+# run the games.
+#
+# The lobby serves nick, list, start, join, auto and joinplayer. Once a game
+# has both players, the lobby stops reading their connections and passes the
+# two sockets (SCM_RIGHTS over a unix socketpair) together with the game to
+# the least busy worker. The worker announces (game <id> joined) and runs
+# the game in a task of its own, as a single server does. When the game is
+# over, the sockets travel back to the lobby. The clients do not notice any
+# of this, they keep talking on the same socket.
+#
+# A game stays in the lobby when one of its players has anything else going
+# on there: another game, or a (list wait) not answered yet. A player who
+# sends one of the lobby's commands during a game takes the game back to
+# the lobby, with its state, and it goes on there.
+#
+# A worker which dies takes its games and their connections with it; the
+# lobby frees their nicks and hands games to the other workers, or runs
+# them itself once none is left.
+#
+# Only the games run in the workers. Logins, listings and pairing all stay in
+# the lobby, and every game costs two hand-offs. So workers pay off only
+# with spare cores, and how far that goes has not been measured. On one core,
+# shipload with 100 players does about 1.6k rounds/s with one or two
+# workers, against 2.4k rounds/s for a single process.
+#
+# Whatever a player sent and the server did not process yet travels with
+# the socket. It follows the json of the game in packets of its own, see
+# _Control.
+
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import socket
+from typing import List
+
+import shipserv
+from shipserv import GameSession, Server
+
+# largest packet on a control socket, well below its send buffer
+_CONTROL_PACKET = 64 * 1024
+
+
+async def _open_connection( fd ):
+    # the socket may be a unix or a tcp one, whichever listener accepted it
+    return await asyncio.open_connection( sock=socket.socket( fileno=fd ) )
+
+
+class _Control:
+    """One end of the socketpair between the lobby and a worker.
+
+    A message is a json packet, which carries the file descriptors, followed
+    by its ‹data› (one bytes per player) in packets of at most
+    _CONTROL_PACKET bytes; the json tells their sizes. The socket is
+    non-blocking, a sender waits while it is full.
+    """
+
+    def __init__( self, sock: socket.socket, on_message, on_closed ):
+        self.socket = sock
+        self._on_message = on_message   # ( message, fds, data )
+        self._on_closed = on_closed
+        # the packets of one message must not interleave with another's
+        self._sending = asyncio.Lock()
+        # ( message, fds, received ) while the data of a message comes in
+        self._incoming = None
+
+    def listen( self ):
+        self.socket.setblocking( False )
+        asyncio.get_running_loop().add_reader( self.socket.fileno(), self._receive )
+
+    async def send( self, message, fds, data: List[bytes] ):
+        header = json.dumps( dict( message, sizes=[ len(d) for d in data ] ) ).encode()
+        if len( header ) > _CONTROL_PACKET:
+            raise ValueError( f"control message of {len( header )} bytes" )
+        data = b"".join( data )
+
+        async with self._sending:
+            await self._send_packet( header, fds )
+            for start in range( 0, len( data ), _CONTROL_PACKET ):
+                await self._send_packet( data[start:start + _CONTROL_PACKET], () )
+
+    async def _send_packet( self, packet, fds ):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                socket.send_fds( self.socket, [ packet ], fds )
+                return
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer( self.socket.fileno(), lambda: writable.done() or writable.set_result( None ) )
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer( self.socket.fileno() )
+
+    def _receive( self ):
+        try:
+            packet, fds, _, _ = socket.recv_fds( self.socket, _CONTROL_PACKET, 2 )
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            packet = b""
+        if not packet:
+            asyncio.get_running_loop().remove_reader( self.socket.fileno() )
+            self._on_closed()
+            return
+
+        if self._incoming is None:
+            self._incoming = ( json.loads( packet ), fds, bytearray() )
+        else:
+            self._incoming[2].extend( packet )
+        message, fds, received = self._incoming
+        if len( received ) < sum( message["sizes"] ):
+            return
+
+        self._incoming = None
+        data = []
+        start = 0
+        for size in message.pop( "sizes" ):
+            data.append( bytes( received[start:start + size] ) )
+            start += size
+        self._on_message( message, fds, data )
+
+
+class _HandedOff:
+    """Stands in the lobby's nick registry for players whose game runs in a worker."""
+
+    def __init__( self, game_id ):
+        self.game_id = game_id
+
+
+class Lobby(Server):
+
+    def __init__( self, controls: List[socket.socket] ):
+        super().__init__()
+        self._controls = [ _Control( control, functools.partial( self._on_control, index ),
+                                     functools.partial( self._on_worker_closed, index ) )
+                           for index, control in enumerate( controls ) ]
+        self._worker_games = [ 0 ] * len(controls)
+        # { game_id: index of the worker running it }
+        self._remote_games = {}
+
+    def listen_to_workers( self ):
+        for control in self._controls:
+            control.listen()
+
+    def _workers( self ) -> List[int]:
+        """Indices of the workers still running."""
+        return [ index for index, control in enumerate( self._controls ) if control is not None ]
+
+    def _start_game( self, game_id ):
+        # a host who left cannot be handed over, nor can they play; and the
+        # lobby's business of a player stays with the lobby
+        if not all( self._only_playing( player ) for player in self.games[game_id] ) or not self._workers():
+            super()._start_game( game_id )
+            return
+
+        # stop reading right away, whatever comes next belongs to the worker
+        detached = [ self._detach( player ) for player in self.games[game_id] ]
+        asyncio.ensure_future( self._hand_off( game_id, detached ) )
+
+    def _only_playing( self, player ) -> bool:
+        """Whether ‹player› is connected and has nothing going on besides the game starting."""
+        if player not in self._outboxes or len( self._seats[player] ) > 1:
+            return False
+        waiter = self.players[player]["list_waiter"]
+        return waiter is None or waiter.done()
+
+    async def _hand_off( self, game_id, detached ):
+        slots = self.games[game_id].slots
+        pending = await asyncio.gather( *detached )
+
+        states = []
+        fds = []
+        for slot in slots:
+            player = slot.player
+            # whatever a player started in the lobby while it let go of them
+            # would wait for them there in vain
+            self._leave_games( player, keep=game_id )
+            await self._hand_over( player )
+            states.append( {
+                "nick": slot.nick,
+                "salt": slot.salt,
+                "server_salt": slot.server_salt,
+                "hash": slot.hash,
+            } )
+            fds.append( os.dup( player.get_extra_info( "socket" ).fileno() ) )
+            player.close()
+
+            # the nick stays taken while the game runs elsewhere
+            self._sign_out( player )
+            self.nicks[ slot.nick ] = _HandedOff( game_id )
+
+        try:
+            workers = self._workers()
+            if not workers:
+                raise ConnectionError( "no worker left" )
+            index = min( workers, key=self._worker_games.__getitem__ )
+            self._worker_games[index] += 1
+            self._remote_games[game_id] = index
+            await self._controls[index].send( { "game_id": game_id, "players": states }, fds, pending )
+        except ConnectionError:
+            # the workers died since the game started, the players' connections
+            # close with the last copies of their sockets
+            self._release( game_id )
+        finally:
+            for fd in fds:
+                os.close( fd )
+
+    def _release( self, game_id ):
+        """Forget a game handed to a worker, the nicks of its players are free again."""
+        if game_id not in self.games:
+            return
+        index = self._remote_games.pop( game_id, None )
+        if index is not None:
+            self._worker_games[index] -= 1
+        for slot in self.games[game_id].slots:
+            if isinstance( self.nicks.get( slot.nick ), _HandedOff ):
+                del self.nicks[ slot.nick ]
+        self._remove_game( game_id )
+
+    def _on_control( self, index, message, fds, data ):
+        asyncio.ensure_future( self._take_back( message, fds, data ) )
+
+    def _on_worker_closed( self, index ):
+        # the worker died, its games and their connections with it
+        self._controls[index] = None
+        for game_id in [ game_id for game_id, worker in self._remote_games.items() if worker == index ]:
+            self._release( game_id )
+
+    async def _take_back( self, message, fds, data ):
+        """A worker is done with a game, serve its players in the lobby again.
+
+        A game which is not over goes on in the lobby.
+        """
+        self._release( message["game_id"] )
+
+        connections = []
+        for state, fd, pending in zip( message["players"], fds, data ):
+            reader, writer = await _open_connection( fd )
+            self._log_in( writer, state["nick"], state["salt"], state["server_salt"] )
+            self.players[writer]["aborted"] = state["aborted"]
+            connections.append( ( reader, writer, pending ) )
+
+        if "moved" in message:
+            self._resume_game( message, [ writer for _, writer, _ in connections ] )
+
+        for reader, writer, pending in connections:
+            asyncio.ensure_future( self._serve( reader, writer, pending, logged_in=True ) )
+
+    def _resume_game( self, message, players ):
+        game_id = message["game_id"]
+        slots = []
+        for player, state in zip( players, message["players"] ):
+            slot = self._new_player_slot( player, state["hash"] )
+            slot.layout = None if state["layout"] is None else [ tuple( ship ) for ship in state["layout"] ]
+            slot.turn = state["turn"]
+            slot.hits = state["hits"]
+            slot.misses = state["misses"]
+            slots.append( slot )
+
+        host, guest = slots
+        game = self.games[game_id] = GameSession( game_id, host )
+        game.seat( guest )
+        game.moved = message["moved"]
+        for slot in slots:
+            self._add_seat( slot.player, game_id )
+        self._update_listing( game_id )
+        self._run_game( game )
+
+
+class Worker(Server):
+
+    # the lobby takes care of these, a game whose player sends one goes back
+    # to the lobby and on there
+    LOBBY_COMMANDS = { "nick", "list", "start", "join", "auto", "joinplayer" }
+
+    def __init__( self, control: socket.socket ):
+        super().__init__()
+        self._done = asyncio.get_running_loop().create_future()
+        # the lobby going away ends the worker
+        self._control = _Control( control, self._on_control, lambda: self._done.set_result( None ) )
+        # { game_id: None } of the games being handed back
+        self._handing_back = {}
+        # { player_writer: frame } of the lobby command which ended a
+        # player's stay, for the lobby to process first
+        self._deferred = {}
+
+    async def run( self ):
+        self._control.listen()
+        try:
+            await self._done
+        finally:
+            self.close()
+
+    def _on_control( self, message, fds, data ):
+        asyncio.ensure_future( self._take_game( message, fds, data ) )
+
+    async def _take_game( self, message, fds, data ):
+        game_id = message["game_id"]
+
+        connections = []
+        slots = []
+        for state, fd, pending in zip( message["players"], fds, data ):
+            reader, writer = await _open_connection( fd )
+            self._log_in( writer, state["nick"], state["salt"], state["server_salt"] )
+            self._connect( writer )
+            slots.append( self._new_player_slot( writer, state["hash"] ) )
+            connections.append( ( reader, writer, pending ) )
+
+        host, guest = slots
+        game = self.games[game_id] = GameSession( game_id, host )
+        game.seat( guest )
+        for slot in slots:
+            self._add_seat( slot.player, game_id )
+
+        self._update_listing( game_id )
+        self._start_game( game_id )
+
+        for reader, writer, pending in connections:
+            asyncio.ensure_future( self._serve( reader, writer, pending, logged_in=True ) )
+
+    async def execute( self, command, player ):
+        if command[0] not in Worker.LOBBY_COMMANDS:
+            await super().execute( command, player )
+            return
+
+        # the read loop stops right after this command, the lobby gets it first
+        self._deferred[ player ] = self._reencode( [ command ] )
+        if player not in self._detaching:
+            # the game is not over, it goes on in the lobby
+            self._hand_back( self.games[ next( iter( self._seats[player] ) ) ] )
+
+    def _remove_game( self, game_id ):
+        game = self.games[game_id]
+        super()._remove_game( game_id )
+        self._hand_back( game )
+
+    def _hand_back( self, game ):
+        """Return the players of ‹game› to the lobby, with the game unless it is over."""
+        if game.game_id in self._handing_back:
+            return
+        self._handing_back[ game.game_id ] = None
+
+        # stop reading right away, whatever comes next belongs to the lobby
+        detached = { player: self._detach( player ) for player in game if player in self._outboxes }
+        asyncio.ensure_future( self._send_back( game, detached ) )
+
+    async def _send_back( self, game, detached ):
+        received = { player: await future for player, future in detached.items() }
+        # nothing is posted any more; what was, is done here and answered
+        # before the connections go
+        game.close()
+        await game.task
+        running = self.games.get( game.game_id ) is game
+        if running:
+            super()._remove_game( game.game_id )
+        del self._handing_back[ game.game_id ]
+
+        message = { "game_id": game.game_id, "players": [] }
+        if running:
+            message["moved"] = game.moved
+        fds = []
+        pending = []
+        for slot in game.slots:
+            player = slot.player
+            if player not in received:
+                self._sign_out( player )
+                continue
+
+            await self._hand_over( player )
+            state = {
+                "nick": slot.nick,
+                "salt": self.players[player]["salt"],
+                "server_salt": self.players[player]["server_salt"],
+                "aborted": self.players[player]["aborted"],
+            }
+            if running:
+                state.update( hash=slot.hash, layout=slot.layout, turn=slot.turn, hits=slot.hits,
+                              misses=slot.misses )
+            message["players"].append( state )
+            pending.append( self._deferred.pop( player, b"" ) + received[player] )
+            fds.append( os.dup( player.get_extra_info( "socket" ).fileno() ) )
+            player.close()
+            self._sign_out( player )
+
+        try:
+            await self._control.send( message, fds, pending )
+        except ConnectionError:
+            # the lobby is gone, the worker ends with it
+            pass
+        finally:
+            for fd in fds:
+                os.close( fd )
+
+
+def _worker_main( control, inherited ):
+    for other in inherited:
+        other.close()
+
+    async def main_simple():
+        await Worker( control ).run()
+
+    asyncio.run( main_simple() )
+
+
+def start_cluster( workers: int, addresses=( shipserv._SOCKET_NAME, ) ):
+    """Fork ‹workers› game processes and run the lobby, listening on ‹addresses›, in this one."""
+    context = multiprocessing.get_context( "fork" )
+
+    controls = []
+    for _ in range(workers):
+        lobby_end, worker_end = socket.socketpair( socket.AF_UNIX, socket.SOCK_SEQPACKET )
+        # the worker must not hold any lobby end, or it would not see the lobby go away
+        context.Process( target=_worker_main, args=( worker_end, [ *controls, lobby_end ] ),
+                         daemon=True ).start()
+        worker_end.close()
+        controls.append( lobby_end )
+
+    async def main_simple():
+        lobby = Lobby( controls )
+        lobby.listen_to_workers()
+        await shipserv.start_server( lobby, addresses )
+
+    asyncio.run( main_simple() )
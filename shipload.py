@@ -0,0 +1,178 @@
+# Closed-loop load generator for shipserv.
+#
+# Every simulated player plays game after game with Battleship: connect,
+# put_ship, auto, round... until the game ends, then it disconnects and does
+# it all again. A player sends the next request only once the previous one was
+# answered, so the load follows what the server can take.
+#
+#   python shipload.py --players 200 --games 5
+#   python shipload.py --players 200 --games 5 --workers 4
+#   python shipload.py --players 200 --games 5 --frame-memo 256
+#
+# By default a fresh server is started in a temporary directory; with
+# --attach the players connect to a server already running in the current one.
+#
+# The players all run in this one process. They take about as much CPU as
+# the server, so comparing --workers counts needs a core for each worker
+# and more for the players; otherwise the cores are what is measured.
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from common import _SOCKET_NAME
+from shipclient import Battleship
+
+# ( x, y, size, vertical )
+LAYOUT = [ ( 0, 0, 2, False ),
+           ( 0, 1, 3, False ),
+           ( 0, 2, 3, False ),
+           ( 0, 3, 4, False ),
+           ( 0, 4, 5, False ), ]
+
+_SERVER = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "shipserv.py" )
+
+
+class Load:
+    """Latencies and counts collected by the simulated players."""
+
+    def __init__( self, memo_size=0 ):
+        self.latencies: Dict[ str, List[float] ] = { "connect": [], "auto": [], "round": [] }
+        self.games = 0
+        self.rounds = 0
+        self.memo_size = memo_size
+        # frame memo counters of all the players
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.memo_evictions = 0
+
+    async def timed( self, name, awaitable ):
+        start = time.perf_counter()
+        result = await awaitable
+        self.latencies[name].append( time.perf_counter() - start )
+        return result
+
+
+async def _player( load: Load, index: int, games: int ):
+    for game in range(games):
+        b = Battleship( memo_size=load.memo_size )
+        for x, y, size, vertical in LAYOUT:
+            b.put_ship( x, y, size, vertical )
+
+        await load.timed( "connect", b.connect( f"load{index}g{game}" ) )
+        await load.timed( "auto", b.auto() )
+
+        rounds = 0
+        while not b.finished():
+            await load.timed( "round", b.round( rounds % 10, rounds // 10 ) )
+            rounds += 1
+
+        await b.close()
+        load.games += 1
+        load.rounds += rounds
+        if b.frame_memo is not None:
+            load.memo_hits += b.frame_memo.hits
+            load.memo_misses += b.frame_memo.misses
+            load.memo_evictions += b.frame_memo.evictions
+
+
+def _peak_rss( pid ):
+    """Peak resident set size of ‹pid› in kB, as the kernel reports it."""
+    with open( f"/proc/{pid}/status" ) as status:
+        for line in status:
+            if line.startswith( "VmHWM:" ):
+                return int( line.split()[1] )
+    return None
+
+
+def _children( pid ):
+    try:
+        with open( f"/proc/{pid}/task/{pid}/children" ) as children:
+            return [ int(child) for child in children.read().split() ]
+    except OSError:
+        return []
+
+
+def _report( load: Load, elapsed ):
+    # every game is counted by both of its players
+    games = load.games // 2
+    rounds = load.rounds // 2
+    print( f"{games} games, {rounds} rounds in {elapsed:.2f} s" )
+    print( f"{games / elapsed:>10,.1f} games/s   {rounds / elapsed:>10,.1f} rounds/s" )
+    print( f"{'':<8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}   (ms)" )
+    for name, samples in load.latencies.items():
+        if len(samples) < 2:
+            continue
+        # "inclusive" stays within the samples, the default extrapolates
+        # past the largest one for the top percentiles
+        q = statistics.quantiles( samples, n=100, method="inclusive" )
+        print( f"{name:<8} {q[49] * 1e3:>9.2f} {q[94] * 1e3:>9.2f} {q[98] * 1e3:>9.2f} {max(samples) * 1e3:>9.2f}" )
+    if load.memo_size:
+        lookups = load.memo_hits + load.memo_misses
+        print( f"client frame memo: {load.memo_hits} hits / {lookups} frames "
+               f"({load.memo_hits / max( lookups, 1 ):.1%}), {load.memo_evictions} evictions" )
+
+
+async def _wait_for_server( server ):
+    while not os.path.exists( _SOCKET_NAME ):
+        if server.poll() is not None:
+            raise RuntimeError( f"server exited with {server.returncode}" )
+        await asyncio.sleep( 0.05 )
+
+
+async def run( players: int, games: int, memo_size=0 ):
+    load = Load( memo_size )
+    start = time.perf_counter()
+    await asyncio.gather( *[ _player( load, i, games ) for i in range(players) ] )
+    elapsed = time.perf_counter() - start
+    _report( load, elapsed )
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Closed-loop load generator for shipserv." )
+    parser.add_argument( "--players", type=int, default=100,
+                         help="concurrent simulated players, an even number (default: 100)" )
+    parser.add_argument( "--games", type=int, default=5,
+                         help="games played by each player (default: 5)" )
+    parser.add_argument( "--workers", type=int, default=0,
+                         help="start the server with this many worker processes" )
+    parser.add_argument( "--loop", choices=( "asyncio", "uvloop" ), default="asyncio",
+                         help="event loop of the started server (default: asyncio)" )
+    parser.add_argument( "--frame-memo", type=int, default=0, metavar="FRAMES",
+                         help="frame memo size of the players and of the started server (default: 0, off)" )
+    parser.add_argument( "--attach", action="store_true",
+                         help="use the server running in the current directory" )
+    args = parser.parse_args()
+    # auto() pairs the players, an odd one out would wait forever
+    if args.players < 2 or args.players % 2:
+        parser.error( "--players must be an even number" )
+
+    if args.attach:
+        asyncio.run( run( args.players, args.games, args.frame_memo ) )
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir( directory )
+        server = subprocess.Popen( [ sys.executable, _SERVER, "--workers", str(args.workers),
+                                    "--loop", args.loop, "--frame-memo", str(args.frame_memo) ] )
+
+        async def main_simple():
+            await _wait_for_server( server )
+            await run( args.players, args.games, args.frame_memo )
+
+        try:
+            asyncio.run( main_simple() )
+            for pid in [ server.pid, *_children( server.pid ) ]:
+                print( f"server pid {pid}: peak RSS {_peak_rss( pid ):,} kB" )
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,57 @@
 # Implement the server here.
 
+import argparse
 import asyncio
+import math
+import multiprocessing
 import os
 import time
-from asyncio import Event, IncompleteReadError
+from asyncio import Event
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import join
 from pathlib import Path
 from typing import List, Optional
 import common
 
-from common import parse as hw3_parse
-from common import _SOCKET_NAME, _SHIPS_HEALTH
+from common import _SOCKET_NAME, _SHIPS_HEALTH, _READ_CHUNK, _escape, Symbol, Template
+
+# bytes a connection may have queued before it is dropped
+_OUTBOX_LIMIT = 1024 * 1024
+# longest and most deeply nested command accepted, a layout takes ~170 bytes
+# and two levels
+_MAX_FRAME = 4 * 1024
+_MAX_DEPTH = 8
+# where the layout hashes of finished games are computed
+_HASH_POOLS = ( "inline", "thread", "process" )
+# games handed to the pool at once
+_HASH_PART = 32
+# commands a running game may have queued before its players' connections
+# are not read any further
+_INBOX_LIMIT = 64
+# stands in for a frame which did not parse, when frames are passed on
+_INVALID_FRAME = b"()\n"
+
+# the messages the server sends
+_OK = Template( "ok", str )
+_ERROR = Template( "error", str )
+_STARTED = Template( "started", int )
+_JOINED = Template( "game", int, "joined" )
+_WAITING = Template( "waiting", str, int )
+_ACTIVE = Template( "active", str, str, int )
+# the messages of every round are formatted directly, calling a Template
+# costs more than the formatting itself
+_SHOOT = b"(shoot %d %d %d)\n"
+_HIT = b"(hit %d)\n"
+_MISS = b"(miss %d)\n"
+_END = b'(end %d "%s")\n'
+_GAME_OK = Template( "game", "ok" ).frame
+_GAME_ABORTED = Template( "game", "aborted" ).frame
+_HASH_MISMATCH = Template( "hash-mismatch", int, Symbol )
+_BOARD_MISMATCH = Template( "board-mismatch", int, Symbol )
+# reports following (game aborted) of a game cut short
+_LEFT = Template( "left", int, Symbol )
+_TIMEOUT = Template( "timeout", int, Symbol )
 
 class ServerError(Exception):
     pass
@@ -24,8 +65,445 @@ class InvalidExpression(ServerError):
 class LoginError(ServerError):
     pass
 
+def _compile_kind( kind ):
+    """Return ( predicate, description ) of one argument kind of a schema."""
+    if kind is int:
+        return ( lambda value: type(value) is int ), "a whole number"
+    if kind is str:
+        return ( lambda value: type(value) is str ), "a string in double quotes"
+    if kind is Symbol:
+        return ( lambda value: type(value) is Symbol ), "an identifier"
+    if isinstance( kind, ( set, frozenset ) ):
+        names = frozenset( kind )
+        return ( lambda value: type(value) is Symbol and value in names ), \
+               "one of " + ", ".join( sorted( names ) )
+
+    # ( name, kinds... ) of a nested compound
+    name, *kinds = kind
+    checks = [ _compile_kind( k )[0] for k in kinds ]
+    length = len(kind)
+
+    def check( value ):
+        return ( type(value) is tuple and len(value) == length
+                 and value[0] == name and type(value[0]) is Symbol
+                 and all( c( v ) for c, v in zip( checks, value[1:] ) ) )
+    return check, f"({name} ...)"
+
+
+def compile_schema( *schemas ):
+    """Compile the argument ‹schemas› of a command into one validator.
+
+    A schema is a tuple of argument kinds: int, str (a string literal),
+    Symbol (an identifier), a set of identifiers, or a tuple ( name, kinds... )
+    for a nested compound. The schemas must differ in length; the validator
+    raises InvalidExpression unless the command matches one of them.
+    """
+    by_length = { len(schema) + 1: [ _compile_kind( kind ) for kind in schema ] for schema in schemas }
+
+    def validate( command ):
+        checks = by_length.get( len(command) )
+        if checks is None:
+            raise InvalidExpression( f"Expected {command[0]} command in invalid format" )
+        for position, ( check, expected ) in enumerate( checks, 1 ):
+            if not check( command[position] ):
+                raise InvalidExpression( f"Argument {position} of {command[0]} must be {expected}" )
+    return validate
+
+
+class Command:
+    """An entry of the command registry: the handler and what it accepts."""
+    __slots__ = ( "handler", "validate", "game" )
+
+    def __init__( self, handler: str, *schemas, game=False ):
+        self.handler = handler      # name of the Server method, subclasses may override it
+        self.validate = compile_schema( *schemas )
+        # with ‹game›, the first argument is a game id and the task of a
+        # running game executes the command
+        self.game = game
+
+
+# (ship <size> <x> <y> vertical|horizontal) of a layout
+_SHIP = ( "ship", int, int, int, { "vertical", "horizontal" } )
+
+
+class Outbox:
+    """Queue of outgoing frames of one connection.
+
+    Sending never waits: frames are queued and a writer task hands all of
+    them queued meanwhile to a single writelines() call. A peer which does
+    not read its socket is disconnected when a frame comes while its
+    backlog exceeds ‹limit› bytes.
+    """
+
+    def __init__( self, writer, limit=_OUTBOX_LIMIT ):
+        self.writer = writer
+        self.limit = limit
+
+        self._frames = []
+        self._size = 0
+        self._ready = Event()
+        self._closed = False
+
+        self.sent_frames = 0
+        self.flushes = 0
+        self.peak_depth = 0
+
+        self._task = asyncio.ensure_future( self._flush_loop() )
+
+    @property
+    def depth( self ) -> int:
+        """Number of frames waiting for the writer task."""
+        return len(self._frames)
+
+    def send( self, frame: bytes ):
+        if self._closed:
+            return
+
+        # only what the peer has not read yet counts, a single frame larger
+        # than the limit still goes out
+        if self._size + self.writer.transport.get_write_buffer_size() > self.limit:
+            self._overflow()
+            return
+
+        self._frames.append( frame )
+        self._size += len(frame)
+        self.peak_depth = max( self.peak_depth, len(self._frames) )
+        self._ready.set()
+
+    def _overflow( self ):
+        self._closed = True
+        self._frames = []
+        # the reader of this connection sees EOF and cleans up
+        self.writer.transport.abort()
+
+    async def _flush_loop( self ):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+
+            frames, self._frames = self._frames, []
+            self._size = 0
+
+            self.writer.writelines( frames )
+            self.sent_frames += len(frames)
+            self.flushes += 1
+
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self._closed = True
+                return
+
+    def close( self ):
+        """Stop the writer task, the peer is gone."""
+        self._closed = True
+        self._task.cancel()
+
+    async def detach( self ):
+        """Stop the writer task once everything queued reached the socket."""
+        self.close()
+
+        self.writer.writelines( self._frames )
+        self.sent_frames += len(self._frames)
+        self._frames = []
+
+        # drain() only waits for the low water mark, the buffer has to be empty
+        self.writer.transport.set_write_buffer_limits( 0 )
+        await self.writer.drain()
+
+
+def _cell( x, y ) -> int:
+    """Bit number of the square ( x, y ) on a bitboard."""
+    return 10 * y + x
+
+
+def _ship_mask( size, x, y, vertical ) -> int:
+    step = 10 if vertical else 1
+    return sum( 1 << ( _cell( x, y ) + i * step ) for i in range(size) )
+
+
+# { ( size, x, y, "vertical"|"horizontal" ): bitboard } of every ship which
+# fits on the board
+_SHIP_MASKS = { ( size, x, y, direction ): _ship_mask( size, x, y, direction == "vertical" )
+                for size in ( 2, 3, 4, 5 )
+                for direction in ( "vertical", "horizontal" )
+                for x in range( 10 - ( 0 if direction == "vertical" else size - 1 ) )
+                for y in range( 10 - ( size - 1 if direction == "vertical" else 0 ) ) }
+
+
+def layout_mask( layout ) -> Optional[int]:
+    """Bitboard of the squares taken by the ships of ‹layout›.
+
+    The ships are ( size, x, y, direction ) as in a (layout ...) command.
+    None if a ship sticks out of the board, overlaps another one or the
+    ships do not take _SHIPS_HEALTH squares together.
+    """
+    board = 0
+    for ship in layout:
+        mask = _SHIP_MASKS.get( tuple( ship ) )
+        if mask is None or board & mask:
+            return None
+        board |= mask
+    return board if board.bit_count() == _SHIPS_HEALTH else None
+
+
+def _hash_layouts( jobs ) -> List[str]:
+    """common.hash_game() of each ( server_salt, salt, ships ) in ‹jobs›; runs in the hash pool."""
+    return [ common.hash_game( *job ) for job in jobs ]
+
+
+class PlayerSlot:
+    """One seat of a game.
+
+    The seat keeps its own copy of the login, the game outlives the
+    connection. Shots at this player's board are kept as bitboards, 100-bit
+    integers with the bit _cell( x, y ) set for each square reported hit or
+    missed.
+    """
+    __slots__ = ( "player", "nick", "salt", "server_salt", "hash", "layout", "turn",
+                  "hits", "misses", "opponent" )
+
+    def __init__( self, player, nick, salt, server_salt, hashed ):
+        self.player = player
+        self.nick = nick
+        self.salt = salt
+        self.server_salt = server_salt
+        self.hash = hashed
+        self.layout = None
+        self.turn = None            # cell of this player's shot until it is answered
+        self.hits = 0
+        self.misses = 0
+        self.opponent: Optional[PlayerSlot] = None
+
+    def hit_count( self ) -> int:
+        return self.hits.bit_count()
+
+
+class GameSession:
+    """The seats of a game, looked up by the player's writer.
+
+    Iterating a session gives the players, in the order they sat down.
+
+    Once both seats are taken, the game gets a task of its own: whatever
+    changes a running game is posted to its inbox and the task does one
+    thing after another, the connections only pass commands on.
+    """
+    __slots__ = ( "game_id", "host", "guest", "moved", "inbox", "task", "posted", "processed",
+                  "_room", "_failed", "_waiters" )
+
+    def __init__( self, game_id, host: PlayerSlot ):
+        self.game_id = game_id
+        self.host = host
+        self.guest: Optional[PlayerSlot] = None
+        self.moved = time.monotonic()     # when the game last went on
+        self.inbox: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.posted = 0                   # posts so far, the last one's number
+        self.processed = 0                # posts the task is done with
+        self._room: Optional[asyncio.Event] = None
+        self._failed = None
+        self._waiters = None              # [ ( post number, future ) ] of wait_for()
+
+    def seat( self, guest: PlayerSlot ):
+        """Take the second seat, the two players become opponents."""
+        self.guest = guest
+        guest.opponent = self.host
+        self.host.opponent = guest
+
+    @property
+    def slots( self ) -> tuple:
+        return ( self.host, ) if self.guest is None else ( self.host, self.guest )
+
+    def __getitem__( self, player ) -> PlayerSlot:
+        if self.host.player is player:
+            return self.host
+        if self.guest is not None and self.guest.player is player:
+            return self.guest
+        raise KeyError( player )
+
+    def __contains__( self, player ) -> bool:
+        return self.host.player is player or ( self.guest is not None and self.guest.player is player )
+
+    def __iter__( self ):
+        return iter( [ slot.player for slot in self.slots ] )
+
+    def __len__( self ) -> int:
+        return 1 if self.guest is None else 2
+
+    def run( self, failed ):
+        """Start the task of the game, it awaits ‹failed›() if something posted raises."""
+        self.inbox = asyncio.Queue()
+        # set while fewer than _INBOX_LIMIT posts are queued
+        self._room = asyncio.Event()
+        self._room.set()
+        self._failed = failed
+        self.task = asyncio.ensure_future( self._run() )
+
+    async def post( self, function, *args ) -> int:
+        """Have the task await ‹function›( *args ), after everything posted before.
+
+        The connections post this way: one which sends faster than the game
+        goes waits here, and is not read meanwhile. Returns the number of
+        the post, for wait_for().
+        """
+        while self.inbox.qsize() >= _INBOX_LIMIT and not self.task.done():
+            self._room.clear()
+            await self._room.wait()
+        self.inbox.put_nowait( ( function, args ) )
+        self.posted += 1
+        return self.posted
+
+    def post_nowait( self, function, *args ):
+        """post() for the server itself, its posts never wait."""
+        self.inbox.put_nowait( ( function, args ) )
+        self.posted += 1
+
+    async def wait_for( self, posted: int ):
+        """Wait until the task is done with the post numbered ‹posted›, or ended."""
+        if self.processed >= posted or self.task.done():
+            return
+        # most posts are never waited for, they get no future
+        done = asyncio.get_running_loop().create_future()
+        if self._waiters is None:
+            self._waiters = []
+        self._waiters.append( ( posted, done ) )
+        await done
+
+    def close( self ):
+        """End the task once it is done with what was posted so far."""
+        if self.inbox is not None:
+            self.inbox.put_nowait( None )
+
+    async def _run( self ):
+        try:
+            while True:
+                posted = await self.inbox.get()
+                if self.inbox.qsize() < _INBOX_LIMIT:
+                    self._room.set()
+                if posted is None:
+                    return
+                function, args = posted
+                try:
+                    await function( *args )
+                except Exception as e:
+                    asyncio.get_running_loop().call_exception_handler( {
+                        "message": f"unexpected error in game {self.game_id}",
+                        "exception": e,
+                        "task": self.task,
+                    } )
+                    # the game is in no known state, it cannot go on
+                    await self._failed()
+                finally:
+                    self.processed += 1
+                    if self._waiters:
+                        self._wake( self.processed )
+        finally:
+            # nobody waits for room which will not come, nor for the posts
+            # which came after close()
+            self._room.set()
+            if self._waiters:
+                self._wake( self.posted )
+
+    def _wake( self, upto ):
+        """Let those waiting for the posts numbered up to ‹upto› go on."""
+        waiters = []
+        for posted, done in self._waiters:
+            if posted > upto:
+                waiters.append( ( posted, done ) )
+            elif not done.done():
+                # unless they gave up waiting
+                done.set_result( None )
+        self._waiters = waiters
+
+
+class TimerWheel:
+    """Timeouts of all the connections and games, served by a single asyncio timer.
+
+    Deadlines are rounded up to whole ticks and kept in a ring of buckets;
+    the asyncio timer goes off once a tick, and only while some timeout is
+    pending. There is no cancelling: a callback must check whether it still
+    has anything to do.
+    """
+
+    def __init__( self, tick=0.5, buckets=256 ):
+        self.tick = tick
+        self._buckets = [ [] for _ in range(buckets) ]
+        self.pending = 0
+        self._start = 0.0
+        self._current = 0           # ticks since _start
+        self._handle = None
+
+    def call_later( self, delay, callback, *args ):
+        loop = asyncio.get_running_loop()
+        if self._handle is None:
+            self._start = loop.time()
+            self._current = 0
+            self._handle = loop.call_at( self._start + self.tick, self._turn )
+
+        due = max( math.ceil( ( loop.time() - self._start + delay ) / self.tick ), self._current + 1 )
+        self._buckets[ due % len(self._buckets) ].append( ( due, callback, args ) )
+        self.pending += 1
+
+    def _turn( self ):
+        self._current += 1
+        index = self._current % len(self._buckets)
+        # a bucket also holds timeouts of the next turns of the wheel
+        fire = [ entry for entry in self._buckets[index] if entry[0] <= self._current ]
+        if fire:
+            self._buckets[index] = [ entry for entry in self._buckets[index] if entry[0] > self._current ]
+            self.pending -= len(fire)
+
+        for _, callback, args in fire:
+            callback( *args )
+
+        if self.pending:
+            self._handle = asyncio.get_running_loop().call_at( self._start + ( self._current + 1 ) * self.tick,
+                                                               self._turn )
+        else:
+            self._handle = None
+
+
 class Server:
+
+    # { name: Command }, what execute() dispatches on
+    COMMANDS = {
+        "shoot": Command( "_shoot", ( int, int, int ), game=True ),
+        "hit": Command( "_hit_or_miss", ( int, ), game=True ),
+        "miss": Command( "_hit_or_miss", ( int, ), game=True ),
+        "nick": Command( "_nick", ( str, str ) ),
+        "start": Command( "_start", ( str, ) ),
+        "join": Command( "_join", ( int, str ) ),
+        "list": Command( "_list", (), ( { "wait" }, ) ),
+        "auto": Command( "_auto", ( str, ) ),
+        "joinplayer": Command( "_joinplayer", ( str, str ) ),
+        "layout": Command( "_layout", ( int, _SHIP, _SHIP, _SHIP, _SHIP, _SHIP ), game=True ),
+    }
+
+    # limits of the received frames, larger or deeper ones get an (error ...)
+    # and are dropped while they arrive
+    max_frame = _MAX_FRAME
+    max_depth = _MAX_DEPTH
+    # frames remembered by the memo all connections share, 0 for none
+    memo_size = 0
+    # the hashes of finished games are checked "inline" on the event loop or
+    # in a "thread" or "process" pool of hash_workers
+    hash_pool = "thread"
+    hash_workers = 2
+    # seconds a connection outside of a running game may stay silent, and a
+    # running game may stand still, before they are cut off; 0 for no limit
+    idle_timeout = 0
+    round_timeout = 0
+    # granularity of the timeouts
+    timer_tick = 0.5
+
     def __init__(self):
+        self._commands = { name: ( getattr( self, command.handler ), command.validate )
+                           for name, command in self.COMMANDS.items() }
+        self._game_commands = frozenset( name for name, command in self.COMMANDS.items() if command.game )
+        self.command_counts = dict.fromkeys( self.COMMANDS, 0 )
+        self.command_errors = dict.fromkeys( self.COMMANDS, 0 )
+        # { name: number of times executed / rejected with an (error ...) }
+        self.frame_memo = common.FrameMemo( self.memo_size ) if self.memo_size else None
         self.players = {}
         # { player_writer:
         #   {
@@ -33,33 +511,54 @@ class Server:
         #       "salt": <salt>
         #   }
         # }
+        self.nicks = {}
+        # { nick: player_writer }
+        self._outboxes = {}
+        # { player_writer: Outbox } of connected players
+        self.sent_frames = 0
+        self.flushes = 0
+        # totals of the closed outboxes
+        self._readers = {}
+        # { player_writer: task of its read loop, while it waits for data }
+        self._detaching = {}
+        # { player_writer: future } of connections handed over elsewhere
+        self._posted = {}
+        # { player_writer: ( game, number of the post ) } of the last
+        # command each connection posted to a game
         self.games = {}
-        # { game_id: 
-        #   {
-        #       p1_writer:
-        #       {
-        #           "hash": <hashed_layout>,
-        #           "hits": <hit_count>,
-        #       }
-        #       p2_writer:
-        #       ...
-        #   }
-        # }
+        # { game_id: GameSession }
+        self._seats = {}
+        # { player_writer: { game_id: None } }, the games of each player
         self.game_turns = {}
         # { game_id: player }
+        self._waiting = OrderedDict()
+        # { game_id: host_writer } of games waiting for the second player,
+        # in the order they were started; unlike a dict, taking the oldest
+        # one does not leave holes the next lookup has to walk past
+        self._hosted = {}
+        # { host_writer: OrderedDict( game_id: None ) }, the same games by their host
+        self._waiting_nicks = None
+        # frozenset of the hosts' nicks, None when it needs to be recomputed
+
+        self._listing = {}
+        # { game_id: "(waiting ...)" or "(active ...)" }, the (list) reply in parts
+        self._listing_reply = None
+        # encoded (games ...) reply, built on demand, None once the listing changes
         self._inner_id_counter = 1
 
-        self._new_game_event = Event()
+        self._hash_batch = None
+        # [ ( hash jobs, future ) ] of the games which ended in this tick of
+        # the event loop, None when no batch is being collected
+        self.hash_batches = 0
+        self._hash_executor: Optional[Executor] = None
+        # the hash pool, started with the first batch, shut down by close()
 
-    @staticmethod
-    def check_string_literal(command):
-        if not command.is_string():
-            raise UnknownCommand("String must be encapsulated in double quotes")
+        self._timers = TimerWheel( self.timer_tick )
+        self._last_seen = {}
+        # { player_writer: time.monotonic() of the last data received }
 
-    @staticmethod
-    def check_command_length(command, length):
-        if len(command) != length:
-            raise InvalidExpression(f"Expected {command[0]} command in invalid format")
+        # replaced by a fresh one every time the set of waiting games changes
+        self._new_game_event = Event()
 
     def check_player( self, player ):
         if player not in self.players:
@@ -74,68 +573,163 @@ class Server:
         self.check_game( game_id )
 
 
-    async def _send_to_player( self, player, command ):
-        player.write( f'{ str(command) }\n'.encode() )
-        await player.drain()
+    def _send_to_player( self, player, frame: bytes ):
+        outbox = self._outboxes.get( player )
+        # a player who left may still be part of a game
+        if outbox is not None:
+            outbox.send( frame )
+
+    def _connect( self, writer ) -> Outbox:
+        outbox = self._outboxes.get( writer )
+        if outbox is None:
+            outbox = Outbox( writer )
+            self._outboxes[ writer ] = outbox
+        return outbox
+
+    def _disconnect( self, writer ):
+        outbox = self._outboxes.pop( writer )
+        outbox.close()
+        self.sent_frames += outbox.sent_frames
+        self.flushes += outbox.flushes
+
+        self._leave_games( writer )
+        self._sign_out( writer )
+
+    def _leave_games( self, player, keep=None ):
+        """Withdraw the offers of ‹player› and abort their running games, all but game ‹keep›."""
+        for game_id in list( self._seats.get( player, () ) ):
+            if game_id == keep:
+                continue
+            game = self.games[game_id]
+            if len( game ) == 1:
+                self._claim_game( game_id )
+                self._remove_game( game_id )
+            else:
+                game.post_nowait( self._abort_game, game, [ _LEFT.part( game_id, game[player].nick ) ] )
 
-    async def _send_lines_to_player( self, player, command ):
-        player.write( f'{ str(command) }\n'.encode() )
-        await player.drain()
+    async def _abort_game( self, game, reports: List[bytes] ):
+        """End a running game early, ‹reports› tell the players why."""
+        if self.games.get( game.game_id ) is not game:
+            # it ended while this waited in the inbox
+            return
+        reports.append( b"\n" )
+        frame = b"".join( reports )
+        for player in game:
+            self._send_to_player( player, _GAME_ABORTED )
+            self._send_to_player( player, frame )
+            attributes = self.players.get( player )
+            if attributes is not None:
+                attributes["aborted"] = game.game_id
+        self._remove_game( game.game_id )
+
+    def _check_idle( self, writer ):
+        seen = self._last_seen.get( writer )
+        if seen is None:
+            # gone, or served elsewhere now
+            return
+        left = seen + self.idle_timeout - time.monotonic()
+        # a running game has a timeout of its own
+        if left <= 0 and any( len( self.games[g] ) == 2 for g in self._seats.get( writer, () ) ):
+            left = self.idle_timeout
+        if left > 0:
+            self._timers.call_later( left, self._check_idle, writer )
+            return
+        # the read loop sees the connection end and cleans up
+        writer.transport.abort()
 
+    def _check_round( self, game ):
+        if self.games.get( game.game_id ) is not game:
+            return
+        left = game.moved + self.round_timeout - time.monotonic()
+        if left > 0:
+            self._timers.call_later( left, self._check_round, game )
+            return
+        game.post_nowait( self._abort_game, game, [ _TIMEOUT.part( game.game_id, slot.nick ) for slot in self._stalling( game ) ] )
 
-    async def _nick( self, player, command ):
-        """ (nick "foo" "salt") """
-        Server.check_command_length( command, 3 )
+    @staticmethod
+    def _stalling( game ) -> List[PlayerSlot]:
+        """Seats of the players a running game is waiting for."""
+        slots = game.slots
+        if any( slot.hit_count() == _SHIPS_HEALTH for slot in slots ):
+            # (end ...) went out, the layouts are due
+            stalled = [ slot for slot in slots if slot.layout is None ]
+        else:
+            # an unanswered shot waits for its target, otherwise the round
+            # waits for whoever has not shot yet
+            stalled = ( [ slot for slot in slots if slot.opponent.turn is not None ]
+                        or [ slot for slot in slots if slot.turn is None ] )
+        return stalled or list( slots )
 
-        Server.check_string_literal( command[1] )
-        nick = str(command[1])
 
-        Server.check_string_literal( command[2] )
-        salt = str(command[2])
+    async def _nick( self, player, command ):
+        """ (nick "foo" "salt") """
+        _, nick, salt = command
 
         if not nick.isalnum():
             raise InvalidExpression("Login nick not alphanumeric")
 
-        for p,attributes in self.players.items():
-            if attributes["nick"] == nick and player != p:
-                raise LoginError("Nick already in use")
+        owner = self.nicks.get( nick )
+        if owner is not None and owner != player:
+            raise LoginError("Nick already in use")
 
         server_salt = common.generate_salt()
 
+        # logging in again releases the old nick
+        self._sign_out( player )
+        self._log_in( player, nick, salt, server_salt )
+
+        self._send_to_player( player, _OK( server_salt ) )
+
+    def _log_in( self, player, nick, salt, server_salt ):
+        self.nicks[ nick ] = player
         self.players[ player ] = {
             "nick": nick,
             "salt": salt,
             "server_salt": server_salt,
+            "listed": frozenset(),  # waiting nicks in the last (games ...) reply
+            "list_waiter": None,
+            "aborted": None,        # id of the last game aborted on the player
         }
 
-        await self._send_to_player( player, f'(ok "{server_salt}")' )
-
 
     async def _join( self, player, command ):
         """ (join 123 "hash") """
-        Server.check_command_length( command, 3 )
-        game_id = int(command[1])
-        hashed = str(command[2])
+        _, game_id, hashed = command
 
         if game_id not in self.games:
             raise LoginError("Game does not exist.")
 
+        # of several players joining the same game only the first one wins,
+        # nothing is awaited between the claim and taking the seat
+        self._claim_game( game_id )
+        self.games[game_id].seat( self._new_player_slot( player, hashed ) )
+        self._add_seat( player, game_id )
+        self._update_listing( game_id )
+
+        self._start_game( game_id )
+
+    def _start_game( self, game_id ):
+        """Both seats of a game are taken, let the players know."""
         game = self.games[game_id]
-        if len(game) >= 2:
-            raise LoginError("Cannot join, game active.")
+        for player in game:
+            self._send_to_player( player, _JOINED( game_id ) )
 
-        self.games[game_id][player] = {
-                "hash": hashed,
-                "hits": 0,
-                "layout": None,
-                "turn": None,
-                "cached_ships": [['?' for _ in range(10)] for _ in range(10)],
-            }
+        game.moved = time.monotonic()
+        self._run_game( game )
+
+    def _run_game( self, game ):
+        """Start the task of a game which has both players."""
+        game.run( lambda: self._abort_game( game, [ _ERROR.part( f"Game {game.game_id} failed" ) ] ) )
+        if self.round_timeout:
+            self._timers.call_later( self.round_timeout, self._check_round, game )
+
+    def _add_seat( self, player, game_id ):
+        self._seats.setdefault( player, {} )[ game_id ] = None
 
-        other_player = self._get_other_player( game_id, player )
-        await self._send_to_player( player, f'(game {game_id} joined)')
-        await self._send_to_player( other_player, f'(game {game_id} joined)')
 
+    def _new_player_slot( self, player, hashed ) -> PlayerSlot:
+        attributes = self.players[player]
+        return PlayerSlot( player, attributes["nick"], attributes["salt"], attributes["server_salt"], hashed )
 
     def _get_id_counter( self ):
         game_id = self._inner_id_counter
@@ -145,196 +739,330 @@ class Server:
 
     async def _start( self, player, command ):
         """ (start "hash") """
-        Server.check_command_length( command, 2 )
-
         if player not in self.players: # TODO ask if server will be standalone tested or not (with just battleship)
             raise LoginError("Player must be logged before starting a game")
 
-        hashed = str(command[1])
+        hashed = command[1]
 
         game_id = self._get_id_counter()
 
         assert game_id not in self.games #TODO remove
-        self.games[game_id] = {
-            player : {
-                "hash": hashed,
-                "hits": 0,
-                "layout": None,
-                "turn": None,
-                "cached_ships": [['?' for _ in range(10)] for _ in range(10)],
-            }
-        }
+        self.games[game_id] = GameSession( game_id, self._new_player_slot( player, hashed ) )
+        self._add_seat( player, game_id )
+        self._offer_game( game_id, player )
+        self._update_listing( game_id )
 
-        await self._send_to_player( player, f'(started {game_id})')
+        self._send_to_player( player, _STARTED( game_id ) )
 
 
 
-    def _get_all_games( self ) -> List[str]:
-        games = []
-        for g in self.games:
-            players = list(self.games[g])
-            if len(players) == 1:
-                games.append( f'(waiting "{self.players[ players[0] ]["nick"]}" {g})' )
-            elif len(players) == 2:
-                games.append( f'(active "{self.players[ players[0] ]["nick"]}" "{self.players[ players[1] ]["nick"]}" {g})' )
-            else:
-                assert False #TODO remove
-        return games
+    def _offer_game( self, game_id, host ):
+        self._waiting[ game_id ] = host
+        self._hosted.setdefault( host, OrderedDict() )[ game_id ] = None
+        self._lobby_changed()
 
+    def _claim_game( self, game_id ) -> asyncio.StreamWriter:
+        """Take a game off the offer and return its host."""
+        host = self._waiting.pop( game_id, None )
+        if host is None:
+            raise LoginError("Cannot join, game active.")
 
-    async def _list( self, player ):
-        """ (list) """
-        games = " ".join(self._get_all_games())
+        hosted = self._hosted[host]
+        del hosted[game_id]
+        if not hosted:
+            del self._hosted[host]
+
+        self._lobby_changed()
+        return host
+
+    def _update_listing( self, game_id ):
+        """Bring the (list) entry of a game up to date with the game."""
+        game = self.games.get( game_id )
+        slots = game.slots if game else ()
+        if len(slots) == 1:
+            self._listing[ game_id ] = _WAITING.part( slots[0].nick, game_id )
+        elif len(slots) == 2:
+            self._listing[ game_id ] = _ACTIVE.part( slots[0].nick, slots[1].nick, game_id )
+        else:
+            self._listing.pop( game_id, None )
 
-        await self._send_to_player( player, f'(games {games})' )
+        self._listing_reply = None
 
+    def _get_all_games( self ) -> List[bytes]:
+        return list( self._listing.values() )
 
-    def _get_other_player( self, game_id, player ) -> asyncio.StreamWriter:
-        other_player = None
-        for p in self.games[game_id]:
-            if player != p:
-                other_player = p
+    def _get_games_reply( self ) -> bytes:
+        if self._listing_reply is None:
+            self._listing_reply = b"(games " + b" ".join( self._listing.values() ) + b")\n"
+        return self._listing_reply
+
+    def _get_waiting_nicks( self ) -> frozenset:
+        if self._waiting_nicks is None:
+            self._waiting_nicks = frozenset( self.games[g_id].host.nick
+                                             for g_id in self._waiting )
+        return self._waiting_nicks
+
+    def _lobby_changed( self ):
+        """Wake up everyone blocked in (list wait)."""
+        self._waiting_nicks = None
+        self._new_game_event.set()
+        self._new_game_event = Event()
+
+    def _send_games( self, player ):
+        self.players[player]["listed"] = self._get_waiting_nicks()
+        self._send_to_player( player, self._get_games_reply() )
+
+    async def _send_games_when_changed( self, player ):
+        while True:
+            waiting = self._get_waiting_nicks()
+            if waiting and waiting != self.players[player]["listed"]:
                 break
-        assert other_player #TODO remove
-        return other_player
+            await self._new_game_event.wait()
+
+        self._send_games( player )
+
+    async def _list( self, player, command ):
+        """
+        request:    (list) or (list wait)
+        response:   (games ...)
+
+        With wait, the reply is held back until there are waiting games and
+        their nicks differ from the previous reply to the same player.
+        """
+        self.check_player( player )
+
+        if len(command) == 2:
+            waiter = self.players[player]["list_waiter"]
+            if waiter:
+                waiter.cancel()
+            # do not hold up the commands following on this connection
+            self.players[player]["list_waiter"] = asyncio.ensure_future(
+                self._send_games_when_changed( player ) )
+            return
+
+        self._send_games( player )
+
+
+    def _game_of( self, player, game_id ) -> Optional[GameSession]:
+        """The game ‹game_id› ‹player› plays in.
+
+        None for the game last aborted on the player: commands sent before
+        the (game aborted) arrived are dropped without an error.
+        """
+        game = self.games.get( game_id )
+        if game is not None and player in game:
+            return game
+
+        attributes = self.players.get( player )
+        if attributes is not None and attributes["aborted"] == game_id:
+            return None
+        if game is None:
+            raise ServerError(f"Game {game_id} does not exist.")
+        raise ServerError(f"Not a player of game {game_id}")
+
+    def _get_other_player( self, game_id, player ) -> asyncio.StreamWriter:
+        opponent = self.games[game_id][player].opponent
+        if opponent is None:
+            raise LoginError("Game not started")
+        return opponent.player
 
 
     async def _shoot( self, player, command ):
         """ (shoot <game_id> <col> <row> ) """
-        Server.check_command_length( command, 4 )
-        game_id = int(command[1])
-        col = int(command[2])
-        row = int(command[3])
+        _, game_id, col, row = command
 
-        assert col < 10 and row < 10 # TODO remove
-        assert game_id in self.games # TODO remove
+        if not ( 0 <= col < 10 and 0 <= row < 10 ):
+            raise InvalidExpression("Shot out of the board")
+        game = self._game_of( player, game_id )
+        if game is None:
+            return
 
         other_player = self._get_other_player( game_id, player )
 
-        if not other_player:
-            raise LoginError("Game not started")
-
-        if self.games[game_id][player]["turn"] is not None:
+        slot = game[player]
+        if slot.turn is not None:
             raise ServerError("Cannot shoot two times in row!")
 
-        self.games[game_id][player]["turn"] = [col, row]
-        await self._send_to_player(other_player, f"(shoot {game_id} {col} {row})")
+        slot.turn = _cell( col, row )
+        game.moved = time.monotonic()
+        self._send_to_player( other_player, _SHOOT % ( game_id, col, row ) )
 
 
     async def _hit_or_miss( self, player, command ):
-        Server.check_command_length( command, 2 )
-        identifier = command[0]
-        game_id = int(command[1])
+        identifier, game_id = command
 
-        #TODO check other player and game
+        game = self._game_of( player, game_id )
+        if game is None:
+            return
         other = self._get_other_player( game_id=game_id, player=player )
 
-        game = self.games[game_id]
-
-        await self._send_to_player( other, command )
+        # the shot was at the board of ‹player›, it is recorded there
+        target = game[player]
+        shooter = target.opponent
+        if shooter.turn is None:
+            raise ServerError("No shot to answer")
+        game.moved = time.monotonic()
 
-        x,y = game[other]["turn"]
-        board = game[other]["cached_ships"]
-        if identifier == "hit":
-            board[y][x] = "h"
-        elif identifier == "miss":
-            if board[y][x] == "?":
-                board[y][x] == "m"
+        self._send_to_player( other, ( _HIT if identifier == "hit" else _MISS ) % game_id )
 
-        game[other]["turn"] = None
+        cell = 1 << shooter.turn
+        shooter.turn = None
 
         if identifier == "hit":
-            game[other]["hits"] += 1
+            # a square already hit does not count twice
+            if target.hits & cell:
+                return
+            target.hits |= cell
 
-            if game[other]["hits"] == _SHIPS_HEALTH:
-                winner_nick = self.players[other]["nick"]
-                winner_message = f'(end {game_id} "{winner_nick}")' 
-                await self._send_to_player( player, winner_message )
-                await self._send_to_player( other, winner_message )
+            if target.hit_count() == _SHIPS_HEALTH:
+                winner_message = _END % ( game_id, _escape( shooter.nick ) )
+                self._send_to_player( player, winner_message )
+                self._send_to_player( other, winner_message )
 
                 #TODO should I set flag? error handling in case of invalid layout sending
                 # not described
 
+        elif not target.hits & cell:
+            target.misses |= cell
 
-    def _verify_hash( self, player, game_id ) -> bool:
-        game = self.games[game_id]
 
-        player_salt = self.players[player]["salt"]
-        player_server_salt = self.players[player]["server_salt"]
-        player_hash = game[player]["hash"]
+    @staticmethod
+    def _hash_job( slot ) -> tuple:
+        """Arguments of common.hash_game() for the layout of ‹slot›, plain enough to pickle."""
+        player_layout = [ ( int(t[1]), int(t[2]), t[3] == "vertical" ) for t in slot.layout ]
+        return ( str( slot.server_salt ), str( slot.salt ), player_layout )
 
-        layout = game[player]["layout"]
-        player_layout = [ (t[1], t[2], t[3] == "vertical") for t in layout ]
+    async def _verify_hashes( self, slots ) -> List[bool]:
+        """Whether the layouts of ‹slots› match their hashes.
 
-        calculated_hash = common.hash_game(player_server_salt, player_salt, player_layout)
+        The hashes of all the games ending in the same tick of the event loop
+        are computed together, off the event loop unless hash_pool is "inline".
+        """
+        loop = asyncio.get_running_loop()
+        if self._hash_batch is None:
+            self._hash_batch = []
+            # runs once the commands received in this tick were processed
+            loop.call_soon( self._submit_hash_batch )
+
+        done = loop.create_future()
+        self._hash_batch.append( ( [ self._hash_job( slot ) for slot in slots ], done ) )
+        hashes = await done
+        return [ hashed == slot.hash for hashed, slot in zip( hashes, slots ) ]
+
+    def _submit_hash_batch( self ):
+        batch, self._hash_batch = self._hash_batch, None
+        self.hash_batches += 1
+        asyncio.ensure_future( self._run_hash_batch( batch ) )
+
+    async def _run_hash_batch( self, batch ):
+        if self.hash_pool == "inline":
+            await self._hash_part( batch )
+            return
+        # the games of a part go on as soon as the part is done, not all of
+        # them in a single tick
+        await asyncio.gather( *[ self._hash_part( batch[i:i + _HASH_PART] )
+                                 for i in range( 0, len(batch), _HASH_PART ) ] )
+
+    async def _hash_part( self, batch ):
+        jobs = [ job for batch_jobs, _ in batch for job in batch_jobs ]
+        try:
+            if self.hash_pool == "inline":
+                hashes = _hash_layouts( jobs )
+            else:
+                hashes = await asyncio.get_running_loop().run_in_executor( self._get_hash_executor(),
+                                                                           _hash_layouts, jobs )
+        except Exception as e:
+            for _, done in batch:
+                if not done.done():
+                    done.set_exception( e )
+            return
 
-        return calculated_hash == player_hash
+        position = 0
+        for batch_jobs, done in batch:
+            if not done.done():
+                done.set_result( hashes[ position:position + len(batch_jobs) ] )
+            position += len(batch_jobs)
+
+    def _get_hash_executor( self ) -> Executor:
+        if self._hash_executor is None:
+            if self.hash_pool == "thread":
+                self._hash_executor = ThreadPoolExecutor( max_workers=self.hash_workers )
+            else:
+                # a forked copy of the server, its event loop and sockets
+                # included, is not safe to run; the pool's processes start afresh
+                self._hash_executor = ProcessPoolExecutor( max_workers=self.hash_workers,
+                                                           mp_context=multiprocessing.get_context( "spawn" ) )
+        return self._hash_executor
+
+    def close( self ):
+        """Shut the hash pool down, the hashes not computed yet are given up on."""
+        if self._hash_executor is not None:
+            self._hash_executor.shutdown( wait=False, cancel_futures=True )
+            self._hash_executor = None
 
     def _verify_board( self, player, game_id ) -> bool:
-        player_layout = self.games[game_id][player]["layout"]
-        cached_board = self.games[game_id][player]["cached_ships"]
-        nick = self.players[player]["nick"]
-
-        player_board = [['w' for _ in range(10)] for _ in range(10)]
-        # ship in shape (size, x, y, vertical||horizontal)
-        for size,x,y,direction in player_layout:
-            for i in range(size):
-                if direction == "horizontal":
-                    player_board[y][x+i] = 's'
-                else:
-                    player_board[y+i][x] = 's'
-
-        for x in range(10):
-            for y in range(10):
-                if cached_board[y][x] == 'h':
-                    if player_board[y][x] != 's':
-                        return False
-                elif cached_board[y][x] == 'm':
-                    if player_board[y][x] != 'w':
-                        return False
-
-        return True
+        slot = self.games[game_id][player]
+
+        ships = layout_mask( slot.layout )
+        if ships is None:
+            return False
+
+        # every hit on a ship, every miss on water
+        return not slot.hits & ~ships and not slot.misses & ships
 
 
     async def _verify( self, player, game_id ):
         other_player = self._get_other_player( game_id, player )
 
-        player_nick = self.players[player]["nick"]
-        other_player_nick = self.players[player]["nick"]
+        game = self.games[game_id]
+        player_nick = game[player].nick
+        other_player_nick = game[other_player].nick
 
-        p1_hash = self._verify_hash( player, game_id )
-        p2_hash = self._verify_hash( other_player, game_id )
+        # the game's task waits, nothing else can end the game meanwhile
+        p1_hash, p2_hash = await self._verify_hashes( [ game[player], game[other_player] ] )
 
         p1_board = self._verify_board( player, game_id )
         p2_board = self._verify_board( other_player, game_id )
 
         if p1_hash and p2_hash and p1_board and p2_board:
-            await self._send_to_player( player, f'(game ok)' )
-            await self._send_to_player( other_player, f'(game ok)')
+            self._send_to_player( player, _GAME_OK )
+            self._send_to_player( other_player, _GAME_OK )
             return
         
-        await self._send_to_player( player, f'(game aborted)' )
-        await self._send_to_player( other_player, f'(game aborted)' )
+        self._send_to_player( player, _GAME_ABORTED )
+        self._send_to_player( other_player, _GAME_ABORTED )
 
-        mismatch_message = ""
+        mismatches = []
         if not p1_hash:
-            mismatch_message += f'(hash-mismatch {game_id} {player_nick})'
+            mismatches.append( _HASH_MISMATCH.part( game_id, player_nick ) )
 
         if not p2_hash:
-            mismatch_message += f'(hash-mismatch {game_id} {other_player_nick})'
+            mismatches.append( _HASH_MISMATCH.part( game_id, other_player_nick ) )
 
         if not p1_board:
-            mismatch_message += f'(board-mismatch {game_id} {player_nick})'
+            mismatches.append( _BOARD_MISMATCH.part( game_id, player_nick ) )
 
         if not p2_board:
-            mismatch_message += f'(board-mismatch {game_id} {other_player_nick})'
+            mismatches.append( _BOARD_MISMATCH.part( game_id, other_player_nick ) )
+
+        # all the reports in one frame
+        mismatches.append( b"\n" )
+        mismatch_message = b"".join( mismatches )
 
-        await self._send_to_player( player, mismatch_message )
-        await self._send_to_player( other_player, mismatch_message )
+        self._send_to_player( player, mismatch_message )
+        self._send_to_player( other_player, mismatch_message )
 
     def _remove_game( self, game_id: int ):
         """Remove game from server."""
-        self.games.pop( game_id )
+        game = self.games.pop( game_id )
+        for player in game:
+            seats = self._seats[player]
+            del seats[game_id]
+            if not seats:
+                del self._seats[player]
+        self._update_listing( game_id )
+        # commands already in the inbox find the game gone
+        game.close()
 
     async def _layout( self, player, command ):
         #   (layout 123 (ship 5 0 0 horizontal)
@@ -346,39 +1074,42 @@ class Server:
         #     the order of ships is mandatory, the first argument is the size
         #     of the ship and the other two numbers are the x and y
         #     coordinates of the top/left square of the ship; 
-        Server.check_command_length( command, 7 )
-
-        game_id = int(command[1])
+        game_id = command[1]
 
         # TODO handle invalid layout ?
         ships = command[2:]
-        layout = [ [ int(s[1]), int(s[2]), int(s[3]), s[4] ] for s in ships  ]
+        layout = [ [ s[1], s[2], s[3], s[4] ] for s in ships  ]
         layout = sorted(layout, key=lambda x: (x[0], x[1], x[2]), reverse=True)
 
-        game = self.games[game_id]
-        assert game_id in self.games #TODO remove
-        game[player]["layout"] = layout
+        game = self._game_of( player, game_id )
+        if game is None:
+            return
+        # the game stays until both layouts are verified, a second one must not
+        # start another verification
+        if game[player].layout:
+            raise ServerError("Layout already sent")
+        game[player].layout = layout
+        game.moved = time.monotonic()
 
         other_player = self._get_other_player( game_id, player )
 
-        if game[other_player]["layout"]:
+        if game[other_player].layout:
             await self._verify(player, game_id)
             self._remove_game( game_id )
 
 
-    def _get_active_game( self, player = None ) -> Optional[int]:
+    def _get_active_game( self, player = None, exclude = None ) -> Optional[int]:
         """Get active game for a player. 
 
-        If player not specified, get random active game
+        If player not specified, get the longest waiting game which was
+        not started by ‹exclude›.
         """
-        for g_id in self.games:
-            players = list(self.games[g_id])
-            if len(players) == 1:
-                if player:
-                    if player == players[0]:
-                        return g_id
-                else:
-                    return g_id
+        if player:
+            return next( iter( self._hosted.get( player, () ) ), None )
+
+        for g_id, host in self._waiting.items():
+            if host != exclude:
+                return g_id
         return None
 
     #     wait_task = asyncio.create_task( await self._new_game_event.wait() )
@@ -387,138 +1118,305 @@ class Server:
 
     async def _auto( self, player, command ):
         # (auto "hash")
-        Server.check_command_length( command, 2 )
-        hashed = str(command[1]) # TODO remove string trimming
+        hashed = command[1]
 
-        game_id = self._get_active_game()
+        game_id = self._get_active_game( exclude=player )
         if not game_id:
-            await self._start( player, hw3_parse(f'(start "{hashed}")') )
+            await self._start( player, ( Symbol("start"), hashed ) )
         else:
-            await self._join( player, command=hw3_parse(f'(join {game_id} "{hashed}")') )
+            await self._join( player, command=( Symbol("join"), game_id, hashed ) )
 
     async def _joinplayer( self, player, command ):
         """
         request:    (joinplayer "nick" "hash")
         response:   (game <id> joined)
         """
-        Server.check_command_length( command, 3 )
-        nick = str(command[1])
-        hashed = str(command[2]) # TODO remove string trimming
-
-        other_player = None
-        for p in self.players:
-            if self.players[p]["nick"] == nick:
-                other_player = p
-                break
+        _, nick, hashed = command
 
+        other_player = self.nicks.get( nick )
         if not other_player:
-            raise UnknownCommand(f'(error "Player {nick} not found"')
+            raise UnknownCommand(f"Player {nick} not found")
 
         found = self._get_active_game( other_player )
         if not found:
-            raise UnknownCommand(f'(error "Player {nick} has not started game yet")')
+            raise UnknownCommand(f"Player {nick} has not started game yet")
 
-        await self._join( player, command=hw3_parse(f'(join {found} "{hashed}")') )
+        await self._join( player, command=( Symbol("join"), found, hashed ) )
 
 
     async def execute(self, command, player):
         identifier = command[0]
-
-        if identifier == "nick":
-            await self._nick( player, command )
-
-        elif identifier == "start":
-            await self._start( player, command )
-
-        elif identifier == "join":
-            await self._join( player, command )
-
-        elif identifier == "list":
-            await self._list( player )
-
-        elif identifier == "shoot":
-            await self._shoot( player, command )
-
-        elif identifier == "hit" or identifier == "miss":
-            await self._hit_or_miss( player, command )
-
-        elif identifier == "auto":
-            await self._auto( player, command )
-
-        elif identifier == "joinplayer":
-            await self._joinplayer( player, command )
-
-        elif identifier == "layout":
-            await self._layout( player, command )
-
-        else:
+        # a string literal in place of the command is no command at all
+        entry = self._commands.get( identifier ) if type(identifier) is Symbol else None
+        if entry is None:
             raise UnknownCommand("Command not known.")
 
+        handler, validate = entry
+        self.command_counts[identifier] += 1
+        try:
+            validate( command )
+            await handler( player, command )
+        except ServerError:
+            self.command_errors[identifier] += 1
+            raise
 
-    # def sign_out_user(self, peer):
-    #     if peer not in self.users:
-    #         return
-
-    #     for ch in self.channels_users:
-    #         if peer in self.channels_users[ch]:
-    #             self.channels_users[ch].remove(peer)
 
+    def _sign_out( self, player ):
+        """Forget the login of a player and release their nick."""
+        attributes = self.players.pop( player, None )
+        if attributes is None:
+            return
 
-    async def handle_client(self, reader, writer):
-        first_command = True
-
-        buffer = ""
-        while True:
-            try:
-                data = await reader.readexactly(1)
-            except IncompleteReadError:
-                # self.sign_out_user(writer)
-                break
-
-            buffer += data.decode()
-            command = hw3_parse( buffer )
-
-            if command is None:
-                continue
-
-            try:
+        self.nicks.pop( attributes["nick"] )
+        if attributes["list_waiter"]:
+            attributes["list_waiter"].cancel()
+
+
+    async def _process( self, player, command, first_command ):
+        if type(command) is not tuple:
+            raise InvalidExpression("Invalid expression")
+
+        if first_command and ( command[0] != "nick" or type(command[0]) is not Symbol ):
+            raise LoginError("Login first required")
+
+        game = self._running_game( player, command )
+        posted = self._posted.get( player )
+        if posted is not None and posted[0] is not game:
+            # the replies go out in the order of the commands, whatever was
+            # posted to another game comes first
+            del self._posted[ player ]
+            await posted[0].wait_for( posted[1] )
+            game = self._running_game( player, command )
+        if game is not None:
+            # replies and errors come from the game's task
+            self._posted[ player ] = ( game, await game.post( self._game_command, player, command ) )
+            return
 
-                if first_command:
-                    if command[0] != "nick":
-                        raise LoginError("Login first required")
-                    
+        await self.execute(command=command, player=player)
+
+    def _running_game( self, player, command ) -> Optional[GameSession]:
+        """The running game of ‹player› which ‹command› goes to, None if it is for the server."""
+        if type(command[0]) is not Symbol or command[0] not in self._game_commands or len(command) < 2:
+            return None
+        game = self.games.get( command[1] )
+        if game is None or game.inbox is None or player not in game:
+            # the handler has the right error for it, or drops it
+            return None
+        return game
+
+    async def _game_command( self, player, command ):
+        try:
+            await self.execute( command, player )
+        except ServerError as e:
+            self._send_to_player( player, _ERROR( str(e) ) )
+
+    def _detach( self, writer ) -> asyncio.Future:
+        """Stop serving a connection, but leave it open.
+
+        The future resolves to the bytes received and not processed yet, once
+        the read loop let go of the connection. What is sent to the player
+        meanwhile is still queued, until _hand_over().
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._detaching[ writer ] = future
+
+        reading = self._readers.get( writer )
+        if reading is not None:
+            reading.cancel()
+        return future
+
+    async def _serve( self, reader, writer, pending=b"", logged_in=False ):
+        """Read loop of one connection, ‹pending› bytes are processed first."""
+        first_command = not logged_in
+
+        self._connect( writer )
+        parser = common.StreamParser( native=True, max_frame=self.max_frame, max_depth=self.max_depth,
+                                      memo=self.frame_memo )
+        self._last_seen[ writer ] = time.monotonic()
+        if self.idle_timeout:
+            self._timers.call_later( self.idle_timeout, self._check_idle, writer )
+        data = pending
+        # commands received already, which the next server of a detached
+        # connection gets to process
+        unprocessed = b""
+        try:
+            while True:
+                commands = parser.feed( data )
+                for index, command in enumerate( commands ):
                     try:
-                        await self.execute(player=writer, command=command)
+                        await self._process( writer, command, first_command )
                         first_command = False
                     except ServerError as e:
-                        raise e
-                else:
-                    await self.execute(command=command, player=writer)
+                        self._send_to_player( writer, _ERROR( str(e) ) )
+
+                    if writer in self._detaching:
+                        unprocessed = self._reencode( commands[index + 1:] )
+                        break
+
+                if writer in self._detaching:
+                    break
+
+                self._readers[ writer ] = asyncio.current_task()
+                try:
+                    data = await reader.read( _READ_CHUNK )
+                except asyncio.CancelledError:
+                    if writer not in self._detaching:
+                        raise
+                    break
+                except ConnectionError:
+                    break
+                finally:
+                    del self._readers[ writer ]
+
+                if not data:
+                    break
+                self._last_seen[ writer ] = time.monotonic()
+        finally:
+            self._last_seen.pop( writer, None )
+            self._posted.pop( writer, None )
+            detached = self._detaching.pop( writer, None )
+            if detached is None:
+                self._disconnect( writer )
+                writer.close()
+
+        if detached is None:
+            return
+
+        # StreamReader has no public way to take the data it buffered
+        detached.set_result( unprocessed + parser.pending() + bytes( reader._buffer ) )
+
+    async def _hand_over( self, writer ):
+        """Stop sending to a detached connection, once everything queued for it was written out."""
+        await self._outboxes.pop( writer ).detach()
 
-            except ServerError as e:
-                error = f'(error "{str(e)}")\n'
-                writer.write(error.encode())
-                await writer.drain()
+    @staticmethod
+    def _reencode( commands ) -> bytes:
+        """Frames of parsed ‹commands›, the same to whoever parses them again."""
+        # a frame which was not a valid expression stays one
+        return b"".join( _INVALID_FRAME if command is None else common.encode( command ) for command in commands )
 
-            buffer = ""
+    async def handle_client(self, reader, writer):
+        await self._serve( reader, writer )
+
+
+def parse_address( address: str ):
+    """Split a listener address into ( "unix", path ) or ( "tcp", host, port ).
+
+    Accepted forms are ‹unix:path›, ‹tcp:host:port› and a bare unix socket
+    path; an IPv6 host goes in brackets, e.g. ‹tcp:[::1]:4000›.
+    """
+    kind, _, rest = address.partition( ":" )
+    if kind == "tcp":
+        host, _, port = rest.rpartition( ":" )
+        if not host or not port.isdigit():
+            raise ValueError( f"expected tcp:host:port, got {address}" )
+        return ( "tcp", host.strip( "[]" ), int(port) )
+    if kind == "unix":
+        return ( "unix", rest )
+    return ( "unix", address )
+
+
+async def listen( server, addresses ):
+    """Serve ‹server› on each of ‹addresses›, return the asyncio servers."""
+    listeners = []
+    for address in addresses:
+        kind, *where = parse_address( address )
+        if kind == "tcp":
+            host, port = where
+            listeners.append( await asyncio.start_server( server.handle_client, host, port ) )
+        else:
+            path = Path(os.getcwd()).joinpath( where[0] )
+            if path.is_socket():
+                path.unlink()
+            listeners.append( await asyncio.start_unix_server( server.handle_client, path=path ) )
+    return listeners
 
 
-async def start_server():
-    path = Path(os.getcwd()).joinpath(_SOCKET_NAME)
+async def start_server( server = None, addresses = ( _SOCKET_NAME, ) ):
+    server = server or Server()
+    listeners = await listen( server, addresses )
+    try:
+        await asyncio.gather( *[ s.serve_forever() for s in listeners ] )
+    finally:
+        server.close()
 
-    if os.path.isfile(path):
-        os.remove(path)
 
-    server = Server()
-    s = await asyncio.start_unix_server(server.handle_client, path=path)
-    await s.serve_forever() #TODO uncomment after testing
+def use_loop( name: str ):
+    """Make asyncio.run() use the event loop implementation ‹name›."""
+    if name == "uvloop":
+        # optional, only needed when asked for
+        import uvloop
+        asyncio.set_event_loop_policy( uvloop.EventLoopPolicy() )
+    elif name != "asyncio":
+        raise ValueError( f"unknown event loop {name}" )
 
 
 def main():
+    parser = argparse.ArgumentParser( description="Battleship server." )
+    parser.add_argument( "--workers", type=int, default=0,
+                         help="run games in this many worker processes, slower than a single process "
+                              "without a spare core per worker (default: single process)" )
+    parser.add_argument( "--listen", action="append", metavar="ADDRESS",
+                         help="unix:PATH, tcp:HOST:PORT or a unix socket path; may be repeated "
+                              f"(default: {_SOCKET_NAME})" )
+    parser.add_argument( "--loop", choices=( "asyncio", "uvloop" ), default="asyncio",
+                         help="event loop implementation (default: asyncio)" )
+    parser.add_argument( "--max-frame", type=int, default=_MAX_FRAME, metavar="BYTES",
+                         help=f"longest command accepted (default: {_MAX_FRAME})" )
+    parser.add_argument( "--max-depth", type=int, default=_MAX_DEPTH,
+                         help=f"deepest nesting of a command accepted (default: {_MAX_DEPTH})" )
+    parser.add_argument( "--frame-memo", type=int, default=0, metavar="FRAMES",
+                         help="remember this many parsed frames, repeated ones are not parsed again "
+                              "(default: 0, off)" )
+    parser.add_argument( "--hash-pool", choices=_HASH_POOLS, default=Server.hash_pool,
+                         help=f"where the layout hashes of finished games are checked (default: {Server.hash_pool})" )
+    parser.add_argument( "--hash-workers", type=int, default=Server.hash_workers, metavar="N",
+                         help=f"threads or processes of the hash pool (default: {Server.hash_workers})" )
+    parser.add_argument( "--idle-timeout", type=float, default=0, metavar="SECONDS",
+                         help="close connections silent for this long, unless they play a game (default: 0, never)" )
+    parser.add_argument( "--round-timeout", type=float, default=0, metavar="SECONDS",
+                         help="abort games standing still for this long (default: 0, never)" )
+    args = parser.parse_args()
+    if args.max_frame < 1 or args.max_depth < 1:
+        parser.error( "--max-frame and --max-depth must be positive" )
+    if args.frame_memo < 0:
+        parser.error( "--frame-memo must not be negative" )
+    if args.hash_workers < 1:
+        parser.error( "--hash-workers must be positive" )
+    if args.idle_timeout < 0 or args.round_timeout < 0:
+        parser.error( "--idle-timeout and --round-timeout must not be negative" )
+    # worker processes are daemons, which may not start processes of their own
+    if args.workers and args.hash_pool == "process":
+        parser.error( "--hash-pool process does not go with --workers, use thread" )
+
+    # the workers of a cluster are forked, they get the settings as well
+    Server.max_frame = args.max_frame
+    Server.max_depth = args.max_depth
+    Server.memo_size = args.frame_memo
+    Server.hash_pool = args.hash_pool
+    Server.hash_workers = args.hash_workers
+    Server.idle_timeout = args.idle_timeout
+    Server.round_timeout = args.round_timeout
+
+    addresses = args.listen or [ _SOCKET_NAME ]
+    try:
+        for address in addresses:
+            parse_address( address )
+        use_loop( args.loop )
+    except ValueError as e:
+        parser.error( str(e) )
+    except ImportError:
+        parser.error( f"{args.loop} is not installed" )
+
+    if args.workers:
+        import shipcluster
+        shipcluster.start_cluster( args.workers, addresses )
+        return
+
     async def main_simple():
-        await start_server()
+        await start_server( addresses=addresses )
 
     asyncio.run( main_simple() )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
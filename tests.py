@@ -1,5 +1,13 @@
 import time
 import asyncio
+import itertools
+import random
+
+import common
+import lisp
+import parsebench
+from parsebench import reference_parse, shape, native_shape, typed
+import shipserv
 
 _SOCKET_NAME = "chatsock"
 
@@ -23,9 +31,633 @@ class Test:
     async def basic():
         pass
 
+
+class TestFrameSplitter:
+
+    @staticmethod
+    async def split_chunks():
+        stream = b'(nick "foo" "salt")(shoot 1 2 3)\n(layout 1 (ship 5 0 0 horizontal))'
+        for chunk in range(1, len(stream) + 1):
+            frames = common.FrameSplitter()
+            got = []
+            for i in range(0, len(stream), chunk):
+                got += frames.feed( stream[i:i + chunk] )
+            assert got == [ b'(nick "foo" "salt")', b'(shoot 1 2 3)',
+                            b'(layout 1 (ship 5 0 0 horizontal))' ], f"{chunk}: {got}"
+            assert frames.pending() == b''
+
+    @staticmethod
+    async def strings_and_atoms():
+        frames = common.FrameSplitter()
+        got = frames.feed( b'(nick "a)(\\" "\\"")' )
+        assert got == [ b'(nick "a)(\\" "\\"")' ], got
+
+        got = frames.feed( b'  42\n\n(list' )
+        assert got == [ b'  42' ], got
+        assert frames.pending() == b'(list'
+        assert frames.feed( b')' ) == [ b'(list)' ]
+
+    @staticmethod
+    async def limits():
+        frames = common.FrameSplitter( max_frame=10, max_depth=2 )
+        assert frames.feed( b'(a b)(((x)))(abcdefghijk' ) == [ b'(a b)', None ]
+        # the rejected frame is not kept, whatever its length
+        assert frames.pending() == b''
+        assert frames.feed( b'lmnop "\\' + b'x' * 1000 ) == []
+        assert frames.pending() == b''
+        assert frames.feed( b'" x)(ok)\n  atom\n' ) == [ None, b'(ok)', b'  atom' ]
+
+        assert common.parse( '(a (b (c)))', max_depth=3 ) is not None
+        assert common.parse( '(a (b (c)))', max_depth=2 ) is None
+        assert common.parse( b'[a [b]]', max_depth=1 ) is None
+        deep = '(' * 100000 + ')' * 100000
+        assert common.parse( deep ) is None and common.parse( deep.encode() ) is None
+
+class TestStreamParser:
+
+    @staticmethod
+    async def feed_bytewise():
+        stream = b'(ok "salt")\n(games (waiting "foo" 1))\n(bad"\n'
+        parser = common.StreamParser()
+        got = []
+        for i in range(len(stream)):
+            done = parser.feed( stream[i:i + 1] )
+            if done:
+                assert stream[i:i + 1] == b')', f"completed at {stream[i:i + 1]}"
+            got += done
+
+        assert [ str(c) for c in got ] == [ '(ok salt)', '(games (waiting foo 1))' ], got
+        assert parser.pending() == b'(bad"\n'
+
+    @staticmethod
+    async def memo():
+        memo = common.FrameMemo( 2 )
+        parser = common.StreamParser( native=True, memo=memo )
+        stream = b'(hit 1)(list)(hit 1)(miss 2)(list)(hit 1)(bad"")'
+        expect = common.StreamParser( native=True ).feed( stream )
+        got = parser.feed( stream )
+        assert got == expect and got[0] is got[2], got
+        # (list) was pushed out by (miss 2), (hit 1) was used meanwhile
+        assert ( memo.hits, memo.misses, memo.evictions ) == ( 1, 6, 4 ), ( memo.hits, memo.misses, memo.evictions )
+        assert len(memo) == 2
+
+        try:
+            common.StreamParser( memo=memo )
+            assert False
+        except ValueError:
+            pass
+
+    @staticmethod
+    async def invalid_frame():
+        parser = common.StreamParser()
+        got = parser.feed( b'(shoot 1 2 3))(hit 1)' )
+        assert len(got) == 3 and got[1] is None, got
+        assert str(got[0]) == '(shoot 1 2 3)' and str(got[2]) == '(hit 1)'
+
+
+def check_same_as_reference( module, expressions ):
+    for expr in expressions:
+        got = shape( module.parse( expr ) )
+        expect = shape( reference_parse( module, expr ) )
+        assert got == expect, f"{module.__name__}.parse({expr!r}): {got} != {expect}"
+
+def short_expressions():
+    """Every expression up to 4 characters long over a tricky alphabet."""
+    alphabet = [ '(', ')', '[', ']', '"', '\\', ' ', '\n', '\x1c', 'a', '1', '.', '+', '#', 't', '²', '一' ]
+    return [ "".join( chars ) for n in range( 1, 5 ) for chars in itertools.product( alphabet, repeat=n ) ]
+
+def random_expressions( count=20000 ):
+    pieces = [ '(', ')', '[', ']', ' ', '  ', '\t', '"s"', '"a\\"b"', '"\\\\"', '"', '\\',
+               'nick', 'shoot', 'x1', 'ab.c#d', '+', '12', '-3', '4.5', '5.', '#t', '#f',
+               '(a)', '((b)c)', '١٢', 'é', '\xa0' ]
+    rnd = random.Random( 248 )
+    expressions = []
+    for _ in range( count ):
+        expr = "".join( rnd.choice( pieces ) for _ in range( rnd.randint( 1, 12 ) ) )
+        expressions.append( f"({expr})" if rnd.random() < 0.5 else expr )
+    return expressions
+
+class TestTokenizer:
+
+    @staticmethod
+    async def exhaustive():
+        expressions = short_expressions()
+        for module in ( common, lisp ):
+            check_same_as_reference( module, expressions )
+
+    @staticmethod
+    async def random_messages():
+        expressions = random_expressions()
+        for module in ( common, lisp ):
+            check_same_as_reference( module, expressions )
+
+    @staticmethod
+    async def bytes_input():
+        # received data parses to what its decoded text does
+        for expr in short_expressions() + random_expressions():
+            expect = shape( common.parse( expr ) )
+            data = expr.encode()
+            for given in ( data, bytearray( data ), memoryview( data ) ):
+                got = shape( common.parse( given ) )
+                assert got == expect, f"parse({given!r}): {got} != {expect}"
+
+    @staticmethod
+    async def native():
+        for expr in short_expressions() + random_expressions():
+            expect = native_shape( common.parse( expr ) )
+            for given in ( expr, expr.encode() ):
+                got = typed( common.parse( given, native=True ) )
+                assert got == expect, f"parse({given!r}, native=True): {got} != {expect}"
+
+        parser = common.StreamParser( native=True )
+        got = parser.feed( b'(layout 1 (ship 5 0 0 vertical))(nick "a" "b")' )
+        assert got == [ ( "layout", 1, ( "ship", 5, 0, 0, "vertical" ) ), ( "nick", "a", "b" ) ], got
+        assert type(got[0][0]) is common.Symbol and type(got[1][1]) is str
+
+    @staticmethod
+    async def gameplay():
+        hot = [ b'(shoot 12 3 4)', b'\n(hit 1)', b'(miss 0)', b'(shoot 007 0 9)' ]
+        for frame in hot:
+            assert common.parse_gameplay( frame ) is not None, frame
+        # whatever it recognizes, it decodes the same as parse()
+        frames = [ expr.encode() for expr in short_expressions() + random_expressions() ]
+        frames += hot + [ b'(shoot 1)', b'(hit 1 2 3)', b'(shoot  1 2 3)', b'[hit 1]', b'(hit 1 )' ]
+        for frame in frames:
+            got = common.parse_gameplay( frame )
+            if got is not None:
+                expect = typed( common.parse( frame, native=True ) )
+                assert typed( got ) == expect, f"parse_gameplay({frame!r}): {typed( got )} != {expect}"
+
+    @staticmethod
+    async def protocol():
+        check_same_as_reference( common, [
+            '(nick "foo" "salt")', '(shoot 12 3 4)', '(hit 1)', '(list wait)', '(games)',
+            '(layout 123 (ship 5 0 0 horizontal) (ship 4 5 5 vertical))',
+            '(games (waiting "foo" 1) (active "a" "b" 2))', '(end 1 "foo")', '#t', '-1.5', '"str"',
+            '((a)b)', '(x (a)b)', '("a"(b))', '(a(b))', '()', '(a]', '(a) b', '' ] )
+
+    @staticmethod
+    async def corpora():
+        for name, corpus in parsebench.make_corpora( 300 ).items():
+            found = parsebench.differences( corpus )
+            assert not found, f"{name}: {found}"
+
+class TestEncoder:
+
+    @staticmethod
+    async def round_trip():
+        for expr in short_expressions() + random_expressions():
+            value = common.parse( expr, native=True )
+            if type(value) is not tuple:
+                continue
+            frame = common.encode( value )
+            assert typed( common.parse( frame, native=True ) ) == typed( value ), f"{expr!r}: {frame!r}"
+            assert common.encode( common.parse( expr ) ) == frame, f"{expr!r}: {frame!r}"
+
+    @staticmethod
+    async def escaping():
+        frame = common.encode( ( common.Symbol( "error" ), 'a "b" \\ c', 1.5, True, [ -2 ] ) )
+        assert frame == b'(error "a \\"b\\" \\\\ c" 1.5 #t (-2))\n', frame
+        assert common.parse( frame, native=True )[1] == 'a "b" \\ c'
+        assert common.encode( common.parse( frame, native=True ) ) == frame
+        assert common.encode( common.parse( frame ) ) == frame
+
+    @staticmethod
+    async def templates():
+        assert common.Template( "shoot", int, int, int )( 12, 3, 4 ) == b'(shoot 12 3 4)\n'
+        assert common.Template( "end", int, str )( 1, 'x"%d' ) == b'(end 1 "x\\"%d")\n'
+        assert common.Template( "game", int, "joined" ).part( 7 ) == b'(game 7 joined)'
+        ok = common.Template( "game", "ok" )
+        assert ok.frame == ok() == b'(game ok)\n'
+        assert common.Template( "board-mismatch", int, common.Symbol )( 3, "foo" ) == b'(board-mismatch 3 foo)\n'
+
+class TestCommands:
+
+    @staticmethod
+    async def schemas():
+        validate = shipserv.compile_schema( (), ( int, str ) )
+        for expr in [ '(x)', '(x 1 "a")', '(x -3 "")' ]:
+            validate( common.parse( expr, native=True ) )
+        for expr in [ '(x 1)', '(x "1" "a")', '(x 1 a)', '(x 1.0 "a")', '(x #t "a")', '(x 1 "a" 2)' ]:
+            try:
+                validate( common.parse( expr, native=True ) )
+                assert False, expr
+            except shipserv.InvalidExpression:
+                pass
+
+        validate = shipserv.Server.COMMANDS["layout"].validate
+        validate( common.parse( '(layout 1' + ' (ship 5 0 0 vertical)' * 4 + ' (ship 2 9 9 horizontal))', native=True ) )
+        for ship in [ '(ship 5 0 0 diagonal)', '(ship 5 0 0 "vertical")', '(shop 5 0 0 vertical)',
+                      '(ship 5 0 vertical)', '[ship 5 "0" 0 vertical]', 'ship' ]:
+            try:
+                validate( common.parse( '(layout 1' + ' (ship 5 0 0 vertical)' * 4 + f' {ship})', native=True ) )
+                assert False, ship
+            except shipserv.InvalidExpression:
+                pass
+
+    @staticmethod
+    async def counters():
+        server = shipserv.Server()
+        for expr in [ '(shoot 1 2)', '(shoot "1" 2 3)', '(nope)', '("shoot" 1 2 3)', '(list wait now)' ]:
+            try:
+                await server.execute( common.parse( expr, native=True ), None )
+                assert False, expr
+            except shipserv.ServerError:
+                pass
+        assert server.command_counts["shoot"] == 2 and server.command_errors["shoot"] == 2
+        assert server.command_counts["list"] == 1 and server.command_errors["list"] == 1
+        assert sum( server.command_counts.values() ) == 3
+
+    @staticmethod
+    async def escaped_hash():
+        server = shipserv.Server()
+        host, guest, other = object(), object(), object()
+        for player, nick in ( ( host, "host" ), ( guest, "guest" ), ( other, "other" ) ):
+            server._log_in( player, nick, "salt1", "salt2" )
+
+        # auto and joinplayer pass the hash on as it was received
+        await server.execute( common.parse( r'(auto "a\"b")', native=True ), host )
+        await server.execute( common.parse( r'(auto "c\\d")', native=True ), guest )
+        await server.execute( common.parse( r'(start "e")', native=True ), other )
+        await server.execute( common.parse( r'(joinplayer "other" "f\"\\g")', native=True ), host )
+        assert server.games[1][host].hash == 'a"b' and server.games[1][guest].hash == 'c\\d'
+        assert server.games[2][host].hash == 'f"\\g'
+
+        for game_id in ( 1, 2 ):
+            game = server.games[game_id]
+            server._remove_game( game_id )
+            await asyncio.wait_for( game.task, 1 )
+
+
+class TestGameSession:
+
+    @staticmethod
+    async def seats_and_shots():
+        server = shipserv.Server()
+        host, guest = object(), object()
+        server._log_in( host, "host", "salt1", "salt2" )
+        server._log_in( guest, "guest", "salt3", "salt4" )
+
+        await server.execute( common.parse( '(start "hash1")', native=True ), host )
+        game = server.games[1]
+        assert list( game ) == [ host ] and guest not in game and game[host].opponent is None
+        await server.execute( common.parse( '(join 1 "hash2")', native=True ), guest )
+        assert list( game ) == [ host, guest ] and guest in game and len(game) == 2
+        assert game[host].opponent is game[guest] and game[guest].opponent is game[host]
+        assert game[guest].nick == "guest" and game[guest].hash == "hash2"
+
+        # the same square again is neither a second hit nor a miss
+        for col, row, reply in ( ( 3, 2, "hit" ), ( 4, 2, "miss" ), ( 3, 2, "hit" ), ( 3, 2, "miss" ) ):
+            await server.execute( common.parse( f'(shoot 1 {col} {row})', native=True ), host )
+            await server.execute( common.parse( f'({reply} 1)', native=True ), guest )
+        board = game[guest]
+        assert board.hits == 1 << 23 and board.misses == 1 << 24 and board.hit_count() == 1
+        assert game[host].hits == game[host].misses == 0 and game[host].turn is None
+
+        server._remove_game( 1 )
+        await asyncio.wait_for( game.task, 1 )
+
+    @staticmethod
+    async def inbox():
+        server = shipserv.Server()
+        host, guest = object(), object()
+        server._log_in( host, "host", "salt1", "salt2" )
+        server._log_in( guest, "guest", "salt3", "salt4" )
+        async def process( player, command ):
+            try:
+                await server._process( player, common.parse( command, native=True ), False )
+            except shipserv.ServerError:
+                pass
+
+        await server.execute( common.parse( '(start "hash1")', native=True ), host )
+        # not running yet, the error comes right away
+        await process( host, '(shoot 1 0 0)' )
+        assert server.command_errors["shoot"] == 1
+        await server.execute( common.parse( '(join 1 "hash2")', native=True ), guest )
+        game = server.games[1]
+
+        # the readers only post, the game's task does the rest in order
+        for player, command in ( ( host, '(shoot 1 3 2)' ), ( guest, '(hit 1)' ), ( host, '(shoot 1 3 2)' ),
+                                 ( host, '(shoot 1 4 2)' ) ):
+            await process( player, command )
+        assert game[guest].hits == 0 and game[host].turn is None and game.inbox.qsize() == 4
+        assert server.command_errors["shoot"] == 1
+        # a command which is not for the game waits for the player's posts
+        await process( guest, '(shoot 2 0 0)' )
+        assert game[guest].hits == 1 << 23
+        while game.inbox.qsize():
+            await asyncio.sleep( 0 )
+        await asyncio.sleep( 0 )
+        assert game[guest].hits == 1 << 23 and game[host].turn == 23
+        assert server.command_counts["shoot"] == 5 and server.command_errors["shoot"] == 3
+
+        server._remove_game( 1 )
+        await asyncio.wait_for( game.task, 1 )
+
+    @staticmethod
+    async def reply_order():
+        server = shipserv.Server()
+        listener, port = await TestTimeouts.serve( server )
+        r1, w1 = await TestTimeouts.login( port, "host" )
+        r2, w2 = await TestTimeouts.login( port, "guest" )
+        w1.write( b'(start "hash")' )
+        await check_line( r1, "(started 1)" )
+        w2.write( b'(join 1 "hash")' )
+        await check_line( r2, "(game 1 joined)" )
+        await check_line( r1, "(game 1 joined)" )
+
+        # the replies come in the order of the commands, those of the game included
+        w1.write( b'(shoot 1 1 1)(shoot 1 2 2)(list)' )
+        await check_line( r2, "(shoot 1 1 1)" )
+        await check_line( r1, '(error "Cannot shoot two times in row!")' )
+        await check_line( r1, '(games (active "host" "guest" 1))' )
+        w2.write( b'(list)(hit 1)(list)' )
+        await check_line( r2, '(games (active "host" "guest" 1))' )
+        await check_line( r2, '(games (active "host" "guest" 1))' )
+        await check_line( r1, "(hit 1)" )
+
+        for writer in ( w1, w2 ):
+            writer.close()
+            await writer.wait_closed()
+        await asyncio.sleep( 0.05 )
+        TestTimeouts.check_forgotten( server )
+        listener.close()
+
+    @staticmethod
+    async def inbox_limit():
+        game = shipserv.GameSession( 1, shipserv.PlayerSlot( object(), "host", "salt1", "salt2", "hash1" ) )
+        game.run( None )
+        go_on = asyncio.Event()
+        await game.post( go_on.wait )
+        await asyncio.sleep( 0 )
+
+        # the task is stuck, the inbox fills up and the next post waits
+        done = []
+        async def record( i ):
+            done.append( i )
+        for i in range( shipserv._INBOX_LIMIT ):
+            await game.post( record, i )
+        blocked = asyncio.ensure_future( game.post( record, "last" ) )
+        await asyncio.sleep( 0.01 )
+        assert not blocked.done() and game.inbox.qsize() == shipserv._INBOX_LIMIT
+        # the server's own posts do not wait
+        game.post_nowait( record, "server" )
+
+        go_on.set()
+        await asyncio.wait_for( blocked, 1 )
+        game.close()
+        await asyncio.wait_for( game.task, 1 )
+        assert done == [ *range( shipserv._INBOX_LIMIT ), "server", "last" ]
+
+    @staticmethod
+    async def failure():
+        server = shipserv.Server()
+        host, guest = object(), object()
+        server._log_in( host, "host", "salt1", "salt2" )
+        server._log_in( guest, "guest", "salt3", "salt4" )
+        await server.execute( common.parse( '(start "hash1")', native=True ), host )
+        await server.execute( common.parse( '(join 1 "hash2")', native=True ), guest )
+        game = server.games[1]
+
+        async def broken():
+            raise RuntimeError( "broken" )
+        errors = []
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler( lambda loop, context: errors.append( context["exception"] ) )
+        try:
+            # the game does not go on in whatever state it was left
+            await game.post( broken )
+            await asyncio.wait_for( game.task, 1 )
+        finally:
+            loop.set_exception_handler( None )
+        assert [ str(e) for e in errors ] == [ "broken" ]
+        assert 1 not in server.games and server.players[host]["aborted"] == 1
+        assert not server._seats and not server._listing
+
+    @staticmethod
+    async def board_masks():
+        fleet = [ [ 5, 0, 0, "horizontal" ], [ 4, 9, 0, "vertical" ], [ 3, 0, 2, "vertical" ],
+                  [ 3, 2, 9, "horizontal" ], [ 2, 5, 5, "vertical" ] ]
+        ships = shipserv.layout_mask( fleet )
+        assert ships.bit_count() == 17 and ships & 0b11111 == 0b11111 and ships >> 55 & 1 and ships >> 65 & 1
+        for x, y in [ ( 9, 3 ), ( 0, 4 ), ( 4, 9 ) ]:
+            assert ships >> shipserv._cell( x, y ) & 1, ( x, y )
+
+        # sticking out, overlapping, not the whole fleet
+        for ship in [ [ 5, 6, 0, "horizontal" ], [ 5, 0, 6, "vertical" ], [ 5, 0, 2, "horizontal" ],
+                      [ 2, 0, 0, "horizontal" ], [ 6, 0, 5, "horizontal" ] ]:
+            assert shipserv.layout_mask( [ ship ] + fleet[1:] ) is None, ship
+
+        server = shipserv.Server()
+        slot = shipserv.PlayerSlot( object(), "a", "salt", "salt", "hash" )
+        server.games[1] = shipserv.GameSession( 1, slot )
+        slot.layout = fleet
+        slot.hits, slot.misses = ships, 1 << shipserv._cell( 5, 4 )
+        assert server._verify_board( slot.player, 1 )
+        slot.misses |= 1 << shipserv._cell( 5, 5 )
+        assert not server._verify_board( slot.player, 1 )
+        slot.misses, slot.hits = 0, 1 << shipserv._cell( 5, 4 )
+        assert not server._verify_board( slot.player, 1 )
+
+    @staticmethod
+    async def hash_batches():
+        fleet = [ [ 5, 0, 0, "horizontal" ], [ 4, 0, 1, "horizontal" ], [ 3, 0, 2, "horizontal" ],
+                  [ 3, 0, 3, "horizontal" ], [ 2, 0, 4, "horizontal" ] ]
+        ships = [ ( x, y, direction == "vertical" ) for _, x, y, direction in fleet ]
+        for pool in shipserv._HASH_POOLS:
+            server = shipserv.Server()
+            server.hash_pool = pool
+            slots = []
+            for i in range(5):
+                slot = shipserv.PlayerSlot( object(), f"p{i}", f"salt{i}", "server", None )
+                slot.hash = common.hash_game( "server", slot.salt, ships if i != 3 else ships[::-1] )
+                slot.layout = fleet
+                slots.append( slot )
+
+            # games ending in the same tick are hashed together
+            got = await asyncio.gather( server._verify_hashes( slots[:2] ), server._verify_hashes( slots[2:] ) )
+            assert got == [ [ True, True ], [ True, False, True ] ] and server.hash_batches == 1, ( pool, got )
+            assert await server._verify_hashes( slots[3:4] ) == [ False ] and server.hash_batches == 2
+            server.close()
+
+
+class TestTimeouts:
+
+    class QuickServer( shipserv.Server ):
+        timer_tick = 0.01
+
+    @staticmethod
+    async def serve( server ):
+        listeners = await shipserv.listen( server, [ "tcp:127.0.0.1:0" ] )
+        return listeners[0], listeners[0].sockets[0].getsockname()[1]
+
+    @staticmethod
+    async def login( port, nick ):
+        reader, writer = await asyncio.open_connection( "127.0.0.1", port )
+        writer.write( f'(nick "{nick}" "salt")'.encode() )
+        assert ( await reader.readline() ).startswith( b'(ok ' )
+        return reader, writer
+
+    @staticmethod
+    def check_forgotten( server ):
+        for state in ( server.games, server.players, server.nicks, server._seats, server._waiting,
+                       server._hosted, server._listing, server._last_seen, server._outboxes,
+                       server._readers, server._detaching, server._posted ):
+            assert not state, state
+
+    @staticmethod
+    async def timer_wheel():
+        wheel = shipserv.TimerWheel( tick=0.01, buckets=4 )
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        fired = []
+        # 0.1 is more than one turn of the wheel away
+        for delay in ( 0.1, 0.005, 0.03, 0.03 ):
+            wheel.call_later( delay, lambda delay: fired.append( ( delay, loop.time() - start ) ), delay )
+        assert wheel.pending == 4
+        await asyncio.sleep( 0.2 )
+        assert [ delay for delay, _ in fired ] == [ 0.005, 0.03, 0.03, 0.1 ]
+        assert all( delay <= at < delay + 0.05 for delay, at in fired ), fired
+        assert wheel.pending == 0 and wheel._handle is None
+
+    @staticmethod
+    async def disconnect():
+        server = shipserv.Server()
+        listener, port = await TestTimeouts.serve( server )
+
+        # the offer of a host who leaves is withdrawn
+        r1, w1 = await TestTimeouts.login( port, "host" )
+        w1.write( b'(start "hash")' )
+        await check_line( r1, "(started 1)" )
+        w1.close()
+        await w1.wait_closed()
+        await asyncio.sleep( 0.05 )
+        r2, w2 = await TestTimeouts.login( port, "guest" )
+        w2.write( b'(list)' )
+        await check_line( r2, "(games )" )
+
+        # a game whose player leaves is aborted
+        r3, w3 = await TestTimeouts.login( port, "other" )
+        w2.write( b'(start "hash")' )
+        await check_line( r2, "(started 2)" )
+        w3.write( b'(join 2 "hash")' )
+        await check_line( r3, "(game 2 joined)" )
+        await check_line( r2, "(game 2 joined)" )
+        w3.close()
+        await check_line( r2, "(game aborted)" )
+        await check_line( r2, "(left 2 other)" )
+        # a shot on its way when the game ended is no error
+        w2.write( b'(shoot 2 1 1)(list)' )
+        await check_line( r2, "(games )" )
+        w2.write( b'(shoot 1 1 1)' )
+        await check_error( r2 )
+
+        w2.close()
+        await w2.wait_closed()
+        await asyncio.sleep( 0.05 )
+        TestTimeouts.check_forgotten( server )
+        listener.close()
+
+    @staticmethod
+    async def idle_and_round():
+        server = TestTimeouts.QuickServer()
+        server.idle_timeout = 0.3
+        server.round_timeout = 0.1
+        listener, port = await TestTimeouts.serve( server )
+
+        r1, w1 = await TestTimeouts.login( port, "host" )
+        r2, w2 = await TestTimeouts.login( port, "guest" )
+        w1.write( b'(start "hash")' )
+        await check_line( r1, "(started 1)" )
+        w2.write( b'(join 1 "hash")' )
+        await check_line( r2, "(game 1 joined)" )
+        await check_line( r1, "(game 1 joined)" )
+
+        # the guest does not answer the shot, the game is theirs to go on with
+        w1.write( b'(shoot 1 0 0)' )
+        await check_line( r2, "(shoot 1 0 0)" )
+        start = time.monotonic()
+        for reader in ( r1, r2 ):
+            await check_line( reader, "(game aborted)" )
+            await check_line( reader, "(timeout 1 guest)" )
+        assert 0.05 < time.monotonic() - start < 0.3
+
+        # out of the game, silent connections are closed
+        for reader in ( r1, r2 ):
+            assert await asyncio.wait_for( reader.read(), 1 ) == b""
+        assert time.monotonic() - start > 0.2
+        await asyncio.sleep( 0.05 )
+        TestTimeouts.check_forgotten( server )
+        listener.close()
+
+
+class TestOutbox:
+
+    @staticmethod
+    async def large_reply():
+        server = shipserv.Server()
+        for i in range( 45000 ):
+            host = object()
+            server._log_in( host, f"host{i}", "salt1", "salt2" )
+            await server._start( host, ( common.Symbol("start"), "hash" ) )
+        reply = server._get_games_reply()
+        assert len( reply ) > shipserv._OUTBOX_LIMIT
+
+        listener, port = await TestTimeouts.serve( server )
+        reader, writer = await TestTimeouts.login( port, "lister" )
+        # a reply larger than the limit goes out whole
+        for _ in range(2):
+            writer.write( b'(list)' )
+            assert await reader.readexactly( len( reply ) ) == reply
+
+        # one who does not read is cut off once the backlog exceeds the limit
+        writer.write( b'(list)' * 20 )
+        await asyncio.sleep( 0.2 )
+        try:
+            while await asyncio.wait_for( reader.read( 1 << 20 ), 1 ):
+                pass
+        except ConnectionResetError:
+            pass
+        await asyncio.sleep( 0.05 )
+        assert not server._outboxes and not server.nicks.get( "lister" )
+
+        writer.close()
+        listener.close()
+
+
 def main():
     async def main_simple():
         await Test.basic()
+        await TestFrameSplitter.split_chunks()
+        await TestFrameSplitter.strings_and_atoms()
+        await TestFrameSplitter.limits()
+        await TestStreamParser.feed_bytewise()
+        await TestStreamParser.invalid_frame()
+        await TestStreamParser.memo()
+        await TestTokenizer.exhaustive()
+        await TestTokenizer.random_messages()
+        await TestTokenizer.bytes_input()
+        await TestTokenizer.native()
+        await TestTokenizer.gameplay()
+        await TestTokenizer.protocol()
+        await TestTokenizer.corpora()
+        await TestEncoder.round_trip()
+        await TestEncoder.escaping()
+        await TestEncoder.templates()
+        await TestCommands.schemas()
+        await TestCommands.counters()
+        await TestCommands.escaped_hash()
+        await TestGameSession.seats_and_shots()
+        await TestGameSession.inbox()
+        await TestGameSession.reply_order()
+        await TestGameSession.inbox_limit()
+        await TestGameSession.failure()
+        await TestGameSession.board_masks()
+        await TestGameSession.hash_batches()
+        await TestTimeouts.timer_wheel()
+        await TestTimeouts.disconnect()
+        await TestTimeouts.idle_and_round()
+        await TestOutbox.large_reply()
 
     asyncio.run( main_simple() )
 